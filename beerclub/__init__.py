@@ -21,10 +21,26 @@ settings = dict(
     DATABASE_NAME='beerclub',
     DATABASE_ACCOUNT=None,
     DATABASE_PASSWORD=None,
+    DATABASE_BACKEND='couchdb', # Or 'sqlite', for small deployments and tests.
+    DATABASE_FILEPATH=None, # SQLite file; default DATABASE_NAME.sqlite in ROOT_DIR.
+    DATABASE_THREADS=8,  # Worker threads for the blocking database calls.
+    DATABASE_POOL_SIZE=8, # Max number of idle connections kept for reuse.
+    DATABASE_KEEPALIVE=60.0, # Seconds an idle connection is kept for reuse.
+    DATABASE_TIMEOUT=None,   # Socket timeout in seconds; None for no timeout.
+    DATABASE_BATCH_SIZE=1000, # Rows per request when paging through a view.
+    TRACE_REQUESTS=False, # Trace database calls; Server-Timing for admins.
+    TRACE_SLOW_REQUEST=1.0, # Seconds; log the trace of slower requests.
     COOKIE_SECRET=None, # Set to a secret long string of random characters.
     PASSWORD_SALT=None, # Set to a secret long string of random characters.
+    PASSWORD_ITERATIONS=260000, # PBKDF2-SHA256 iterations for password hashes.
+    PASSWORD_THREADS=2, # Worker threads for the password hashing.
+    PASSWORD_CACHE_TTL=300, # Seconds a verified password is remembered.
+    PASSWORD_CACHE_SIZE=1000, # Max number of verified passwords remembered.
     MIN_PASSWORD_LENGTH=8,
     LOGIN_SESSION_DAYS=31,
+    BALANCE_RECONCILE_INTERVAL=3600, # Seconds between balance cache checks.
+    SNAPSHOT_INTERVAL=3600, # Seconds between checks for new snapshots.
+    SNAPSHOT_BACKFILL_DAYS=31, # Max number of missed days to backfill.
     MEMBER_EMAIL_AUTOENABLE=None,
     EMAIL=dict(HOST='localhost',
                PORT=None,
@@ -32,6 +48,14 @@ settings = dict(
                USER=None,
                PASSWORD=None,
                SENDER=None),
+    EMAIL_BATCH_SIZE=20, # Max number of messages sent per batch.
+    EMAIL_KEEPALIVE=60, # Seconds an idle email server connection is kept.
+    EMAIL_QUEUE_POLL=60, # Seconds between checks for messages to retry.
+    EMAIL_RETRY_DELAY=60, # Seconds before the first retry; then doubled.
+    EMAIL_MAX_ATTEMPTS=8, # Max number of attempts to send a message.
+    MAILER_CONNECTIONS=3, # Email server connections for the bulk mailer.
+    MAILER_RATE=2.0, # Max number of messages per second for the bulk mailer.
+    MAILER_BURST=5, # Max number of messages sent at once by the bulk mailer.
     CONTACT_EMAIL=None,
     DISPLAY_NAVBAR_THEME='navbar-dark',
     DISPLAY_NAVBAR_BG_COLOR='bg-dark',
@@ -42,6 +66,13 @@ settings = dict(
     DISPLAY_ACCOUNT_DAYS=7,
     DISPLAY_PAYMENT_DAYS=7,
     DISPLAY_SNAPSHOT_DAYS=60,
+    DISPLAY_DASHBOARD_POINTS=200, # Max number of points in a chart.
+    DISPLAY_PAGE_SIZE=100, # Default number of events per page.
+    DISPLAY_PAGE_MAX=1000, # Max number of events per page.
+    PAGE_CACHE_SIZE=100, # Max number of rendered pages kept in memory.
+    PAGE_CACHE_MAX_BODY=1000000, # Max bytes of a page to keep in memory.
+    SESSION_CACHE_TTL=60, # Seconds a verified login session is reused.
+    SESSION_CACHE_SIZE=1000, # Max number of login sessions kept in memory.
     GLOBAL_ALERT=None,
     RULES_HTML="<ul><li>You must be a registered member to buy beer.</li></ul>",
     PAYMENT_INFO_HTML=None,
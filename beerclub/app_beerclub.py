@@ -7,13 +7,21 @@ import tornado.web
 import tornado.ioloop
 
 from beerclub import settings
+from beerclub import cache
+from beerclub import changes
+from beerclub import designs
+from beerclub import outbox
+from beerclub import snapshot
 from beerclub import uimodules
 from beerclub import utils
 from beerclub.home import (Home,
                            Snapshots,
                            SnapshotsCsv,
                            Dashboard,
-                           BalanceCsv)
+                           DashboardJson,
+                           BalanceCsv,
+                           Status,
+                           Metrics)
 from beerclub.member import (Member,
                              Settings,
                              Members,
@@ -42,7 +50,10 @@ from beerclub.event import (Event,
                             EventApiV1,
                             MemberEventApiV1)
 
-def main():
+POOL_LOG_INTERVAL = 3600        # Seconds.
+
+def get_application(db):
+    "Return the web application, using the given database."
     url = tornado.web.url
     handlers = [
         url(r'/', Home, name='home'),
@@ -68,6 +79,9 @@ def main():
         url(r'/snapshots', Snapshots, name='snapshots'),
         url(r'/snapshots.csv', SnapshotsCsv, name='snapshots_csv'),
         url(r'/dashboard', Dashboard, name='dashboard'),
+        url(r'/dashboard.json', DashboardJson, name='dashboard_json'),
+        url(r'/status', Status, name='status'),
+        url(r'/metrics', Metrics, name='metrics'),
         url(r'/balance.csv', BalanceCsv, name='balance_csv'),
         url(r'/event/([0-9a-f]{32})', Event, name='event'),
         url(r'/login', Login, name='login'),
@@ -83,7 +97,7 @@ def main():
             {'path': os.path.join(settings['ROOT_DIR'], 'static')}),
     ]
 
-    application = tornado.web.Application(
+    return tornado.web.Application(
         handlers=handlers,
         debug=settings.get('TORNADO_DEBUG', False),
         cookie_secret=settings['COOKIE_SECRET'],
@@ -92,14 +106,40 @@ def main():
         template_path=os.path.join(settings['ROOT_DIR'], 'html'),
         static_path=os.path.join(settings['ROOT_DIR'], 'static'),
         login_url=r'/',
+        db=db,
     )
+
+def main():
+    db = utils.get_db()
+    application = get_application(db)
     application.listen(settings['PORT'], xheaders=True)
     logging.info("tornado debug: %s", settings['TORNADO_DEBUG'])
     logging.info("web server %s", settings['BASE_URL'])
+    tornado.ioloop.PeriodicCallback(utils.log_pool_counters,
+                                    POOL_LOG_INTERVAL * 1000).start()
+    tornado.ioloop.PeriodicCallback(
+        cache.balances.reconcile,
+        settings['BALANCE_RECONCILE_INTERVAL'] * 1000).start()
+    tornado.ioloop.PeriodicCallback(
+        lambda: snapshot.run(db),
+        settings['SNAPSHOT_INTERVAL'] * 1000).start()
+    tornado.ioloop.IOLoop.current().spawn_callback(startup, db)
     tornado.ioloop.IOLoop.instance().start()
 
+async def startup(db):
+    """Regenerate any pending view indexes, while the server is running.
+    Then load the caches, follow the changes feed, start sending
+    the queued emails, and create any missing snapshots.
+    """
+    await designs.warm_views(db)
+    since = await utils.run_async(cache.initialize, db)
+    ioloop = tornado.ioloop.IOLoop.current()
+    ioloop.spawn_callback(changes.follow, db, since)
+    ioloop.spawn_callback(outbox.run, db)
+    await snapshot.run(db)
+
 
 if __name__ == "__main__":
     utils.setup()
-    utils.initialize()
+    utils.initialize(warm=False)
     main()
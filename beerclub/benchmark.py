@@ -0,0 +1,281 @@
+"""Benchmark the request handlers against an in-memory database.
+
+The web application from 'app_beerclub' is run in a thread of its own,
+using the stand-in from the module 'standin' instead of CouchDB, seeded
+with data from the module 'generate'. Each scenario is a number of
+requests for one page made by concurrent clients, for which the
+throughput and the latency percentiles are reported. The results may be saved to a JSON file and
+compared with those of a previous run, e.g. for another commit.
+"""
+
+import argparse
+import asyncio
+import http.cookies
+import json
+import logging
+import math
+import os
+import subprocess
+import sys
+import threading
+import time
+import urllib.parse
+
+import tornado.httpclient
+import tornado.httpserver
+import tornado.ioloop
+import tornado.netutil
+
+from beerclub import app_beerclub
+from beerclub import constants
+from beerclub import generate
+from beerclub import settings
+from beerclub import standin
+from beerclub import utils
+
+ADMIN_EMAIL = generate.ADMIN_EMAIL
+ADMIN_PASSWORD = 'benchmark'
+PERCENTILES = (50, 95, 99)
+
+# Name, method, path and body of the request. The account of a different
+# member is shown for each request.
+SCENARIOS = [
+    ('home', 'GET', '/', None),
+    ('purchase', 'POST', '/purchase', dict(purchase='credit', beverage='beer')),
+    ('members', 'GET', '/members', None),
+    ('ledger', 'GET', '/ledger', None),
+    ('account', 'GET', '/account/{member}', None),
+    ('activity', 'GET', '/activity', None),
+    ('ledger_csv', 'GET', '/ledger.csv', None),
+    ('payments_csv', 'GET', '/payments.csv', None),
+    ('members_csv', 'GET', '/members.csv', None),
+    ('balance_csv', 'GET', '/balance.csv', None),
+    ('snapshots_csv', 'GET', '/snapshots.csv', None),
+]
+
+
+def seed(db, members=200, days=365, purchases=200, randomseed=0):
+    """Load a generated dataset of the members, with the admin, and
+    their events over the given number of days until today, with two
+    pub nights per week, and the daily snapshots.
+    Return the list of emails of the enabled members.
+    """
+    generate.load(db, generate.Generator(members=members,
+                                         days=days,
+                                         purchases=purchases,
+                                         randomseed=randomseed,
+                                         admin_password=ADMIN_PASSWORD))
+    return [row.value for row in db.view('member/status',
+                                         key=constants.ENABLED)]
+
+def serve(db, sockets, started):
+    "Run the web application and its background tasks, in this thread."
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    server = tornado.httpserver.HTTPServer(app_beerclub.get_application(db),
+                                           xheaders=True)
+    server.add_sockets(sockets)
+    async def startup():
+        await app_beerclub.startup(db)
+        started.set()
+    tornado.ioloop.IOLoop.current().spawn_callback(startup)
+    tornado.ioloop.IOLoop.current().start()
+
+
+class Client(object):
+    "HTTP client keeping the cookies of a logged-in admin session."
+
+    def __init__(self, url):
+        self.url = url
+        self.cookies = http.cookies.SimpleCookie()
+        self.client = tornado.httpclient.AsyncHTTPClient(max_clients=100)
+
+    async def login(self):
+        "Log in as the admin. Raise ValueError if that fails."
+        await self.fetch('GET', '/')
+        response = await self.fetch('POST', '/login',
+                                    dict(email=ADMIN_EMAIL,
+                                         password=ADMIN_PASSWORD))
+        if constants.USER_COOKIE not in self.cookies:
+            raise ValueError("login failed: %s" % response.code)
+
+    async def fetch(self, method, path, body=None):
+        "Make the request; keep the cookies set. Return the response."
+        headers = {'Cookie': '; '.join(["%s=%s" % (k, m.value)
+                                        for k, m in self.cookies.items()])}
+        if body is not None:
+            body = dict(body)
+            body['_xsrf'] = self.cookies['_xsrf'].value
+            body = urllib.parse.urlencode(body)
+        response = await self.client.fetch(self.url + path,
+                                           method=method,
+                                           headers=headers,
+                                           body=body,
+                                           follow_redirects=False,
+                                           raise_error=False)
+        for cookie in response.headers.get_list('Set-Cookie'):
+            self.cookies.load(cookie)
+        return response
+
+
+async def run_scenario(client, scenario, members, requests, concurrency,
+                       warmup):
+    """Make the requests of the scenario, with the given number
+    of concurrent clients. Return the result.
+    """
+    name, method, path, body = scenario
+    paths = [path.format(member=urllib.parse.quote(members[n % len(members)]))
+             for n in range(warmup + requests)]
+    latencies = []
+    errors = []
+    async def worker(paths, measured):
+        while paths:
+            path = paths.pop()
+            start = time.perf_counter()
+            response = await client.fetch(method, path, body)
+            if not measured: continue
+            latencies.append(time.perf_counter() - start)
+            if response.code >= 400:
+                errors.append(response.code)
+    warmups = paths[requests:]
+    await asyncio.gather(*[worker(warmups, False) for n in range(concurrency)])
+    paths = paths[:requests]
+    start = time.perf_counter()
+    await asyncio.gather(*[worker(paths, True) for n in range(concurrency)])
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    result = dict(name=name,
+                  requests=len(latencies),
+                  errors=len(errors),
+                  throughput=len(latencies) / elapsed,
+                  mean=1000.0 * sum(latencies) / len(latencies))
+    for percentile in PERCENTILES:
+        pos = max(0, int(math.ceil(percentile / 100.0 * len(latencies))) - 1)
+        result["p%s" % percentile] = 1000.0 * latencies[pos]
+    return result
+
+async def run_scenarios(url, names, members, requests, concurrency, warmup):
+    "Log in, and run the named scenarios in order. Return the results."
+    client = Client(url)
+    await client.login()
+    result = []
+    for scenario in SCENARIOS:
+        if names and scenario[0] not in names: continue
+        result.append(await run_scenario(client, scenario, members,
+                                         requests, concurrency, warmup))
+        print_result(result[-1])
+    return result
+
+def print_result(result, previous=None):
+    "Print the result of a scenario, and the change from a previous one."
+    line = "%-14s %6i %4i %9.1f/s %8.1f ms %8.1f ms %8.1f ms" % \
+           (result['name'], result['requests'], result['errors'],
+            result['throughput'], result['p50'], result['p95'],
+            result['p99'])
+    if previous:
+        line += "   %+6.1f%% /s %+6.1f%% p50" % \
+                (100.0 * (result['throughput'] / previous['throughput'] - 1),
+                 100.0 * (result['p50'] / previous['p50'] - 1))
+    print(line)
+
+def get_commit():
+    "Return the current git commit of the source, if available."
+    try:
+        process = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                                 cwd=settings['ROOT_DIR'],
+                                 capture_output=True, text=True, check=True)
+        return process.stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def benchmark(members=200, purchases=200, days=365, requests=200,
+              concurrency=4, warmup=10, names=None, page_cache=True):
+    "Seed the stand-in, start the server, and run the scenarios."
+    if not settings['COOKIE_SECRET']:
+        settings['COOKIE_SECRET'] = utils.get_iuid()
+    if not settings['PASSWORD_SALT']:
+        settings['PASSWORD_SALT'] = utils.get_iuid()
+    if not page_cache:
+        settings['PAGE_CACHE_SIZE'] = 0
+    db = standin.Database()
+    start = time.perf_counter()
+    enabled = seed(db, members=members, days=days, purchases=purchases)
+    utils.initialize(db, warm=False)
+    print("seeded %i documents in %.1f s" %
+          (len(db), time.perf_counter() - start))
+    sockets = tornado.netutil.bind_sockets(0, '127.0.0.1')
+    url = "http://127.0.0.1:%s" % sockets[0].getsockname()[1]
+    settings['BASE_URL'] = url
+    started = threading.Event()
+    threading.Thread(target=serve, args=(db, sockets, started),
+                     daemon=True).start()
+    start = time.perf_counter()
+    started.wait()
+    print("started in %.1f s" % (time.perf_counter() - start))
+    print("%-14s %6s %4s %11s %11s %11s %11s" %
+          ('scenario', 'reqs', 'errs', 'throughput', 'p50', 'p95', 'p99'))
+    scenarios = asyncio.run(run_scenarios(url, names, enabled,
+                                          requests, concurrency, warmup))
+    return dict(timestamp=utils.timestamp(),
+                commit=get_commit(),
+                version=settings['VERSION'],
+                options=dict(members=members,
+                             purchases=purchases,
+                             days=days,
+                             requests=requests,
+                             concurrency=concurrency,
+                             page_cache=page_cache),
+                scenarios=scenarios)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING)
+    parser = argparse.ArgumentParser(
+        description='Benchmark the request handlers against'
+        ' an in-memory database.')
+    parser.add_argument('scenarios', metavar='SCENARIO', type=str, nargs='*',
+                        help="Scenarios to run; default all: %s" %
+                        ', '.join([s[0] for s in SCENARIOS]))
+    parser.add_argument('-m', '--members', type=int, default=200,
+                        help='Number of members to generate.')
+    parser.add_argument('-p', '--purchases', type=int, default=200,
+                        help='Mean number of purchases per pub night.')
+    parser.add_argument('-d', '--days', type=int, default=365,
+                        help='Number of days of events to generate.')
+    parser.add_argument('-n', '--requests', type=int, default=200,
+                        help='Number of requests per scenario.')
+    parser.add_argument('-c', '--concurrency', type=int, default=4,
+                        help='Number of concurrent clients.')
+    parser.add_argument('-w', '--warmup', type=int, default=10,
+                        help='Number of unmeasured requests per scenario.')
+    parser.add_argument('--no-page-cache', action='store_false',
+                        dest='page_cache', default=True,
+                        help='Do not reuse the rendered pages.')
+    parser.add_argument('-o', '--output', metavar='FILE', type=str,
+                        help='Save the results to the JSON file.')
+    parser.add_argument('--compare', metavar='FILE', type=str,
+                        help='Compare with the results in the JSON file.')
+    args = parser.parse_args()
+    result = benchmark(members=args.members,
+                       purchases=args.purchases,
+                       days=args.days,
+                       requests=args.requests,
+                       concurrency=args.concurrency,
+                       warmup=args.warmup,
+                       names=args.scenarios,
+                       page_cache=args.page_cache)
+    if args.output:
+        with open(args.output, 'w') as outfile:
+            json.dump(result, outfile, indent=2)
+        print('results saved to', args.output)
+    if args.compare:
+        with open(args.compare) as infile:
+            previous = json.load(infile)
+        print("compared with %s (%s):" % (previous.get('commit'),
+                                          previous['timestamp']))
+        previous = dict([(s['name'], s) for s in previous['scenarios']])
+        for scenario in result['scenarios']:
+            print_result(scenario, previous.get(scenario['name']))
+    # Do not wait for the executor threads of the server, e.g. the one
+    # waiting for the changes feed.
+    sys.stdout.flush()
+    os._exit(0)
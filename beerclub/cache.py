@@ -0,0 +1,464 @@
+"""In-process caches of database contents.
+
+They are kept coherent with the database by the notifications
+from the module 'changes'.
+"""
+
+import collections
+import copy
+import hashlib
+import hmac
+import logging
+import os
+import time
+
+import tornado.gen
+import tornado.ioloop
+
+from beerclub import changes
+from beerclub import constants
+from beerclub import settings
+from beerclub import utils
+
+
+class MemberCache(object):
+    "In-memory index of member documents by email, Swish number and API key."
+
+    def __init__(self):
+        self.loaded = False
+        self.docs = {}          # Member documents by id.
+        self.generations = {}   # Latest revision generation by id.
+        self.by_email = {}
+        self.by_swish = {}
+        self.by_api_key = {}
+        self.counters = dict(hits=0, misses=0, updates=0)
+
+    def load(self, db):
+        "Populate the cache from the database."
+        for doc in utils.get_docs(db, 'member/email'):
+            self.update(doc)
+        self.loaded = True
+        logging.info("member cache: loaded %s members", len(self.docs))
+
+    def update(self, doc):
+        """Add, update or remove the member document.
+        Documents of other types are ignored, as are old revisions.
+        """
+        docid = doc['_id']
+        if doc.get('_deleted'):
+            if docid not in self.docs: return
+        elif doc.get(constants.DOCTYPE) != constants.MEMBER:
+            return
+        generation = changes.revision_generation(doc)
+        if generation < self.generations.get(docid, 0): return
+        self.generations[docid] = generation
+        old = self.docs.pop(docid, None)
+        if old is not None:
+            self._unindex(self.by_email, old.get('email'), docid)
+            self._unindex(self.by_swish, old.get('swish'), docid)
+            self._unindex(self.by_api_key, old.get('api_key'), docid)
+        self.counters['updates'] += 1
+        if doc.get('_deleted'): return
+        doc = copy.deepcopy(doc)
+        self.docs[docid] = doc
+        self.by_email[doc['email']] = doc
+        if doc.get('swish'):
+            self.by_swish[doc['swish']] = doc
+        if doc.get('api_key'):
+            self.by_api_key[doc['api_key']] = doc
+
+    def _unindex(self, index, key, docid):
+        "Remove the entry from the index, if it refers to the document."
+        if key and index.get(key, {}).get('_id') == docid:
+            del index[key]
+
+    def get(self, email):
+        """Get a copy of the member identified by the email address.
+        If Swish is enabled, then also check if 'email' is
+        a Swish number, which must match exactly.
+        Raise KeyError if not in the cache.
+        """
+        email = email.strip().lower()
+        try:
+            return self._lookup(self.by_email, email)
+        except KeyError:
+            if settings['MEMBER_SWISH']:
+                return self._lookup(self.by_swish, email)
+            raise
+
+    def get_by_api_key(self, api_key):
+        """Get a copy of the member having the API key.
+        Raise KeyError if not in the cache.
+        """
+        return self._lookup(self.by_api_key, api_key)
+
+    def _lookup(self, index, key):
+        try:
+            if not self.loaded: raise KeyError
+            doc = index[key]
+        except KeyError:
+            self.counters['misses'] += 1
+            raise KeyError(key)
+        self.counters['hits'] += 1
+        return copy.deepcopy(doc)
+
+    def get_metrics(self):
+        "Return the current counters and size, and the feed staleness."
+        result = self.counters.copy()
+        result['size'] = len(self.docs)
+        result['staleness'] = changes.staleness()
+        return result
+
+
+class BalanceCache(object):
+    """In-memory table of the balance of each member, the sum for all
+    members, and the Beer Club balance (i.e. payments). It is loaded
+    from the reduce views, and then updated for each event document
+    saved or deleted, with a periodic reconciliation against the views.
+    """
+
+    # Drift smaller than this is rounding noise.
+    TOLERANCE = 0.001
+    # Seconds to wait before confirming a drift found by reconciliation.
+    RECHECK_PAUSE = 10.0
+
+    def __init__(self):
+        self.db = None
+        self.loaded = False
+        self.balances = {}      # Balance by member email.
+        self.members_balance = 0.0
+        self.beerclub_balance = 0.0
+        # Contribution of events changed since loading, by event id:
+        # (revision generation, member email, member credit, payment credit)
+        self.contributions = {}
+        self.version = 0        # Incremented for each update.
+        self.reconciling = False
+        self.counters = dict(updates=0, reconciliations=0, drifts=0)
+
+    def load(self, db):
+        "Load the balances from the reduce views."
+        self.db = db
+        self.set(*self.fetch(db))
+        self.loaded = True
+        logging.info("balance cache: loaded %s balances", len(self.balances))
+
+    def fetch(self, db):
+        "Get the member balances and the Beer Club balance from the views."
+        balances = {}
+        for row in db.view('event/credit', group_level=1, reduce=True):
+            balances[row.key] = row.value
+        return balances, utils.get_beerclub_balance(db)
+
+    def set(self, balances, beerclub_balance):
+        self.balances = balances
+        self.members_balance = sum(balances.values())
+        self.beerclub_balance = beerclub_balance
+        self.version += 1
+
+    def get(self, member=None):
+        "Get the balance for the member, or the sum of all members."
+        if member is None:
+            return self.members_balance
+        else:
+            return self.balances.get(member['email'], 0)
+
+    def update(self, doc):
+        """Update the balances for the event document.
+        A deleted document whose contents and contribution are unknown
+        (i.e. created before loading, and deleted by another process)
+        triggers reconciliation, as does a modified such event.
+        """
+        docid = doc['_id']
+        generation = changes.revision_generation(doc)
+        doctype = doc.get(constants.DOCTYPE)
+        try:
+            old = self.contributions[docid]
+        except KeyError:
+            if doctype is None and doc.get('_deleted'):
+                self.spawn_reconcile()
+                return
+            elif doctype != constants.EVENT:
+                # Remember deletions in this process of other documents,
+                # to recognize them when they arrive via the changes feed.
+                if doc.get('_deleted'):
+                    self.contributions[docid] = (generation, None, 0.0, 0.0)
+                return
+            elif doc.get('_deleted'):
+                # Deleted in this process; the contents is available.
+                old = (0, ) + self.contribution(doc)
+            elif generation == 1:
+                # Created; it cannot have been counted already.
+                old = (0, None, 0.0, 0.0)
+            else:
+                self.spawn_reconcile()
+                return
+        if generation < old[0]: return
+        if doc.get('_deleted'):
+            new = (generation, None, 0.0, 0.0)
+        else:
+            new = (generation, ) + self.contribution(doc)
+        self.contributions[docid] = new
+        if old[1] is not None:
+            self.add(old[1], -old[2], -old[3])
+        if new[1] is not None:
+            self.add(new[1], new[2], new[3])
+        self.counters['updates'] += 1
+
+    def contribution(self, doc):
+        "Return the tuple (member, member credit, payment credit) of the event."
+        credit = doc.get('credit') or 0.0
+        if doc['member'] == constants.BEERCLUB:
+            member_credit = 0.0
+        else:
+            member_credit = credit
+        if doc.get('action') == constants.PAYMENT:
+            payment_credit = credit
+        else:
+            payment_credit = 0.0
+        return (doc['member'], member_credit, payment_credit)
+
+    def add(self, email, member_credit, payment_credit):
+        if email != constants.BEERCLUB:
+            self.balances[email] = self.balances.get(email, 0) + member_credit
+            self.members_balance += member_credit
+        self.beerclub_balance += payment_credit
+        self.version += 1
+
+    def spawn_reconcile(self):
+        "Reconcile in the background."
+        tornado.ioloop.IOLoop.current().spawn_callback(self.reconcile)
+
+    async def reconcile(self):
+        """Compare the table with the reduce views, and log any drift.
+        A drift is corrected only if it is still the same after a pause,
+        with no updates in between, since the views and the changes feed
+        may momentarily differ.
+        """
+        if not self.loaded or self.reconciling: return
+        self.reconciling = True
+        try:
+            self.counters['reconciliations'] += 1
+            drift, fetched = await self.get_drift()
+            if not drift: return
+            await tornado.gen.sleep(self.RECHECK_PAUSE)
+            if drift != (await self.get_drift())[0]: return
+            self.counters['drifts'] += 1
+            for key, (table, view) in sorted(drift.items()):
+                logging.warning("balance cache drift %s: table %s, view %s",
+                                key, table, view)
+            self.set(*fetched)
+            # Invalidate any rendered pages showing balances.
+            changes.status['version'] += 1
+        except Exception as error:
+            logging.error("balance cache reconciliation: %s", error)
+        finally:
+            self.reconciling = False
+
+    async def get_drift(self):
+        """Return a dictionary of the differences between the table and
+        the views, and the values fetched from the views. The dictionary
+        is empty if no differences, or if updates occurred meanwhile.
+        """
+        version = self.version
+        fetched = await utils.run_async(self.fetch, self.db)
+        if version != self.version: return {}, fetched
+        balances, beerclub_balance = fetched
+        result = {}
+        for email in set(balances).union(self.balances):
+            table = self.balances.get(email, 0)
+            view = balances.get(email, 0)
+            if abs(table - view) > self.TOLERANCE:
+                result[email] = (table, view)
+        if abs(self.beerclub_balance - beerclub_balance) > self.TOLERANCE:
+            result[constants.BEERCLUB] = (self.beerclub_balance,
+                                          beerclub_balance)
+        return result, fetched
+
+    def get_metrics(self):
+        "Return the current counters and size."
+        result = self.counters.copy()
+        result['size'] = len(self.balances)
+        return result
+
+
+class PageCache(object):
+    """Bounded in-memory store of rendered response bodies, by a key
+    identifying the request. Each entry is valid only for the ETag
+    it was stored with.
+    """
+
+    def __init__(self):
+        self.entries = collections.OrderedDict()
+        self.counters = dict(hits=0, misses=0, not_modified=0)
+
+    def get(self, key, etag):
+        """Get the headers and body chunks for the key and ETag.
+        Raise KeyError if not in the cache, or stored for another ETag.
+        """
+        try:
+            entry = self.entries[key]
+            if entry[0] != etag: raise KeyError
+        except KeyError:
+            self.counters['misses'] += 1
+            raise KeyError(key)
+        self.entries.move_to_end(key)
+        self.counters['hits'] += 1
+        return entry[1], entry[2]
+
+    def set(self, key, etag, headers, chunks):
+        "Store the headers and body chunks; evict the least recently used."
+        self.entries[key] = (etag, headers, chunks)
+        self.entries.move_to_end(key)
+        while len(self.entries) > settings['PAGE_CACHE_SIZE']:
+            self.entries.popitem(last=False)
+
+    def get_metrics(self):
+        "Return the current counters and size."
+        result = self.counters.copy()
+        result['size'] = len(self.entries)
+        return result
+
+
+class SessionCache(object):
+    """Bounded in-memory store of the members of verified login sessions,
+    by the value of the secure cookie. An entry expires after a short
+    time, and is removed when the member document changes, e.g. when
+    logging out or being disabled. It is not used until enabled, i.e.
+    until it is registered for the change notifications.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.entries = collections.OrderedDict()
+        self.by_member = {}     # Cookie values by member document id.
+        self.counters = dict(hits=0, misses=0, invalidations=0)
+
+    def get(self, value):
+        """Get a copy of the member of the session for the cookie value.
+        Raise KeyError if not in the cache, or expired, or not enabled.
+        """
+        try:
+            if not self.enabled: raise KeyError
+            expires, member = self.entries[value]
+            if expires < time.monotonic():
+                self.remove(value)
+                raise KeyError
+        except KeyError:
+            self.counters['misses'] += 1
+            raise KeyError(value)
+        self.entries.move_to_end(value)
+        self.counters['hits'] += 1
+        return copy.deepcopy(member)
+
+    def set(self, value, member):
+        "Store the member for the cookie value; evict the least recently used."
+        if not self.enabled: return
+        self.remove(value)
+        expires = time.monotonic() + settings['SESSION_CACHE_TTL']
+        self.entries[value] = (expires, copy.deepcopy(member))
+        self.by_member.setdefault(member['_id'], set()).add(value)
+        while len(self.entries) > settings['SESSION_CACHE_SIZE']:
+            self.remove(next(iter(self.entries)))
+
+    def remove(self, value):
+        "Remove the entry for the cookie value, if any."
+        try:
+            expires, member = self.entries.pop(value)
+        except KeyError:
+            return
+        values = self.by_member.get(member['_id'], set())
+        values.discard(value)
+        if not values:
+            self.by_member.pop(member['_id'], None)
+
+    def update(self, doc):
+        "Remove all sessions of the member, if the document is a member."
+        values = self.by_member.pop(doc['_id'], None)
+        if not values: return
+        for value in values:
+            self.entries.pop(value, None)
+        self.counters['invalidations'] += 1
+
+    def get_metrics(self):
+        "Return the current counters and size."
+        result = self.counters.copy()
+        result['size'] = len(self.entries)
+        return result
+
+
+class CredentialCache(object):
+    """Bounded in-memory store of recently verified passwords, by member
+    email, so that the password need not be hashed for each request made
+    with HTTP Basic authentication. Only a keyed digest of the password is
+    kept, together with the stored hashed form it was verified against;
+    an entry is not valid after the password has been changed.
+    """
+
+    def __init__(self):
+        self.key = os.urandom(32)
+        self.entries = collections.OrderedDict()
+        self.counters = dict(hits=0, misses=0)
+
+    def get_digest(self, password):
+        "Return the keyed digest of the password."
+        return hmac.new(self.key, password.encode('utf-8'),
+                        hashlib.sha256).digest()
+
+    def check(self, member, password):
+        """Has the password recently been verified for the member,
+        as currently stored?
+        """
+        try:
+            expires, stored, digest = self.entries[member['email']]
+            if expires < time.monotonic() or \
+               stored != member.get('password') or \
+               not hmac.compare_digest(digest, self.get_digest(password)):
+                raise KeyError
+        except KeyError:
+            self.counters['misses'] += 1
+            return False
+        self.entries.move_to_end(member['email'])
+        self.counters['hits'] += 1
+        return True
+
+    def set(self, member, password):
+        """Record that the password has been verified for the member;
+        evict the least recently used.
+        """
+        expires = time.monotonic() + settings['PASSWORD_CACHE_TTL']
+        self.entries[member['email']] = (expires,
+                                         member.get('password'),
+                                         self.get_digest(password))
+        self.entries.move_to_end(member['email'])
+        while len(self.entries) > settings['PASSWORD_CACHE_SIZE']:
+            self.entries.popitem(last=False)
+
+    def get_metrics(self):
+        "Return the current counters and size."
+        result = self.counters.copy()
+        result['size'] = len(self.entries)
+        return result
+
+
+members = MemberCache()
+balances = BalanceCache()
+pages = PageCache()
+sessions = SessionCache()
+credentials = CredentialCache()
+
+
+def initialize(db):
+    """Load the caches, and register them for change notifications.
+    Return the database update sequence from which to follow the changes.
+    The balances are loaded before getting the sequence, since they
+    must not be updated twice for the same event; the periodic
+    reconciliation takes care of any change missed in between.
+    """
+    balances.load(db)
+    since = db.info()['update_seq']
+    members.load(db)
+    changes.add_listener(members.update)
+    changes.add_listener(balances.update)
+    changes.add_listener(sessions.update)
+    sessions.enabled = True
+    return since
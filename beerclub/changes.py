@@ -0,0 +1,104 @@
+"""Follow the CouchDB changes feed, and notify the in-process caches.
+
+Documents saved or deleted by this process are notified directly,
+while changes made by other processes arrive via the feed.
+"""
+
+import concurrent.futures
+import logging
+import time
+
+import tornado.gen
+import tornado.ioloop
+
+TIMEOUT = 60000                 # Milliseconds for a longpoll request.
+ERROR_PAUSE = 5.0               # Seconds to wait after an error.
+
+_listeners = []
+_executor = None
+
+# Current state of the feed: last sequence seen, monotonic time of the
+# last successful response, number of changes and of errors, and the
+# number of notifications, which is incremented also for local changes.
+status = dict(seq=None, synced=None, changes=0, errors=0, version=0)
+
+
+def add_listener(func):
+    "Add a function to be called with each changed document."
+    _listeners.append(func)
+
+def notify(doc):
+    """Notify all listeners of a changed document.
+    A deleted document is a stub containing '_id', '_rev' and '_deleted'.
+    """
+    status['version'] += 1
+    for func in _listeners:
+        try:
+            func(doc)
+        except Exception as error:
+            logging.error("changes listener %s: %s", func.__name__, error)
+
+def notify_deleted(doc):
+    """Notify all listeners that the given document has been deleted.
+    Unlike deletions arriving via the feed, the contents is included.
+    """
+    doc = dict(doc)
+    doc['_rev'] = "%i-" % (revision_generation(doc) + 1)
+    doc['_deleted'] = True
+    notify(doc)
+
+def revision_generation(doc):
+    "Return the generation number of the document's revision; 0 if none."
+    try:
+        return int(doc['_rev'].split('-', 1)[0])
+    except (KeyError, ValueError, AttributeError):
+        return 0
+
+def get_version():
+    """Return a value identifying the state of the database as seen by
+    this process, or None if the feed has not been started. It changes
+    as soon as a document is saved or deleted by this process, and when
+    the feed reports changes made by other processes.
+    """
+    if status['synced'] is None: return None
+    return "%s-%s" % (status['seq'], status['version'])
+
+def staleness():
+    """Return the number of seconds since the feed last confirmed that
+    the caches are up to date, or None if the feed has not been started.
+    """
+    if status['synced'] is None: return None
+    return time.monotonic() - status['synced']
+
+async def follow(db, since):
+    """Follow the changes feed from the given sequence, forever.
+    The longpoll requests run in an executor of their own, so as not
+    to occupy any of the threads for the ordinary database calls.
+    """
+    global _executor
+    if _executor is None:
+        _executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix='beerclub-changes')
+    status['seq'] = since
+    status['synced'] = time.monotonic()
+    ioloop = tornado.ioloop.IOLoop.current()
+    while True:
+        try:
+            result = await ioloop.run_in_executor(
+                _executor,
+                lambda: db.changes(feed='longpoll',
+                                   since=status['seq'],
+                                   include_docs='true',
+                                   timeout=TIMEOUT))
+        except Exception as error:
+            status['errors'] += 1
+            logging.error("changes feed: %s", error)
+            await tornado.gen.sleep(ERROR_PAUSE)
+            continue
+        for change in result['results']:
+            doc = change.get('doc')
+            if doc is None: continue
+            notify(doc)
+            status['changes'] += 1
+        status['seq'] = result['last_seq']
+        status['synced'] = time.monotonic()
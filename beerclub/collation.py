@@ -0,0 +1,34 @@
+"""Approximation of the CouchDB collation of view keys.
+
+For strings, punctuation < digits < letters, case-insensitively.
+Used by the stand-in databases, and for checking the page cursors.
+"""
+
+
+def char_key(c):
+    "Collation key for a character."
+    if c.isalpha():
+        return (2, c.lower(), c.isupper())
+    elif c.isdigit():
+        return (1, c, False)
+    else:
+        return (0, c, False)
+
+def collation_key(value):
+    "Collation key for a view key."
+    if value is None:
+        return (0,)
+    elif value is False:
+        return (1,)
+    elif value is True:
+        return (2,)
+    elif isinstance(value, (int, float)):
+        return (3, value)
+    elif isinstance(value, str):
+        return (4, tuple([char_key(c) for c in value]))
+    elif isinstance(value, (list, tuple)):
+        return (5, tuple([collation_key(v) for v in value]))
+    elif isinstance(value, dict):
+        return (6, tuple([(collation_key(k), collation_key(v))
+                          for k, v in value.items()]))
+    raise TypeError("cannot collate %r" % value)
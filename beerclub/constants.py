@@ -13,7 +13,8 @@ DOCTYPE  = 'beerclub_doctype'
 MEMBER   = 'member'
 EVENT    = 'event'
 SNAPSHOT = 'snapshot'
-ENTITIES = (MEMBER, EVENT, SNAPSHOT)
+MESSAGE  = 'message'
+ENTITIES = (MEMBER, EVENT, SNAPSHOT, MESSAGE)
 
 # Member status
 PENDING  = 'pending'
@@ -21,6 +22,11 @@ ENABLED  = 'enabled'
 DISABLED = 'disabled'
 STATUSES = (PENDING, ENABLED, DISABLED)
 
+# Message status
+QUEUED = 'queued'
+SENT   = 'sent'
+FAILED = 'failed'
+
 # Member roles
 ADMIN  = 'admin'
 MEMBER = 'member'
@@ -42,3 +48,7 @@ EMAIL_PATTERN = '*@*.*'
 API_KEY_HEADER = 'X-BeerClub-API-key'
 JSON_MIME = 'application/json'
 CSV_MIME  = 'text/csv'
+
+# Name of the tar member containing the metadata of a dump file.
+# Not a valid document id, since it starts with an underscore.
+DUMP_METADATA = '_beerclub_dump.json'
@@ -1,9 +1,21 @@
 "CouchDB design documents (view index definitions)."
 
+import concurrent.futures
 import logging
+import time
 
 import couchdb
+import tornado.gen
+import tornado.ioloop
 
+# State of the index of a view.
+PENDING  = 'pending'
+BUILDING = 'building'
+READY    = 'ready'
+
+# Whether all view indexes are ready, and the state of the index of each
+# view in a design document that has been updated since startup.
+status = dict(ready=False, views=dict())
 
 DESIGNS = dict(
 
@@ -62,6 +74,14 @@ DESIGNS = dict(
 """function(doc) {
   if (doc.beerclub_doctype !== 'event') return;
   emit(doc.log.timestamp, doc.credit);
+}"""),
+        latest=dict(reduce="_stats", # event/latest
+                    map=
+"""function(doc) {
+  if (doc.beerclub_doctype !== 'event') return;
+  if (!doc.log || !doc.log.timestamp) return;
+  if (isNaN(Date.parse(doc.log.timestamp))) return;
+  emit(doc.member, Date.parse(doc.log.timestamp));
 }"""),
         activity=dict(map=      # event/activity
 """function(doc) {
@@ -69,6 +89,13 @@ DESIGNS = dict(
   if (doc.action !== 'purchase') return;
   if (doc.credit === 0.0) return;
   emit(doc.log.timestamp, doc.member);
+}"""),
+        balance=dict(reduce="_sum", # event/balance
+                     map=
+"""function(doc) {
+  if (doc.beerclub_doctype !== 'event') return;
+  if (doc.member === 'beerclub') return;
+  emit(doc.date, doc.credit);
 }"""),
         payment=dict(reduce="_sum", # event/payment
                      map=
@@ -83,20 +110,84 @@ DESIGNS = dict(
 """function(doc) {
   if (doc.beerclub_doctype !== 'snapshot') return;
   emit(doc.date, doc.beerclub_balance);
+}"""),
+        series=dict(map=        # snapshot/series
+"""function(doc) {
+  if (doc.beerclub_doctype !== 'snapshot') return;
+  emit(doc.date, [doc.beerclub_balance, doc.members_balance,
+                  doc.member_counts.pending, doc.member_counts.enabled,
+                  doc.member_counts.disabled]);
 }""")
     ),
+    message=dict(
+        queue=dict(reduce="_count", # message/queue
+                   map=
+"""function(doc) {
+  if (doc.beerclub_doctype !== 'message') return;
+  if (doc.status !== 'queued') return;
+  emit(doc.next_attempt, doc.recipient);
+}"""),
+    ),
 )
 
 
-def load_design_documents(db):
-    "Load the design documents (view index definitions)."
+def load_design_documents(db, warm=True):
+    """Load the design documents (view index definitions).
+    The views of the updated design documents are marked as pending.
+    If 'warm' is True, then regenerate their indexes before returning,
+    otherwise this is done by 'warm_views'.
+    """
     for entity, designs in DESIGNS.items():
-         updated = update_design_document(db, entity, designs)
-         if updated:
+        updated = update_design_document(db, entity, designs)
+        if updated:
+            status['ready'] = False
             for view in designs:
-                name = "%s/%s" % (entity, view)
-                logging.info("regenerating index for view %s" % name)
-                list(db.view(name, limit=10))
+                status['views']["%s/%s" % (entity, view)] = PENDING
+    if warm:
+        for entity in DESIGNS:
+            warm_design(db, entity)
+        status['ready'] = True
+
+async def warm_views(db):
+    """Regenerate the pending view indexes in the background, concurrently
+    for the design documents. The requests run in an executor of their
+    own, so as not to occupy any of the threads for the ordinary
+    database calls. Set the readiness flag when done.
+    """
+    pending = [e for e in DESIGNS
+               if "%s/%s" % (e, list(DESIGNS[e])[0]) in status['views']]
+    if pending:
+        executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=len(pending), thread_name_prefix='beerclub-designs')
+        ioloop = tornado.ioloop.IOLoop.current()
+        await tornado.gen.multi([ioloop.run_in_executor(executor,
+                                                        warm_design,
+                                                        db, entity)
+                                 for entity in pending])
+        executor.shutdown()
+    status['ready'] = True
+    logging.info("view indexes ready")
+
+def warm_design(db, entity):
+    """Regenerate the indexes of the pending views of the design document.
+    CouchDB builds the indexes for all views in a design document at once,
+    so the first query takes the time.
+    """
+    for view in DESIGNS[entity]:
+        name = "%s/%s" % (entity, view)
+        if status['views'].get(name) != PENDING: continue
+        logging.info("regenerating index for view %s" % name)
+        status['views'][name] = BUILDING
+        start = time.perf_counter()
+        try:
+            list(db.view(name, limit=10))
+        except Exception as error:
+            status['views'][name] = "error: %s" % error
+            logging.error("regenerating index for view %s: %s", name, error)
+        else:
+            status['views'][name] = READY
+            logging.info("index for view %s ready in %.1f s",
+                         name, time.perf_counter() - start)
 
 def update_design_document(db, design, views):
     "Update the design document (view index definition)."
@@ -2,9 +2,14 @@
 
 By default, the dump file will be called 'dump_{ISO date}.tar.gz'
 using today's date.
+
+A delta dump contains only the documents changed or deleted since
+a previous dump, full or delta. The update sequence of the database
+is recorded in each dump file for this purpose.
 """
 
 import argparse
+import base64
 import io
 import json
 import logging
@@ -14,44 +19,113 @@ import tarfile
 import time
 
 from beerclub import constants
+from beerclub import settings
 from beerclub import utils
 
 
-def dump(db, filepath):
+def dump(db, filepath, since=None):
     """Dump contents of the database to a tar file, optionally gzip compressed.
     Skip any entity that does not contain a doctype field.
+    The documents are read in batches, with their attachments inline.
+    If 'since' is given, it is the database update sequence recorded
+    in a previous dump, and only the documents changed since then are
+    dumped, with a deleted document as a stub.
     """
     count_items = 0
     count_files = 0
+    count_bytes = 0
+    start = time.perf_counter()
     if filepath.endswith('.gz'):
         mode = 'w:gz'
     else:
         mode = 'w'
     outfile = tarfile.open(filepath, mode=mode)
-    for key in db:
-        doc = db[key]
+    # Any change made during the dump will be in the next delta dump.
+    metadata = dict(update_seq=db.info()['update_seq'],
+                    since=since,
+                    timestamp=utils.timestamp())
+    add_item(outfile, constants.DUMP_METADATA, json.dumps(metadata))
+    if since is None:
+        docs = get_all_docs(db)
+    else:
+        docs = get_changed_docs(db, since)
+    for doc in docs:
         # Only documents that explicitly belong to the application.
-        if doc.get(constants.DOCTYPE) is None: continue
+        if doc.get(constants.DOCTYPE) is None and not doc.get('_deleted'):
+            continue
         del doc['_rev']
-        info = tarfile.TarInfo(doc['_id'])
-        data = json.dumps(doc)
-        info.size = len(data)
-        outfile.addfile(info, io.BytesIO(data.encode('utf-8')))
+        attachments = []
+        for attname, attinfo in doc.get('_attachments', dict()).items():
+            data = base64.b64decode(attinfo.pop('data', ''))
+            attinfo['length'] = len(data)
+            attinfo['stub'] = True
+            attachments.append((attname, data))
+        count_bytes += add_item(outfile, doc['_id'], json.dumps(doc))
         count_items += 1
-        for attname in doc.get('_attachments', dict()):
-            info = tarfile.TarInfo("{0}_att/{1}".format(doc['_id'], attname))
-            attfile = db.get_attachment(doc, attname)
-            if attfile is None:
-                data = ''
-            else:
-                data = attfile.read()
-                attfile.close()
-            info.size = len(data)
-            outfile.addfile(info, io.BytesIO(data))
+        for attname, data in attachments:
+            count_bytes += add_item(outfile,
+                                    "{0}_att/{1}".format(doc['_id'], attname),
+                                    data)
             count_files += 1
     outfile.close()
+    elapsed = max(time.perf_counter() - start, 0.001)
     logging.info("dumped %s items and %s files to %s",
                  count_items, count_files, filepath)
+    logging.info("dump took %.1f s: %.0f items/s, %.0f bytes/s",
+                 elapsed, count_items / elapsed, count_bytes / elapsed)
+
+def add_item(outfile, name, data):
+    "Add an item to the tar file; return its size in bytes."
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    outfile.addfile(info, io.BytesIO(data))
+    return info.size
+
+def get_metadata(filepath):
+    """Get the metadata recorded in the dump file.
+    Raise KeyError if there is none; a dump made by an older version.
+    """
+    with tarfile.open(filepath, mode='r') as infile:
+        item = infile.next()
+        if item is None or item.name != constants.DUMP_METADATA:
+            raise KeyError("no metadata in dump file %s" % filepath)
+        return json.loads(infile.extractfile(item).read())
+
+def get_all_docs(db):
+    """Generator of all documents, including attachments, except
+    the design documents. The ranges of ids before and after
+    those of the design documents are read in batches.
+    """
+    for kwargs in [dict(endkey='_design/', inclusive_end=False),
+                   dict(startkey='_design0')]:
+        for rows in utils.get_rows_batches(db, '_all_docs',
+                                           include_docs=True,
+                                           attachments=True,
+                                           **kwargs):
+            for row in rows:
+                yield row.doc
+
+def get_changed_docs(db, since):
+    """Generator of the documents changed since the given update sequence,
+    including attachments, except the design documents. A deleted document
+    is a stub containing '_id', '_rev' and '_deleted'.
+    """
+    batch_size = settings['DATABASE_BATCH_SIZE']
+    while True:
+        result = db.changes(since=since, limit=batch_size,
+                            include_docs='true', attachments='true')
+        for change in result['results']:
+            if change['id'].startswith('_design/'): continue
+            doc = change.get('doc')
+            if change.get('deleted') or doc is None:
+                doc = {'_id': change['id'],
+                       '_rev': change['changes'][0]['rev'],
+                       '_deleted': True}
+            yield doc
+        if len(result['results']) < batch_size: break
+        since = result['last_seq']
 
 
 if __name__ == '__main__':
@@ -65,11 +139,26 @@ if __name__ == '__main__':
                         action='store', dest='dumpdir',
                         help='The directory to write the dump file'
                         ' (with standard name) in.')
+    parser.add_argument('-s', '--since', metavar='FILE',
+                        action='store', dest='since',
+                        help='Write a delta dump of the changes since'
+                        ' the given previous dump file.')
     args = parser.parse_args()
+    if args.since:
+        try:
+            since = get_metadata(args.since)['update_seq']
+        except (KeyError, IOError, tarfile.TarError) as error:
+            sys.exit(str(error))
+    else:
+        since = None
     if args.dumpfile:
         filepath = args.dumpfile
     else:
-        filepath = "dump_{0}.tar.gz".format(time.strftime("%Y-%m-%d"))
+        if since is None:
+            filepath = "dump_{0}.tar.gz".format(time.strftime("%Y-%m-%d"))
+        else:
+            filepath = "dump_{0}_delta.tar.gz".format(
+                time.strftime("%Y-%m-%dT%H%M%S"))
         if args.dumpdir:
             filepath = os.path.join(args.dumpdir, filepath)
-    dump(utils.get_db(), filepath)
+    dump(utils.get_db(), filepath, since=since)
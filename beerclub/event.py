@@ -1,10 +1,9 @@
 "Event: purchase, payment, etc."
 
-import csv
 import datetime
 import logging
-import tempfile
-from io import StringIO
+import time
+from io import BytesIO
 
 import openpyxl
 import tornado.web
@@ -12,7 +11,10 @@ import tornado.web
 from . import constants
 from . import settings
 from . import utils
-from .requesthandler import RequestHandler, ApiMixin
+from .requesthandler import (RequestHandler,
+                             ApiMixin,
+                             CsvMixin,
+                             CachedPageMixin)
 from .saver import Saver
 
 
@@ -98,9 +100,9 @@ class Event(RequestHandler):
     "View an event; purchase, payment, etc. Admin may delete it."
 
     @tornado.web.authenticated
-    def get(self, iuid):
+    async def get(self, iuid):
         try:
-            event = self.get_doc(iuid)
+            event = await self.get_doc(iuid)
         except KeyError:
             self.set_error_flash('No such event.')
             self.see_other('account', self.current_user['email'])
@@ -113,12 +115,12 @@ class Event(RequestHandler):
                 self.see_other('home')
 
     @tornado.web.authenticated
-    def post(self, iuid):
+    async def post(self, iuid):
         "Delete the event."
         self.check_admin()
-        event = self.get_doc(iuid)
+        event = await self.get_doc(iuid)
         if self.get_argument('_http_method', None) == 'DELETE':
-            self.db.delete(event)
+            await self.delete_doc(event)
         self.see_other('account', event['member'])
 
 
@@ -126,14 +128,14 @@ class Purchase(RequestHandler):
     "Buying one beverage."
 
     @tornado.web.authenticated
-    def get(self, email=None):
+    async def get(self, email=None):
         "This page for admin to record purchases on behalf of a member."
         self.check_admin()
         if email is None:
             member = self.current_user
         else:
             try:
-                member = self.get_member(email, check=True)
+                member = await self.get_member(email, check=True)
             except KeyError as error:
                 self.set_error_flash(str(error))
                 self.see_other('home')
@@ -141,18 +143,18 @@ class Purchase(RequestHandler):
         self.render('purchase.html', member=member)
 
     @tornado.web.authenticated
-    def post(self, email=None):
+    async def post(self, email=None):
         if email is None:
             member = self.current_user
         else:
             try:
-                member = self.get_member(email, check=True)
+                member = await self.get_member(email, check=True)
             except KeyError as error:
                 self.set_error_flash(str(error))
                 self.see_other('home')
                 return
         try:
-            with EventSaver(rqh=self) as saver:
+            async with EventSaver(rqh=self) as saver:
                 saver['member'] = member['email']
                 saver.set_purchase(purchase=self.get_argument('purchase',None),
                                    beverage=self.get_argument('beverage',None))
@@ -170,22 +172,22 @@ class Payment(RequestHandler):
     "Payment to increase the credit of a member, or correction."
 
     @tornado.web.authenticated
-    def get(self, email):
+    async def get(self, email):
         self.check_admin()
         try:
-            member = self.get_member(email, check=True)
+            member = await self.get_member(email, check=True)
         except KeyError as error:
             self.set_error_flash(str(error))
             self.see_other('home')
         else:
-            member['balance'] = self.get_balance(member)
+            member['balance'] = await self.get_balance(member)
             self.render('payment.html', member=member)
 
     @tornado.web.authenticated
-    def post(self, email):
+    async def post(self, email):
         self.check_admin()
         try:
-            member = self.get_member(email, check=True)
+            member = await self.get_member(email, check=True)
         except KeyError as error:
             self.set_error_flash(str(error))
             self.see_other('home')
@@ -199,24 +201,28 @@ class Payment(RequestHandler):
             if payment is None:
                 raise ValueError('no payment type specified')
             if payment == constants.CORRECTION:
-                with EventSaver(rqh=self) as saver:
+                async with EventSaver(rqh=self) as saver:
                     saver['member'] = member['email']
                     saver.set_transfer(amount=amount,
                                        description='manual correction')
             else:
-                with EventSaver(rqh=self) as saver:
+                date = self.get_argument('date', None)
+                async with EventSaver.bulk(rqh=self) as bulk:
+                    saver = bulk.new()
                     saver['member'] = member['email']
                     saver.set_payment(payment=payment,
                                       amount=amount,
-                                      date=self.get_argument('date', None))
-                lazy = self.get_argument('swish_lazy', False)
-                if lazy and lazy.lower() == 'true':
-                    with EventSaver(rqh=self) as saver:
-                        saver['action']      = constants.PURCHASE
-                        saver['member']      = member['email']
-                        saver['beverage']    = 'unknown beverage'
-                        saver['description'] = 'Swish lazy'
-                        saver['credit']      = - amount
+                                      date=date)
+                    lazy = self.get_argument('swish_lazy', False)
+                    if lazy and lazy.lower() == 'true':
+                        saver = bulk.new()
+                        saver['member'] = member['email']
+                        saver.set_purchase(purchase='credit',
+                                           amount=amount,
+                                           description='Swish lazy',
+                                           date=date)
+                if bulk.errors:
+                    raise ValueError('could not save the payment')
         except ValueError as error:
             self.set_error_flash(str(error))
         self.see_other('account', member['email'])
@@ -226,32 +232,22 @@ class Load(RequestHandler):
     "Load payments data file, e.g. Excel XLSX Swish records."
 
     @tornado.web.authenticated
-    def get(self):
+    async def get(self):
         self.check_admin()
-        self.render('load.html', missing=[])
+        self.render('load.html', missing=[], timings=[])
 
     @tornado.web.authenticated
-    def post(self):
+    async def post(self):
         self.check_admin()
         missing = []
+        timings = []
         try:
             infiles = self.request.files.get('xlsxfile')
             if not infiles:
                 raise ValueError('no XLSX file selected')
-            infile = infiles[0]
-            tmp = tempfile.NamedTemporaryFile(suffix='.xlsx')
-            tmp.write(infile['body'])
-            tmp.seek(0)
-            wb = openpyxl.load_workbook(tmp.name)
-            records = list(wb.active.values)
             header_cell = self.get_argument('header_cell')
             if not header_cell:
                 raise ValueError('no header cell value provided')
-            for header_pos, header in enumerate(records):
-                if header[0] == header_cell:
-                    break
-            else:
-                raise ValueError('could not find header in XLSX file')
             try:
                 swish_pos = int(self.get_argument('swish_pos')) - 1
                 if swish_pos < 0: raise ValueError
@@ -273,27 +269,25 @@ class Load(RequestHandler):
             except (TypeError, ValueError):
                 name_pos = None
 
-            payments = []
-            for record in records[header_pos+1:]:
-                if name_pos is None:
-                    name = None
+            # Read the rows one at a time from the read-only workbook.
+            start = time.perf_counter()
+            wb = openpyxl.load_workbook(BytesIO(infiles[0]['body']),
+                                        read_only=True, data_only=True)
+            try:
+                rows = wb.active.iter_rows(values_only=True)
+                for record in rows:
+                    if record and record[0] == header_cell: break
                 else:
-                    name = str(record[name_pos])
-                swish = str(record[swish_pos])
-                for prefix, replacement in settings['SWISH_NUMBER_PREFIXES'].items():
-                    if swish.startswith(prefix):
-                        swish = replacement + swish[len(prefix):]
-                        break
-                try:
-                    member = self.get_member(swish)
-                except KeyError:
-                    if name:
-                        missing.append(f"{swish} {name}")
+                    raise ValueError('could not find header in XLSX file')
+                records = []
+                today = datetime.date.today().isoformat()
+                for record in rows:
+                    if name_pos is None:
+                        name = None
                     else:
-                        missing.append(swish)
-                else:
+                        name = str(record[name_pos])
                     if date_pos is None:
-                        date = datetime.date.today().isoformat()
+                        date = today
                     else:
                         date = record[date_pos]
                         if isinstance(date, datetime.datetime):
@@ -302,45 +296,79 @@ class Load(RequestHandler):
                             date = date.isoformat()
                         else:
                             date = str(date)
+                    records.append(
+                        {'swish': utils.normalized_swish(str(record[swish_pos])),
+                         'name': name,
+                         'date': date,
+                         'amount': float(record[amount_pos])})
+            finally:
+                wb.close()
+            timings.append(('read', time.perf_counter() - start))
+
+            # Resolve all Swish numbers at once.
+            start = time.perf_counter()
+            members = await self.get_members(set([r['swish'] for r in records]))
+            payments = []
+            for record in records:
+                try:
+                    member = members[record['swish']]
+                except KeyError:
+                    if record['name']:
+                        missing.append(f"{record['swish']} {record['name']}")
+                    else:
+                        missing.append(record['swish'])
+                else:
                     payments.append({'member': member['email'],
                                      'lazy': settings['GLOBAL_SWISH_LAZY'] or
                                              member.get('swish_lazy'),
-                                     'date': date,
-                                     'amount': float(record[amount_pos])})
+                                     'date': record['date'],
+                                     'amount': record['amount']})
+            timings.append(('lookup', time.perf_counter() - start))
             if missing:
                 raise ValueError('Swish number(s) missing')
-            for payment in payments:
-                with EventSaver(rqh=self) as saver:
+
+            start = time.perf_counter()
+            async with EventSaver.bulk(rqh=self) as bulk:
+                for payment in payments:
+                    saver = bulk.new()
                     saver['member'] = payment['member']
                     saver.set_payment(payment='swish',
                                       amount=payment['amount'],
                                       date=payment['date'])
-                if payment['lazy']:
-                    with EventSaver(rqh=self) as saver:
+                    if payment['lazy']:
+                        saver = bulk.new()
                         saver['member'] = payment['member']
                         saver.set_purchase(purchase='credit',
                                            amount=payment['amount'],
                                            description='Swish lazy',
                                            date=payment['date'])
+            if bulk.errors:
+                raise ValueError("%i of %i events could not be saved" %
+                                 (len(bulk.errors), len(bulk.savers)))
+            timings.append(('save', time.perf_counter() - start))
         except (IndexError, TypeError, ValueError, IOError) as error:
             self.set_error_flash(str(error))
-            self.render('load.html', missing=missing)
+            self.render('load.html', missing=missing, timings=timings)
         else:
+            timings = ' '.join(["%s %.2f s" % t for t in timings])
+            logging.info("loaded %s payments: %s", len(payments), timings)
+            self.set_message_flash("Loaded %s payments: %s." %
+                                   (len(payments), timings))
             self.see_other('ledger')
 
 class Expenditure(RequestHandler):
     "Expenditure that reduces the credit of the BeerClub master virtual member."
 
     @tornado.web.authenticated
-    def get(self):
+    async def get(self):
         self.check_admin()
         self.render('expenditure.html')
 
     @tornado.web.authenticated
-    def post(self):
+    async def post(self):
         self.check_admin()
         try:
-            with EventSaver(rqh=self) as saver:
+            async with EventSaver(rqh=self) as saver:
                 saver['member'] = constants.BEERCLUB
                 saver.set_payment(
                     payment=constants.EXPENDITURE,
@@ -358,15 +386,15 @@ class Cash(RequestHandler):
     """
 
     @tornado.web.authenticated
-    def get(self):
+    async def get(self):
         self.check_admin()
         self.render('cash.html')
 
     @tornado.web.authenticated
-    def post(self):
+    async def post(self):
         self.check_admin()
         try:
-            with EventSaver(rqh=self) as saver:
+            async with EventSaver(rqh=self) as saver:
                 saver['member'] = constants.BEERCLUB
                 saver.set_payment(
                     payment=constants.CASH,
@@ -381,43 +409,43 @@ class Account(RequestHandler):
     "View events for a member account."
 
     @tornado.web.authenticated
-    def get(self, email):
+    async def get(self, email):
         try:
-            member = self.get_member(email, check=True)
+            member = await self.get_member(email, check=True)
         except KeyError:
             self.see_other('home')
             return 
-        member['balance'] = self.get_balance(member)
-        member['count'] = self.get_count(member)
-        try:
-            from_ = self.get_argument('from')
-        except tornado.web.MissingArgumentError:
-            from_ = utils.today(-settings['DISPLAY_ACCOUNT_DAYS'])
-        try:
-            to = self.get_argument('to')
-        except tornado.web.MissingArgumentError:
-            to = utils.today()
+        member['balance'] = await self.get_balance(member)
+        member['count'] = await self.get_count(member)
+        from_, to = self.get_from_to(settings['DISPLAY_ACCOUNT_DAYS'])
         if from_ > to:
-            events = []
+            events, next_url, previous_url = [], None, None
         else:
-            events = self.get_docs('event/member',
-                                   key=[member['email'], from_],
-                                   last=[member['email'], to+constants.CEILING])
+            events, next_url, previous_url = await self.get_docs_page(
+                'event/member',
+                [member['email'], from_],
+                [member['email'], to+constants.CEILING])
         self.render('account.html',
-                    member=member, events=events, from_=from_, to=to)
+                    member=member,
+                    events=events,
+                    from_=from_,
+                    to=to,
+                    next_url=next_url,
+                    previous_url=previous_url)
 
 
 class Activity(RequestHandler):
     "Members having made credit-affecting purchases recently."
 
     @tornado.web.authenticated
-    def get(self):
+    async def get(self):
         self.check_admin()
         activity = dict()
         from_ = utils.today(-settings['DISPLAY_ACTIVITY_DAYS'])
         to = utils.today()
-        view = self.db.view('event/activity')
-        for row in view[from_ : to+constants.CEILING]:
+        for row in await self.get_rows('event/activity',
+                                       key=from_,
+                                       last=to+constants.CEILING):
             try:
                 activity[row.value] = max(activity[row.value], row.key)
             except KeyError:
@@ -426,7 +454,7 @@ class Activity(RequestHandler):
         activity = list(activity.items())
         activity.sort(key=lambda i: i[1])
         # This is more efficient than calling for each member.
-        all_members = self.get_docs('member/email')
+        all_members = await self.get_docs('member/email')
         lookup = {}
         for member in all_members:
             lookup[member['email']] = member
@@ -435,56 +463,53 @@ class Activity(RequestHandler):
             member = lookup[email]
             member['activity'] = timestamp
             members.append(member)
-        utils.get_balances(self.db, members)
+        await self.get_balances(members)
         self.render('activity.html', members=members)
 
 
-class Ledger(RequestHandler):
+class Ledger(CachedPageMixin, RequestHandler):
     "Ledger page for listing recent events."
 
     @tornado.web.authenticated
-    def get(self):
+    async def get(self):
         "Display recent events."
-        try:
-            from_ = self.get_argument('from')
-        except tornado.web.MissingArgumentError:
-            from_ = utils.today(-settings['DISPLAY_LEDGER_DAYS'])
-        try:
-            to = self.get_argument('to')
-        except tornado.web.MissingArgumentError:
-            to = utils.today()
+        from_, to = self.get_from_to(settings['DISPLAY_LEDGER_DAYS'])
         if from_ > to:
-            events = []
+            events, next_url, previous_url = [], None, None
         else:
-            events = self.get_docs('event/ledger',
-                                   key=from_,
-                                   last=to+constants.CEILING)
+            events, next_url, previous_url = await self.get_docs_page(
+                'event/ledger', from_, to+constants.CEILING)
         self.render('ledger.html',
-                    beerclub_balance=self.get_beerclub_balance(),
-                    members_balance=self.get_balance(),
+                    beerclub_balance=await self.get_beerclub_balance(),
+                    members_balance=await self.get_balance(),
                     events=events,
                     from_=from_,
-                    to=to)
+                    to=to,
+                    next_url=next_url,
+                    previous_url=previous_url)
 
 
-class LedgerCsv(Ledger):
+class LedgerCsv(CachedPageMixin, CsvMixin, RequestHandler):
     "CSV output of ledger data."
 
-    def render(self, template, events, from_, to, **kwargs):
-        csvbuffer = StringIO()
-        writer = csv.writer(csvbuffer)
-        row = ['Action',
-               'Id',
-               'Member',
-               'Beverage',
-               'Description',
-               'Credit',
-               'Date',
-               'Actor',
-               'Timestamp']
-        writer.writerow(row)
-        for event in events:
-            writer.writerow([event['action'],
+    @tornado.web.authenticated
+    async def get(self):
+        from_, to = self.get_from_to(settings['DISPLAY_LEDGER_DAYS'])
+        self.start_csv('ledger.csv',
+                       ['Action',
+                        'Id',
+                        'Member',
+                        'Beverage',
+                        'Description',
+                        'Credit',
+                        'Date',
+                        'Actor',
+                        'Timestamp'])
+        if from_ > to: return
+        async for events in self.get_docs_batches('event/ledger',
+                                                  key=from_,
+                                                  last=to+constants.CEILING):
+            self.write_csv([[event['action'],
                              event['_id'],
                              event['member'],
                              event.get('beverage') or '',
@@ -492,71 +517,67 @@ class LedgerCsv(Ledger):
                              event['credit'],
                              event.get('date') or '',
                              event['log'].get('member') or '',
-                             event['log']['timestamp']])
-        self.write(csvbuffer.getvalue())
-        self.set_header('Content-Type', constants.CSV_MIME)
-        self.set_header('Content-Disposition', 
-                        'attachment; filename="ledger.csv')
+                             event['log']['timestamp']]
+                            for event in events])
+            await self.flush()
 
 
-class Payments(RequestHandler):
+class Payments(CachedPageMixin, RequestHandler):
     "Page for listing recent payment events, and the Beer Club balance."
 
     @tornado.web.authenticated
-    def get(self):
+    async def get(self):
         "Display recent payment events."
-        try:
-            from_ = self.get_argument('from')
-        except tornado.web.MissingArgumentError:
-            from_ = utils.today(-settings['DISPLAY_PAYMENT_DAYS'])
-        try:
-            to = self.get_argument('to')
-        except tornado.web.MissingArgumentError:
-            to = utils.today()
+        from_, to = self.get_from_to(settings['DISPLAY_PAYMENT_DAYS'])
         if from_ > to:
-            events = []
+            events, next_url, previous_url = [], None, None
         else:
-            events = self.get_docs('event/payment',
-                                   key=from_,
-                                   last=to+constants.CEILING)
-        self.render('payments.html', events=events, from_=from_, to=to)
+            events, next_url, previous_url = await self.get_docs_page(
+                'event/payment', from_, to+constants.CEILING)
+        self.render('payments.html',
+                    events=events,
+                    from_=from_,
+                    to=to,
+                    next_url=next_url,
+                    previous_url=previous_url)
 
 
-class PaymentsCsv(Payments):
+class PaymentsCsv(CachedPageMixin, CsvMixin, RequestHandler):
     "CSV output of payment data."
 
-    def render(self, template, events, from_, to, **kwargs):
-        csvbuffer = StringIO()
-        writer = csv.writer(csvbuffer)
-        row = ['Id',
-               'Member',
-               'Description',
-               'Credit',
-               'Date',
-               'Actor',
-               'Timestamp']
-        writer.writerow(row)
-        for event in events:
-            writer.writerow([event['_id'],
+    @tornado.web.authenticated
+    async def get(self):
+        from_, to = self.get_from_to(settings['DISPLAY_PAYMENT_DAYS'])
+        self.start_csv('payments.csv',
+                       ['Id',
+                        'Member',
+                        'Description',
+                        'Credit',
+                        'Date',
+                        'Actor',
+                        'Timestamp'])
+        if from_ > to: return
+        async for events in self.get_docs_batches('event/payment',
+                                                  key=from_,
+                                                  last=to+constants.CEILING):
+            self.write_csv([[event['_id'],
                              event['member'],
                              event.get('description') or '',
                              event['credit'],
                              event.get('date') or '',
                              event['log'].get('member') or '',
-                             event['log']['timestamp']])
-        self.write(csvbuffer.getvalue())
-        self.set_header('Content-Type', constants.CSV_MIME)
-        self.set_header('Content-Disposition', 
-                        'attachment; filename="payments.csv')
+                             event['log']['timestamp']]
+                            for event in events])
+            await self.flush()
 
 
 class EventApiV1(ApiMixin, RequestHandler):
     "Return event data."
 
     @tornado.web.authenticated
-    def get(self, iuid):
+    async def get(self, iuid):
         self.check_admin()
-        event = self.get_doc(iuid)
+        event = await self.get_doc(iuid)
         if event.get(constants.DOCTYPE) != constants.EVENT:
             raise tornado.web.HTTPError(404, reason='no such event')
         data = dict(iuid=event['_id'])
@@ -570,14 +591,14 @@ class MemberEventApiV1(ApiMixin, RequestHandler):
     "Add an event for the member."
 
     @tornado.web.authenticated
-    def post(self, email):
+    async def post(self, email):
         self.check_admin()
         try:
-            member = self.get_member(email)
+            member = await self.get_member(email)
         except KeyError:
             raise tornado.web.HTTPError(404, reason='no such member')
         try:
-            with EventSaver(rqh=self) as saver:
+            async with EventSaver(rqh=self) as saver:
                 saver['member'] = member['email']
                 saver.set(self.get_json_body())
         except ValueError as error:
@@ -0,0 +1,433 @@
+"""Generate a synthetic dataset, for capacity testing, in the dump format.
+
+The Beer Club is simulated day by day. Members join over the period,
+and some leave. Pub nights are held on some weekdays, at which a varying
+number of purchases are made, more by some members than others. Members
+pay when their debt exceeds a threshold of their own, each mostly using
+one payment method; some use the 'Swish lazy' way of paying for each
+purchase right away. Every week, the Beer Club buys beer for what was
+sold, and the cash is deposited. A snapshot is made for each day.
+
+The result is the same for the same seed and last date. It is written to
+a dump file in the format of 'dump.py', which 'undump.py' can load, as
+can the option '--load' of this script.
+"""
+
+import argparse
+import datetime
+import json
+import math
+import random
+import tarfile
+import time
+
+from beerclub import constants
+from beerclub import dump
+from beerclub import settings
+from beerclub import undump
+from beerclub import utils
+
+ADMIN_EMAIL = 'admin@example.com'
+FIRST_NAMES = ['Anna', 'Erik', 'Maria', 'Lars', 'Karin', 'Per', 'Eva',
+               'Johan', 'Sara', 'Anders', 'Lena', 'Nils', 'Emma', 'Olof']
+LAST_NAMES = ['Andersson', 'Johansson', 'Karlsson', 'Nilsson', 'Eriksson',
+              'Larsson', 'Olsson', 'Persson', 'Svensson', 'Gustafsson']
+
+# The weekdays in the order in which they become pub nights; Thursday first.
+WEEKDAYS = (3, 4, 2, 1, 0, 5, 6)
+
+# Payment methods, and the relative number of members mostly using each.
+# A 'transfer' is a bank account transfer event, not a payment event.
+METHODS = (('swish', 60), ('cash', 15), ('bank', 10),
+           (constants.TRANSFER, 15))
+
+INITIAL = 0.2                   # Fraction of members there from the start.
+PENDING = 0.02                  # Fraction of members never enabled.
+LEAVING = 0.15                  # Fraction of members who leave.
+LAZY = 0.2                      # Fraction of Swish users who are lazy.
+CREDIT = 0.85                   # Fraction of purchases put on credit.
+COST = 0.75                     # Beer Club cost as fraction of the price.
+
+
+class Generator(object):
+    "Simulation of the Beer Club, producing the documents."
+
+    def __init__(self, members=1000, days=365, nights=2, purchases=40,
+                 threshold=300.0, pay_probability=0.3, randomseed=0,
+                 until=None, admin_password=None):
+        self.rnd = random.Random(randomseed)
+        self.members = members
+        self.nights = set(WEEKDAYS[:nights])
+        self.purchases = purchases
+        self.threshold = threshold
+        self.pay_probability = pay_probability
+        self.admin_password = admin_password
+        until = datetime.date.fromisoformat(until or utils.today())
+        self.dates = [until - datetime.timedelta(days=n)
+                      for n in range(days-1, -1, -1)]
+        self.beverage = settings['BEVERAGE'][0]
+        self.counts = dict([(s, 0) for s in constants.STATUSES])
+        self.beerclub_balance = 0.0
+        self.members_balance = 0.0
+        self.sold = 0                   # Beverages sold since the last buy.
+        self.cash = 0.0                 # Cash received since the last deposit.
+
+    def __iter__(self):
+        "Generate the documents: events and snapshots, and then the members."
+        self.create_members()
+        for pos, date in enumerate(self.dates):
+            yield from self.get_day(date)
+            # No snapshot for the last date, since it is not yet over.
+            if pos < len(self.dates) - 1:
+                yield self.get_snapshot(date)
+        yield from self.get_members()
+
+    def get_iuid(self):
+        "Return a unique identifier that is given by the random seed."
+        return "%032x" % self.rnd.getrandbits(128)
+
+    def get_timestamp(self, date, first_hour=0, last_hour=23):
+        "Return a random timestamp during the hours of the date."
+        return "%sT%02i:%02i:%06.3fZ" % (date,
+                                        self.rnd.randint(first_hour, last_hour),
+                                        self.rnd.randrange(60),
+                                        self.rnd.random() * 60)
+
+    def create_members(self):
+        "Create the members, with the dates of joining and leaving."
+        rnd = self.rnd
+        methods = [m[0] for m in METHODS]
+        weights = [m[1] for m in METHODS]
+        self.all_members = [dict(email=ADMIN_EMAIL,
+                                 first_name='Admin',
+                                 last_name='Generated',
+                                 role=constants.ADMIN,
+                                 joined=0,
+                                 left=None,
+                                 pending=False,
+                                 method='swish',
+                                 lazy=False,
+                                 thirst=1.0,
+                                 threshold=self.threshold,
+                                 balance=0.0,
+                                 debtor=False,
+                                 login=None)]
+        for number in range(self.members):
+            first_name = rnd.choice(FIRST_NAMES)
+            last_name = rnd.choice(LAST_NAMES)
+            if rnd.random() < INITIAL:
+                joined = 0
+            else:
+                joined = rnd.randrange(len(self.dates))
+            if rnd.random() < LEAVING and joined < len(self.dates) - 1:
+                left = rnd.randrange(joined + 1, len(self.dates))
+            else:
+                left = None
+            method = rnd.choices(methods, weights=weights)[0]
+            self.all_members.append(dict(
+                email="%s.%s%i@example.com" % (first_name.lower(),
+                                               last_name.lower(), number),
+                first_name=first_name,
+                last_name=last_name,
+                role=constants.MEMBER,
+                joined=joined,
+                left=left,
+                pending=rnd.random() < PENDING,
+                method=method,
+                lazy=method == 'swish' and rnd.random() < LAZY,
+                thirst=rnd.expovariate(1.0),
+                threshold=self.threshold * rnd.uniform(0.5, 1.5),
+                balance=0.0,
+                debtor=False,
+                login=None))
+        self.joining = {}
+        self.leaving = {}
+        for member in self.all_members:
+            self.joining.setdefault(member['joined'], []).append(member)
+            if member['left'] is not None:
+                self.leaving.setdefault(member['left'], []).append(member)
+        self.active = []
+        self.debtors = []
+
+    def get_day(self, date):
+        "Generate the events of the day, and update the member counts."
+        day = (date - self.dates[0]).days
+        changed = False
+        for member in self.joining.get(day, []):
+            if member['pending']:
+                self.counts[constants.PENDING] += 1
+            else:
+                self.counts[constants.ENABLED] += 1
+                self.active.append(member)
+                changed = True
+        for member in self.leaving.get(day, []):
+            if member['pending']:
+                self.counts[constants.PENDING] -= 1
+            else:
+                self.counts[constants.ENABLED] -= 1
+                self.active.remove(member)
+                changed = True
+                # Settle any debt when leaving.
+                if member['balance'] < 0.0:
+                    yield self.get_payment(member, date, -member['balance'])
+            self.counts[constants.DISABLED] += 1
+        if changed:
+            self.cum_weights = []
+            total = 0.0
+            for member in self.active:
+                total += member['thirst']
+                self.cum_weights.append(total)
+        if date.weekday() in self.nights and self.active:
+            count = max(0, round(self.rnd.gauss(self.purchases,
+                                                self.purchases / 4.0)))
+            buyers = self.rnd.choices(self.active,
+                                      cum_weights=self.cum_weights, k=count)
+            for member in buyers:
+                yield from self.get_purchase(member, date)
+        debtors = self.debtors
+        self.debtors = []
+        for member in debtors:
+            member['debtor'] = False
+            if member['balance'] >= 0.0: continue
+            if member['left'] is not None and member['left'] <= day: continue
+            if self.rnd.random() < self.pay_probability:
+                amount = 100.0 * math.ceil(-member['balance'] / 100.0)
+                yield self.get_payment(member, date, amount)
+            else:
+                member['debtor'] = True
+                self.debtors.append(member)
+        # Monday: buy beer for what was sold, and deposit the cash.
+        if date.weekday() == 0:
+            if self.sold:
+                yield self.get_beerclub_payment(
+                    date,
+                    "%s: beer" % constants.EXPENDITURE,
+                    - COST * self.sold * self.beverage['price'])
+                self.sold = 0
+            if self.cash:
+                yield self.get_beerclub_payment(date, 'cash transfer',
+                                                self.cash)
+                self.cash = 0.0
+
+    def get_event(self, member, date, timestamp, action, credit, **kwargs):
+        "Return an event document, and update the balances."
+        doc = dict(_id=self.get_iuid(),
+                   beerclub_doctype=constants.EVENT,
+                   member=member['email'],
+                   action=action,
+                   credit=credit,
+                   date=date.isoformat(),
+                   log=dict(timestamp=timestamp,
+                            date=date.isoformat(),
+                            member=kwargs.pop('by', member['email'])))
+        doc.update(kwargs)
+        member['balance'] += credit
+        self.members_balance += credit
+        if action == constants.PAYMENT:
+            self.beerclub_balance += credit
+        return doc
+
+    def get_purchase(self, member, date):
+        "Generate the event(s) for a purchase by the member at the pub night."
+        price = float(self.beverage['price'])
+        timestamp = self.get_timestamp(date, 17, 23)
+        member['login'] = timestamp
+        self.sold += 1
+        if member['lazy']:
+            # Swish lazy: a payment followed by a purchase with its amount.
+            yield self.get_event(member, date, timestamp,
+                                 constants.PAYMENT, price,
+                                 description='swish')
+            yield self.get_event(member, date, timestamp,
+                                 constants.PURCHASE, - price,
+                                 beverage='unknown beverage',
+                                 description='Swish lazy')
+        elif self.rnd.random() < CREDIT:
+            yield self.get_event(member, date, timestamp,
+                                 constants.PURCHASE, - price,
+                                 beverage=self.beverage['identifier'],
+                                 description='credit')
+            if member['balance'] < - member['threshold'] and \
+               not member['debtor']:
+                member['debtor'] = True
+                self.debtors.append(member)
+        else:
+            self.cash += price
+            yield self.get_event(member, date, timestamp,
+                                 constants.PURCHASE, 0.0,
+                                 beverage=self.beverage['identifier'],
+                                 description='cash')
+
+    def get_payment(self, member, date, amount):
+        "Return the event for a payment by the member, entered by the admin."
+        timestamp = self.get_timestamp(date, 8, 16)
+        if member['method'] == constants.TRANSFER:
+            return self.get_event(member, date, timestamp,
+                                  constants.TRANSFER, amount,
+                                  description='bank account transfer',
+                                  by=ADMIN_EMAIL)
+        if member['method'] == 'cash':
+            self.cash += amount
+        return self.get_event(member, date, timestamp,
+                              constants.PAYMENT, amount,
+                              description=member['method'],
+                              by=ADMIN_EMAIL)
+
+    def get_beerclub_payment(self, date, description, credit):
+        "Return a payment event for the Beer Club itself."
+        timestamp = self.get_timestamp(date, 8, 16)
+        doc = dict(_id=self.get_iuid(),
+                   beerclub_doctype=constants.EVENT,
+                   member=constants.BEERCLUB,
+                   action=constants.PAYMENT,
+                   description=description,
+                   credit=credit,
+                   date=date.isoformat(),
+                   log=dict(timestamp=timestamp,
+                            date=date.isoformat(),
+                            member=ADMIN_EMAIL))
+        self.beerclub_balance += credit
+        return doc
+
+    def get_snapshot(self, date):
+        "Return the snapshot document for the end of the date."
+        timestamp = self.get_timestamp(date + datetime.timedelta(days=1), 0, 0)
+        return {'_id': "snapshot_%s" % date,
+                constants.DOCTYPE: constants.SNAPSHOT,
+                'date': date.isoformat(),
+                'beerclub_balance': self.beerclub_balance,
+                'members_balance': self.members_balance,
+                'member_counts': self.counts.copy(),
+                'log': dict(timestamp=timestamp, date=timestamp[:10])}
+
+    def get_members(self):
+        "Generate the member documents, with their final status."
+        for number, member in enumerate(self.all_members):
+            if member['left'] is not None:
+                status = constants.DISABLED
+            elif member['pending']:
+                status = constants.PENDING
+            else:
+                status = constants.ENABLED
+            if member['lazy'] or member['method'] == 'swish':
+                swish = "07%08i" % number
+            else:
+                swish = None
+            if member['role'] == constants.ADMIN and self.admin_password:
+                # The salt is drawn from the seeded generator, so that
+                # the output is deterministic also for the password.
+                password = utils.hashed_password(self.admin_password,
+                                                 salt=self.get_iuid())
+            else:
+                password = None
+            timestamp = self.get_timestamp(self.dates[member['joined']])
+            yield dict(_id=self.get_iuid(),
+                       beerclub_doctype=constants.MEMBER,
+                       email=member['email'],
+                       first_name=member['first_name'],
+                       last_name=member['last_name'],
+                       role=member['role'],
+                       status=status,
+                       password=password,
+                       login=member['login'],
+                       swish=swish,
+                       swish_lazy=member['lazy'],
+                       address=None,
+                       log=dict(timestamp=timestamp, date=timestamp[:10]))
+
+
+def write(filepath, docs, parameters=None):
+    """Write the documents to a dump file, with the parameters used
+    to generate them in the metadata. Return the number of documents.
+    """
+    if filepath.endswith('.gz'):
+        mode = 'w:gz'
+    else:
+        mode = 'w'
+    metadata = dict(update_seq=None,
+                    since=None,
+                    timestamp=utils.timestamp(),
+                    generated=parameters)
+    count = 0
+    with tarfile.open(filepath, mode=mode) as outfile:
+        dump.add_item(outfile, constants.DUMP_METADATA, json.dumps(metadata))
+        for doc in docs:
+            dump.add_item(outfile, doc['_id'], json.dumps(doc))
+            count += 1
+    return count
+
+def load(db, docs, batch_size=None):
+    """Save the documents directly to the database, in batches.
+    Return the number of documents.
+    """
+    if batch_size is None:
+        batch_size = settings['DATABASE_BATCH_SIZE']
+    count = 0
+    batch = []
+    for doc in docs:
+        batch.append(doc)
+        if len(batch) >= batch_size:
+            db.update(batch)
+            count += len(batch)
+            batch = []
+    if batch:
+        db.update(batch)
+        count += len(batch)
+    return count
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Generate a synthetic dataset as a dump file.')
+    parser.add_argument('-o', '--output', metavar='FILE', type=str,
+                        default='synthetic.tar.gz',
+                        help='The dump file to write; default %(default)s')
+    parser.add_argument('-m', '--members', type=int, default=1000,
+                        help='Number of members; default %(default)s')
+    parser.add_argument('-y', '--years', type=float, default=5.0,
+                        help='Number of years of events; default %(default)s')
+    parser.add_argument('-n', '--nights', type=int, default=2,
+                        choices=range(1, 8),
+                        help='Number of pub nights per week;'
+                        ' default %(default)s')
+    parser.add_argument('-p', '--purchases', type=int, default=40,
+                        help='Mean number of purchases per pub night;'
+                        ' default %(default)s')
+    parser.add_argument('-t', '--threshold', type=float, default=300.0,
+                        help='Mean debt at which members pay;'
+                        ' default %(default)s')
+    parser.add_argument('--pay-probability', type=float, default=0.3,
+                        help='Probability that a member in debt beyond'
+                        ' the threshold pays on a given day;'
+                        ' default %(default)s')
+    parser.add_argument('-s', '--seed', type=int, default=0,
+                        help='Seed for the random numbers; default %(default)s')
+    parser.add_argument('-u', '--until', metavar='DATE', type=str,
+                        help='The last date of events; default today.')
+    parser.add_argument('-a', '--admin-password', metavar='PASSWORD', type=str,
+                        help="Password for the admin %s; default none." %
+                        ADMIN_EMAIL)
+    parser.add_argument('-L', '--load', action='store_true', default=False,
+                        help='Also load the dump file into the database,'
+                        ' which should be empty.')
+    args = parser.parse_args()
+    utils.setup()
+    if args.load:
+        utils.initialize()
+    parameters = dict(members=args.members,
+                      days=round(365.25 * args.years),
+                      nights=args.nights,
+                      purchases=args.purchases,
+                      threshold=args.threshold,
+                      pay_probability=args.pay_probability,
+                      randomseed=args.seed,
+                      until=args.until)
+    start = time.perf_counter()
+    count = write(args.output,
+                  Generator(admin_password=args.admin_password, **parameters),
+                  parameters=parameters)
+    print("wrote %i documents to %s in %.1f s" %
+          (count, args.output, time.perf_counter() - start))
+    if args.load:
+        undump.undump(utils.get_db(), args.output,
+                      checkpoint=args.output + '.checkpoint')
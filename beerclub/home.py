@@ -1,46 +1,46 @@
 "Home page, and misc others."
 
-import csv
-from io import StringIO
 import logging
 
 import tornado.web
 
+from beerclub import cache
+from beerclub import changes
 from beerclub import constants
+from beerclub import designs
+from beerclub import metrics
+from beerclub import outbox
 from beerclub import settings
 from beerclub import utils
-from beerclub.requesthandler import RequestHandler
+from beerclub.requesthandler import (RequestHandler,
+                                     CsvMixin,
+                                     CachedPageMixin)
 
 
 class Home(RequestHandler):
     "Home page; login or payment and member info."
 
-    def get(self):
+    async def get(self):
         if self.current_user:
-            self.current_user['balance'] = self.get_balance(self.current_user)
-            self.current_user['count'] = self.get_count(self.current_user)
+            self.current_user['balance'] = \
+                await self.get_balance(self.current_user)
+            self.current_user['count'] = \
+                await self.get_count(self.current_user)
             self.render('home_member.html')
         else:
             self.render('home_login.html')
 
 
-class Snapshots(RequestHandler):
+class Snapshots(CachedPageMixin, RequestHandler):
     "Display snapshots table."
 
     @tornado.web.authenticated
-    def get(self):
+    async def get(self):
         self.check_admin()
-        try:
-            from_ = self.get_argument('from')
-        except tornado.web.MissingArgumentError:
-            from_ = utils.today(-settings['DISPLAY_SNAPSHOT_DAYS'])
-        try:
-            to = self.get_argument('to')
-        except tornado.web.MissingArgumentError:
-            to = utils.today()
+        from_, to = self.get_from_to(settings['DISPLAY_SNAPSHOT_DAYS'])
         if from_ > to:
             to = from_
-        snapshots = self.get_docs('snapshot/date',
+        snapshots = await self.get_docs('snapshot/date',
                                   key=from_,
                                   last=to+constants.CEILING)
         self.render('snapshots.html',
@@ -49,75 +49,153 @@ class Snapshots(RequestHandler):
                     to=to)
 
 
-class SnapshotsCsv(Snapshots):
+class SnapshotsCsv(CachedPageMixin, CsvMixin, RequestHandler):
     "Output CSV for snapshots data."
 
-    def render(self, template, snapshots, from_, to):
-        csvbuffer = StringIO()
-        writer = csv.writer(csvbuffer)
+    @tornado.web.authenticated
+    async def get(self):
+        self.check_admin()
+        from_, to = self.get_from_to(settings['DISPLAY_SNAPSHOT_DAYS'])
+        if from_ > to:
+            to = from_
         row = ['Date',
                'BeerClub',
                'members',
                'surplus']
         row.extend(constants.STATUSES)
-        writer.writerow(row)
-        for snapshot in snapshots:
-            row = [snapshot['date'],
-                   snapshot['beerclub_balance'],
-                   snapshot['members_balance'],
-                   snapshot['beerclub_balance'] - snapshot['members_balance']]
-            for status in constants.STATUSES:
-                row.append(snapshot['member_counts'][status])
-            writer.writerow(row)
-        self.write(csvbuffer.getvalue())
-        self.set_header('Content-Type', constants.CSV_MIME)
-        filename = "snapshots_%s_%s.csv" % (from_, to)
-        self.set_header('Content-Disposition', 
-                        'attachment; filename="%s"' % filename)
-
-
-class Dashboard(RequestHandler):
+        self.start_csv("snapshots_%s_%s.csv" % (from_, to), row)
+        async for snapshots in self.get_docs_batches(
+                'snapshot/date', key=from_, last=to+constants.CEILING):
+            rows = []
+            for snapshot in snapshots:
+                row = [snapshot['date'],
+                       snapshot['beerclub_balance'],
+                       snapshot['members_balance'],
+                       snapshot['beerclub_balance'] -
+                       snapshot['members_balance']]
+                for status in constants.STATUSES:
+                    row.append(snapshot['member_counts'][status])
+                rows.append(row)
+            self.write_csv(rows)
+            await self.flush()
+
+
+class Dashboard(CachedPageMixin, RequestHandler):
     "Dashboard display of various interesting data."
 
     @tornado.web.authenticated
-    def get(self):
+    async def get(self):
         self.check_admin()
-        try:
-            from_ = self.get_argument('from')
-        except tornado.web.MissingArgumentError:
-            from_ = utils.today(-settings['DISPLAY_SNAPSHOT_DAYS'])
-        try:
-            to = self.get_argument('to')
-        except tornado.web.MissingArgumentError:
-            to = utils.today()
+        from_, to = self.get_from_to(settings['DISPLAY_SNAPSHOT_DAYS'])
         if from_ > to:
             to = from_
         self.render('dashboard.html',
-                    beerclub_balance=self.get_beerclub_balance(),
-                    members_balance=self.get_balance(),
+                    beerclub_balance=await self.get_beerclub_balance(),
+                    members_balance=await self.get_balance(),
                     from_=from_,
                     to=to)
 
 
-class BalanceCsv(Snapshots):
+class DashboardJson(CachedPageMixin, RequestHandler):
+    """JSON time series of the balances and member counts for the dashboard.
+    A long interval is downsampled to at most 'points' dates, taking
+    the last snapshot of each period, since the values are states.
+    """
+
+    @tornado.web.authenticated
+    async def get(self):
+        self.check_admin()
+        from_, to = self.get_from_to(settings['DISPLAY_SNAPSHOT_DAYS'])
+        if from_ > to:
+            to = from_
+        try:
+            points = int(self.get_argument('points'))
+            if points < 2: raise ValueError
+        except (tornado.web.MissingArgumentError, ValueError):
+            points = settings['DISPLAY_DASHBOARD_POINTS']
+        rows = await self.get_rows('snapshot/series',
+                                   key=from_,
+                                   last=to+constants.CEILING)
+        step = max(1, -(-len(rows) // points)) # Ceiling of the division.
+        # Include the last row in the interval.
+        rows = rows[len(rows)-1::-step][::-1]
+        result = dict(step=step,
+                      date=[r.key for r in rows],
+                      beerclub=[r.value[0] for r in rows],
+                      members=[r.value[1] for r in rows],
+                      surplus=[r.value[0] - r.value[1] for r in rows])
+        for pos, status in enumerate(constants.STATUSES):
+            result[status] = [r.value[2+pos] for r in rows]
+        self.write(result)
+
+
+class BalanceCsv(CachedPageMixin, CsvMixin, RequestHandler):
     "Output CSV for snapshots balance data."
 
-    def render(self, template, snapshots, from_, to):
-        csvbuffer = StringIO()
-        writer = csv.writer(csvbuffer)
+    @tornado.web.authenticated
+    async def get(self):
+        self.check_admin()
+        from_, to = self.get_from_to(settings['DISPLAY_SNAPSHOT_DAYS'])
+        if from_ > to:
+            to = from_
         row = ['date',
                'amount',
                'type']
         row.extend(constants.STATUSES)
-        writer.writerow(row)
-        for snapshot in snapshots:
-            row = [snapshot['date'], snapshot['beerclub_balance'], 'beerclub']
-            writer.writerow(row)
-            row[1] = snapshot['members_balance']
-            row[2] = 'members'
-            writer.writerow(row)
-            row[1] = snapshot['beerclub_balance'] - snapshot['members_balance']
-            row[2] = 'surplus'
-            writer.writerow(row)
-        self.write(csvbuffer.getvalue())
-        self.set_header('Content-Type', constants.CSV_MIME)
+        self.start_csv(None, row)
+        async for snapshots in self.get_docs_batches(
+                'snapshot/date', key=from_, last=to+constants.CEILING):
+            rows = []
+            for snapshot in snapshots:
+                date = snapshot['date']
+                beerclub = snapshot['beerclub_balance']
+                members = snapshot['members_balance']
+                rows.append([date, beerclub, 'beerclub'])
+                rows.append([date, members, 'members'])
+                rows.append([date, beerclub - members, 'surplus'])
+            self.write_csv(rows)
+            await self.flush()
+
+
+class Status(RequestHandler):
+    """Display the state of the view indexes, caches, changes feed
+    and email queue.
+    """
+
+    @tornado.web.authenticated
+    async def get(self):
+        self.check_admin()
+        self.render('status.html',
+                    designs=designs.status,
+                    members_loaded=cache.members.loaded,
+                    balances_loaded=cache.balances.loaded,
+                    staleness=changes.staleness(),
+                    outbox=outbox.get_metrics())
+
+
+class Metrics(RequestHandler):
+    """Request and CouchDB call latency histograms, and the counters of
+    the caches, changes feed and email queue, in Prometheus text format.
+    A scraper may authenticate using the API key of an admin.
+    """
+
+    async def get(self):
+        self.check_admin()
+        values = []
+        for name, counters in [('member_cache', cache.members.get_metrics()),
+                               ('balance_cache', cache.balances.get_metrics()),
+                               ('page_cache', cache.pages.get_metrics()),
+                               ('session_cache', cache.sessions.get_metrics()),
+                               ('credential_cache',
+                                cache.credentials.get_metrics()),
+                               ('email_queue', outbox.get_metrics())]:
+            for key, value in sorted(counters.items()):
+                values.append(("beerclub_%s_%s" % (name, key), value))
+        values.append(('beerclub_changes_total', changes.status['changes']))
+        values.append(('beerclub_changes_errors', changes.status['errors']))
+        values.append(('beerclub_changes_staleness_seconds',
+                       changes.staleness()))
+        values.append(('beerclub_view_indexes_ready',
+                       designs.status['ready']))
+        self.set_header('Content-Type', metrics.CONTENT_TYPE)
+        self.write(metrics.render(values))
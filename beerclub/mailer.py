@@ -0,0 +1,262 @@
+"""Send an email message to many members, e.g. a reminder of their debt.
+
+The recipients are selected directly from the database: the enabled
+members, optionally only those with a balance below a given amount.
+All messages are rendered first, and then sent over a small pool of
+connections to the email server, at a rate limited by a token bucket.
+
+Without the execute option, only a report of what would be sent is output.
+A checkpoint file records the members sent to, so that an interrupted
+mailing can be resumed without sending anyone the message twice.
+"""
+
+import argparse
+import concurrent.futures
+import json
+import os
+import smtplib
+import sys
+import threading
+import time
+
+from beerclub import constants
+from beerclub import settings
+from beerclub import utils
+
+
+class TokenBucket(object):
+    """Rate limiter shared by the sending threads. Tokens are added at
+    the given rate per second, up to the burst size, and each message
+    takes one token.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.refilled = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self):
+        "Take a token; wait until one is available."
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst,
+                                  self.tokens + (now-self.refilled)*self.rate)
+                self.refilled = now
+                if self.tokens >= 1.0:
+                    self.tokens -= 1.0
+                    return
+                wait = (1.0 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class Mailer(object):
+    """Send the messages over a pool of connections to the email server,
+    one per thread, at the rate allowed by the token bucket.
+    """
+
+    def __init__(self, connections=None, rate=None, burst=None):
+        if connections is None:
+            connections = settings['MAILER_CONNECTIONS']
+        if rate is None:
+            rate = settings['MAILER_RATE']
+        if burst is None:
+            burst = settings['MAILER_BURST']
+        self.connections = connections
+        self.bucket = TokenBucket(rate, burst)
+        self.local = threading.local()
+        self.servers = []
+        self.lock = threading.Lock()
+        self.errors = []        # Tuples (member email, error).
+
+    def send(self, messages, checkpoint=None, sent=None):
+        """Send the messages, and return the set of the emails of the
+        members sent to. If a checkpoint file is given, then record each
+        member sent to in it.
+        """
+        sent = set(sent or [])
+        executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.connections, thread_name_prefix='beerclub-mailer')
+        try:
+            futures = dict([(executor.submit(self.send_message, message),
+                             message)
+                            for message in messages])
+            for future in concurrent.futures.as_completed(futures):
+                message = futures[future]
+                error = future.result()
+                if error is None:
+                    sent.add(message['email'])
+                    write_checkpoint(checkpoint, sent)
+                    print('sent', message['recipient'])
+                else:
+                    self.errors.append((message['email'], error))
+                    print('failed', message['recipient'], error)
+        finally:
+            executor.shutdown()
+            self.close()
+        return sent
+
+    def send_message(self, message):
+        "Send the message. Return None if sent, else the error message."
+        self.bucket.take()
+        try:
+            self.get_server().send(message['recipient'],
+                                   message['subject'],
+                                   message['text'])
+        except (smtplib.SMTPException, OSError, ValueError) as error:
+            # The connection may be in an unknown state; start afresh.
+            self.local.server = None
+            return str(error) or type(error).__name__
+        return None
+
+    def get_server(self):
+        "Get the connection to the email server for the current thread."
+        server = getattr(self.local, 'server', None)
+        if server is None:
+            server = self.local.server = utils.EmailServer()
+            with self.lock:
+                self.servers.append(server)
+        return server
+
+    def close(self):
+        "Close all connections to the email server."
+        for server in self.servers:
+            try:
+                server.close()
+            except Exception:
+                pass
+        self.servers = []
+
+
+def get_members(db, below=None):
+    """Get the enabled members, each with its balance, optionally only
+    those having a balance below the given amount.
+    """
+    balances = {}
+    for row in db.view('event/credit', group_level=1, reduce=True):
+        balances[row.key] = row.value
+    result = []
+    for member in utils.get_docs(db, 'member/status', key=constants.ENABLED):
+        member['balance'] = balances.get(member['email'], 0.0)
+        if below is not None and member['balance'] >= below: continue
+        result.append(member)
+    result.sort(key=lambda m: (m.get('last_name') or '',
+                               m.get('first_name') or '',
+                               m['email']))
+    return result
+
+def render(members, subject, template):
+    """Render the message for each member. The template may contain
+    the fields {name}, {email}, {balance}, {amount} and {site}.
+    Raise KeyError if it contains any other field.
+    """
+    result = []
+    for member in members:
+        name = ' '.join([n for n in [member.get('first_name'),
+                                     member.get('last_name')] if n])
+        data = dict(name=name or member['email'],
+                    email=member['email'],
+                    balance=member['balance'],
+                    amount=abs(member['balance']),
+                    site=settings['SITE_NAME'])
+        if name:
+            recipient = "%s <%s>" % (name, member['email'])
+        else:
+            recipient = member['email']
+        result.append(dict(email=member['email'],
+                           recipient=recipient,
+                           balance=member['balance'],
+                           subject=subject.format(**data),
+                           text=template.format(**data)))
+    return result
+
+def mail(db, subject, template, below=None, execute=False, checkpoint=None,
+         **kwargs):
+    """Send the message to the selected members; by default, only report
+    what would be sent. The members recorded in the checkpoint file, if
+    given, are skipped. It is removed when all messages have been sent.
+    Other keyword arguments are passed to the Mailer.
+    """
+    start = time.perf_counter()
+    sent = set()
+    if checkpoint and os.path.exists(checkpoint):
+        with open(checkpoint) as cpfile:
+            sent = set(json.load(cpfile)['sent'])
+        print('resuming after', len(sent), 'messages sent')
+    members = get_members(db, below=below)
+    messages = render(members, subject, template)
+    messages = [m for m in messages if m['email'] not in sent]
+    if not execute:
+        # This will be executed on the command line, so output to console.
+        for message in messages:
+            print(message['recipient'], message['balance'])
+        print(len(messages), 'messages to send; total balance',
+              sum([m['balance'] for m in messages]))
+        if messages:
+            rate = kwargs.get('rate') or settings['MAILER_RATE']
+            print("about %.0f s at %s messages/s" %
+                  (len(messages) / rate, rate))
+        return
+    mailer = Mailer(**kwargs)
+    sent = mailer.send(messages, checkpoint=checkpoint, sent=sent)
+    elapsed = max(time.perf_counter() - start, 0.001)
+    print('sent', len(messages) - len(mailer.errors), 'messages')
+    print("%.1f s, %.1f messages/s" %
+          (elapsed, (len(messages) - len(mailer.errors)) / elapsed))
+    if mailer.errors:
+        print(len(mailer.errors), 'errors; run again to resume')
+    elif checkpoint and os.path.exists(checkpoint):
+        os.remove(checkpoint)
+
+def write_checkpoint(checkpoint, sent):
+    "Record the emails of the members sent to, if a checkpoint file is given."
+    if not checkpoint: return
+    with open(checkpoint + '.tmp', 'w') as cpfile:
+        json.dump(dict(sent=sorted(sent)), cpfile)
+    os.replace(checkpoint + '.tmp', checkpoint)
+
+
+if __name__ == '__main__':
+    utils.setup()
+    utils.initialize()
+    parser = argparse.ArgumentParser(
+        description='Send an email message to the enabled members.')
+    parser.add_argument('messagefile', metavar='FILE',
+                        type=argparse.FileType('r'),
+                        help='File containing the email message.')
+    parser.add_argument('-S', '--subject', type=str, required=True,
+                        help='Subject of the email message.')
+    parser.add_argument('-b', '--below', metavar='AMOUNT', type=float,
+                        action='store', dest='below',
+                        help='Only members having a balance below this;'
+                        ' e.g. 0 for those in debt.')
+    parser.add_argument('-x', '--execute',
+                        action='store_true', default=False,
+                        help='Actually send the messages.')
+    parser.add_argument('-c', '--connections', metavar='N', type=int,
+                        action='store', dest='connections',
+                        help='The number of connections to the email server;'
+                        ' default MAILER_CONNECTIONS.')
+    parser.add_argument('-r', '--rate', metavar='N', type=float,
+                        action='store', dest='rate',
+                        help='The max number of messages per second;'
+                        ' default MAILER_RATE.')
+    parser.add_argument('--checkpoint', metavar='FILE', type=str,
+                        action='store', dest='checkpoint',
+                        help='File recording the members sent to;'
+                        ' default the message file name + .checkpoint')
+    args = parser.parse_args()
+    checkpoint = args.checkpoint or args.messagefile.name + '.checkpoint'
+    try:
+        mail(utils.get_db(),
+             args.subject,
+             args.messagefile.read(),
+             below=args.below,
+             execute=args.execute,
+             checkpoint=checkpoint,
+             connections=args.connections,
+             rate=args.rate)
+    except KeyError as error:
+        sys.exit("invalid field in the message: %s" % error)
@@ -1,16 +1,19 @@
 "Member account handling; member of Beer Club."
 
-import csv
 import logging
 import fnmatch
-from io import StringIO
 
 import tornado.web
 
+from beerclub import cache
 from beerclub import constants
+from beerclub import outbox
 from beerclub import settings
 from beerclub import utils
-from beerclub.requesthandler import RequestHandler, ApiMixin
+from beerclub.requesthandler import (RequestHandler,
+                                     ApiMixin,
+                                     CsvMixin,
+                                     CachedPageMixin)
 from beerclub.saver import Saver
 
 EMAIL_SENT = 'An email with instructions has been sent.'
@@ -62,13 +65,13 @@ class MemberSaver(Saver):
         except tornado.web.MissingArgumentError:
             raise ValueError('Missing first or last name.')
 
-    def set_swish(self):
+    async def set_swish(self):
         try:
             swish = self.rqh.get_argument('swish')
             if swish:
                 swish = utils.normalize_swish(swish)
                 try:
-                    other = self.rqh.get_member(swish)
+                    other = await self.rqh.get_member(swish)
                 except KeyError:
                     pass
                 else:
@@ -110,31 +113,31 @@ class Member(RequestHandler):
     "View a member account."
 
     @tornado.web.authenticated
-    def get(self, email):
+    async def get(self, email):
         try:
-            member = self.get_member(email, check=True)
+            member = await self.get_member(email, check=True)
         except KeyError:
             self.see_other('home')
         else:
-            member['balance'] = self.get_balance(member)
-            utils.get_latest_events(self.db, [member])
+            member['balance'] = await self.get_balance(member)
+            await utils.get_latest_events_async(self.db, [member])
             deletable = not member['latest_event'] and \
                         member['role'] != constants.ADMIN
             self.render('member.html', member=member, deletable=deletable)
 
     @tornado.web.authenticated
-    def post(self, email):
+    async def post(self, email):
         "Delete this member; only if has no events and is not admin."
         self.check_admin()
         try:
-            member = self.get_member(email, check=True)
-            utils.get_latest_events(self.db, [member])
+            member = await self.get_member(email, check=True)
+            await utils.get_latest_events_async(self.db, [member])
         except KeyError:
             self.see_other('home')
             return
         if self.get_argument('_http_method', None) == 'DELETE' and \
            not member['latest_event'] and member['role'] != constants.ADMIN:
-            self.db.delete(member)
+            await self.delete_doc(member)
         url = self.get_argument('next', None)
         if url:
             self.redirect(url)
@@ -146,25 +149,25 @@ class Settings(RequestHandler):
     "Edit a member account; change values, enable or disable."
 
     @tornado.web.authenticated
-    def get(self, email):
+    async def get(self, email):
         try:
-            member = self.get_member(email, check=True)
+            member = await self.get_member(email, check=True)
         except KeyError:
             self.see_other('home')
         else:
             self.render('settings.html', member=member)
 
     @tornado.web.authenticated
-    def post(self, email):
+    async def post(self, email):
         try:
-            member = self.get_member(email, check=True)
+            member = await self.get_member(email, check=True)
         except KeyError:
             self.see_other('home')
             return
         try:
-            with MemberSaver(doc=member, rqh=self) as saver:
+            async with MemberSaver(doc=member, rqh=self) as saver:
                 saver.set_name()
-                saver.set_swish()
+                await saver.set_swish()
                 saver.set_address()
                 saver.set_api_key()
                 saver.set_role()
@@ -182,20 +185,20 @@ class Members(RequestHandler):
     "View a table of all member accounts."
 
     @tornado.web.authenticated
-    def get(self):
+    async def get(self):
         self.check_admin()
-        members = self.get_docs('member/email')
-        utils.get_balances(self.db, members)
-        utils.get_latest_events(self.db, members)
+        members = await self.get_docs('member/email')
+        await self.get_balances(members)
+        await utils.get_latest_events_async(self.db, members)
         self.render('members.html', members=members)
 
 
-class MembersCsv(Members):
+class MembersCsv(CachedPageMixin, CsvMixin, RequestHandler):
     "CSV output of members accounts."
 
-    def render(self, template, members):
-        csvbuffer = StringIO()
-        writer = csv.writer(csvbuffer)
+    @tornado.web.authenticated
+    async def get(self):
+        self.check_admin()
         row = ['Member',
                'First name',
                'Last name',
@@ -209,35 +212,36 @@ class MembersCsv(Members):
                 row.append('Swish lazy')
         if settings['MEMBER_ADDRESS']:
             row.append('Address')
-        writer.writerow(row)
-        for member in members:
-            row = [member['email'],
-                   member['first_name'],
-                   member['last_name'],
-                   member['balance'],
-                   member['role'],
-                   member['status'],
-                   member.get('last_login') or '']
-            if settings['MEMBER_SWISH']:
-                row.append(member.get('swish') or '')
-                if not settings['GLOBAL_SWISH_LAZY']:
-                    row.append(member.get('swish_lazy') or '')
-            if settings['MEMBER_ADDRESS']:
-                row.append(member.get('address') or '')
-            writer.writerow(row)
-        self.write(csvbuffer.getvalue())
-        self.set_header('Content-Type', constants.CSV_MIME)
-        self.set_header('Content-Disposition', 
-                        'attachment; filename="members.csv"')
+        self.start_csv('members.csv', row)
+        async for members in self.get_docs_batches('member/email'):
+            await self.get_balances(members)
+            rows = []
+            for member in members:
+                row = [member['email'],
+                       member['first_name'],
+                       member['last_name'],
+                       member['balance'],
+                       member['role'],
+                       member['status'],
+                       member.get('last_login') or '']
+                if settings['MEMBER_SWISH']:
+                    row.append(member.get('swish') or '')
+                    if not settings['GLOBAL_SWISH_LAZY']:
+                        row.append(member.get('swish_lazy') or '')
+                if settings['MEMBER_ADDRESS']:
+                    row.append(member.get('address') or '')
+                rows.append(row)
+            self.write_csv(rows)
+            await self.flush()
 
 
 class Pending(RequestHandler):
     "View a table of pending member accounts."
 
     @tornado.web.authenticated
-    def get(self):
+    async def get(self):
         self.check_admin()
-        members = self.get_docs('member/status', key=constants.PENDING)
+        members = await self.get_docs('member/status', key=constants.PENDING)
         members.sort(key=lambda m: m['email'])
         self.render('pending.html', members=members)
 
@@ -245,7 +249,7 @@ class Pending(RequestHandler):
 class Login(RequestHandler):
     "Login resource."
 
-    def post(self):
+    async def post(self):
         "Login to a member account. Set a secure cookie."
         try:
             email = self.get_argument('email').lower()
@@ -255,10 +259,10 @@ class Login(RequestHandler):
             self.see_other('home')
             return
         try:
-            member = self.get_member(email)
+            member = await self.get_member(email)
             if member['status'] == constants.DISABLED:
                 raise ValueError
-            if utils.hashed_password(password) != member.get('password'):
+            if not await self.verify_password(member, password):
                 raise KeyError
         except KeyError:
             self.set_error_flash('No such member or invalid password.')
@@ -267,7 +271,13 @@ class Login(RequestHandler):
                                  " Contact the %s administrators."
                                  % settings['SITE_NAME'])
         else:
-            with MemberSaver(doc=member, rqh=self) as saver:
+            # Replace a legacy or outdated hashed form of the password.
+            if utils.needs_rehash(member['password']):
+                hashed = await utils.hashed_password_async(password)
+            else:
+                hashed = member['password']
+            async with MemberSaver(doc=member, rqh=self) as saver:
+                saver['password']   = hashed
                 saver['login']      = utils.timestamp() # Set login session.
                 saver['last_login'] = saver['login']    # Set last login.
             logging.info("Login auth: %s", member['email'])
@@ -281,9 +291,10 @@ class Logout(RequestHandler):
     "Logout; unset the secure cookie, and invalidate login session."
 
     @tornado.web.authenticated
-    def post(self):
-        with MemberSaver(doc=self.current_user, rqh=self) as saver:
+    async def post(self):
+        async with MemberSaver(doc=self.current_user, rqh=self) as saver:
             saver['login'] = None  # Unset login session.
+        cache.sessions.remove(self.get_cookie(constants.USER_COOKIE))
         self.set_secure_cookie(constants.USER_COOKIE, '')
         self.see_other('home')
 
@@ -291,9 +302,9 @@ class Logout(RequestHandler):
 class Reset(RequestHandler):
     "Reset the password of a member account."
 
-    def post(self):
+    async def post(self):
         try:
-            member = self.get_member(self.get_argument('email'))
+            member = await self.get_member(self.get_argument('email'))
         except (tornado.web.MissingArgumentError, KeyError):
             self.see_other('home', error='No such member account.')
         else:
@@ -305,7 +316,7 @@ class Reset(RequestHandler):
                 self.see_other('home', error='Cannot reset password.'
                                ' Member account is disabled.')
                 return
-            with MemberSaver(doc=member, rqh=self) as saver:
+            async with MemberSaver(doc=member, rqh=self) as saver:
                 saver['password'] = None
                 saver['code']     = utils.get_iuid()
             data = dict(email=member['email'],
@@ -313,10 +324,9 @@ class Reset(RequestHandler):
                         url = self.absolute_reverse_url('password',
                                                     email=member['email'],
                                                     code=member['code']))
-            email_server = utils.EmailServer()
-            email_server.send(member['email'],
-                              RESET_SUBJECT.format(**data),
-                              RESET_TEXT.format(**data))
+            await outbox.enqueue(self, [(member['email'],
+                                         RESET_SUBJECT.format(**data),
+                                         RESET_TEXT.format(**data))])
             if self.current_user and not self.is_admin():
                 # Log out the user if not admin
                 self.set_secure_cookie(constants.USER_COOKIE, '')
@@ -331,9 +341,9 @@ class Password(RequestHandler):
                     email=self.get_argument('email', default=''),
                     code=self.get_argument('code', default=''))
 
-    def post(self):
+    async def post(self):
         try:
-            member = self.get_member(self.get_argument('email'))
+            member = await self.get_member(self.get_argument('email'))
             if member.get('code') != self.get_argument('code'):
                 raise ValueError
         except (tornado.web.MissingArgumentError, KeyError, ValueError):
@@ -352,8 +362,8 @@ class Password(RequestHandler):
                            code=self.get_argument('code') or '',
                            error=str(msg))
             return 
-        with MemberSaver(doc=member, rqh=self) as saver:
-            saver['password'] = utils.hashed_password(password)
+        async with MemberSaver(doc=member, rqh=self) as saver:
+            saver['password'] = await utils.hashed_password_async(password)
             saver['login'] = utils.timestamp()     # Set login session.
             saver['last_login'] = saver['login']   # Set last login.
             saver['code'] = None
@@ -372,9 +382,9 @@ class Register(RequestHandler):
         self.check_admin()
         self.render('register.html')
 
-    def post(self):
+    async def post(self):
         try:
-            with MemberSaver(rqh=self) as saver:
+            async with MemberSaver(rqh=self) as saver:
                 try:
                     email = self.get_argument('email').lower()
                     if not email: raise ValueError
@@ -383,7 +393,7 @@ class Register(RequestHandler):
                 if not fnmatch.fnmatch(email, constants.EMAIL_PATTERN):
                     raise ValueError('Invalid email address provided.')
                 try:
-                    member = self.get_doc(email, 'member/email')
+                    member = await self.get_doc(email, 'member/email')
                 except KeyError:
                     pass
                 else:
@@ -391,12 +401,13 @@ class Register(RequestHandler):
                                      ' Please use Reset password.')
                 saver['email']   = email
                 saver.set_name()
-                saver.set_swish()
+                await saver.set_swish()
                 saver.set_address()
                 # Set the very first member account in the database
                 # to be admin and enabled.
-                count = len(self.get_docs('member/email', key='',
-                                          last=constants.CEILING, limit=2))
+                count = len(await self.get_docs('member/email', key='',
+                                                last=constants.CEILING,
+                                                limit=2))
                 if count == 0:
                     saver['role'] = constants.ADMIN
                     saver['status'] = constants.ENABLED
@@ -414,21 +425,21 @@ class Register(RequestHandler):
             return
         member = saver.doc
         data = dict(email=member['email'], site=settings['SITE_NAME'])
-        email_server = utils.EmailServer()
         if member['status'] == constants.ENABLED:
             data['url'] = self.absolute_reverse_url('password',
                                                     email=email,
                                                     code=code)
-            email_server.send(member['email'],
-                              ENABLED_SUBJECT.format(**data),
-                              ENABLED_TEXT.format(**data))
+            await outbox.enqueue(self, [(member['email'],
+                                         ENABLED_SUBJECT.format(**data),
+                                         ENABLED_TEXT.format(**data))])
             self.set_message_flash(EMAIL_SENT)
         else:
             data['url'] = self.absolute_reverse_url('member', data['email'])
             subject = PENDING_SUBJECT.format(**data)
             text = PENDING_TEXT.format(**data)
-            for admin in self.get_docs('member/role', key=constants.ADMIN):
-                email_server.send(admin['email'], subject, text)
+            admins = await self.get_docs('member/role', key=constants.ADMIN)
+            await outbox.enqueue(self, [(admin['email'], subject, text)
+                                        for admin in admins])
             self.set_message_flash(PENDING_MESSAGE)
         if self.is_admin():
             self.see_other('member', member['email'])
@@ -440,23 +451,22 @@ class Enable(RequestHandler):
     "Enable a member account."
 
     @tornado.web.authenticated
-    def post(self, email):
+    async def post(self, email):
         self.check_admin()
-        member = self.get_member(email)
-        with MemberSaver(doc=member, rqh=self) as saver:
+        member = await self.get_member(email)
+        async with MemberSaver(doc=member, rqh=self) as saver:
             saver['status']   = constants.ENABLED
             saver['login']    = None
             saver['password'] = None
             saver['code']     = utils.get_iuid()
-        email_server = utils.EmailServer()
         data = dict(email=member['email'],
                     site=settings['SITE_NAME'],
                     url=self.absolute_reverse_url('password',
                                                   email=member['email'],
                                                   code=member['code']))
-        email_server.send(member['email'],
-                          ENABLED_SUBJECT.format(**data),
-                          ENABLED_TEXT.format(**data))
+        await outbox.enqueue(self, [(member['email'],
+                                     ENABLED_SUBJECT.format(**data),
+                                     ENABLED_TEXT.format(**data))])
         self.set_message_flash(EMAIL_SENT)
         url = self.get_argument('next', None)
         if url:
@@ -469,10 +479,10 @@ class Disable(RequestHandler):
     "Disable a member account."
 
     @tornado.web.authenticated
-    def post(self, email):
+    async def post(self, email):
         self.check_admin()
-        member = self.get_member(email)
-        with MemberSaver(doc=member, rqh=self) as saver:
+        member = await self.get_member(email)
+        async with MemberSaver(doc=member, rqh=self) as saver:
             saver['status']   = constants.DISABLED
             saver['login']    = None
             saver['password'] = None
@@ -488,10 +498,10 @@ class MemberApiV1(ApiMixin, RequestHandler):
     "Get member data."
 
     @tornado.web.authenticated
-    def get(self, email):
+    async def get(self, email):
         self.check_admin()
         try:
-            member = self.get_member(email)
+            member = await self.get_member(email)
         except KeyError:
             raise tornado.web.HTTPError(404, reason='no such member')
         data = {}
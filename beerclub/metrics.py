@@ -0,0 +1,164 @@
+"""Latency histograms of the requests and of the CouchDB calls,
+output in the Prometheus text format.
+
+The observations are made both in the IOLoop thread and in the
+executor threads for the database calls, hence the lock.
+
+Optionally, the CouchDB calls made while handling a request are traced,
+for output as a Server-Timing header and in the log of slow requests.
+The trace is held in a context variable, which is copied to the executor
+thread by 'utils.run_async' only when tracing.
+"""
+
+import contextlib
+import contextvars
+import json
+import threading
+import time
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Upper bounds of the histogram buckets, in seconds.
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+           1.0, 2.5, 5.0, 10.0)
+
+TRACE_MAX_ENTRIES = 50          # Max number of calls in Server-Timing.
+
+_routes = {}                    # Route names and matchers by handler class.
+_trace = contextvars.ContextVar('beerclub_trace', default=None)
+
+
+class Histograms(object):
+    "Latency histograms, by the tuple of values for the labels."
+
+    def __init__(self, name, help, labels):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.lock = threading.Lock()
+        # Cumulative count for each bucket, followed by count and sum.
+        self.entries = {}
+
+    def observe(self, values, seconds):
+        "Record the time for the label values."
+        with self.lock:
+            try:
+                entry = self.entries[values]
+            except KeyError:
+                entry = self.entries[values] = [0] * len(BUCKETS) + [0, 0.0]
+            for pos, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    entry[pos] += 1
+            entry[-2] += 1
+            entry[-1] += seconds
+
+    @contextlib.contextmanager
+    def timer(self, *values, **details):
+        """Context manager recording the time taken by the block.
+        If tracing, then also add the label values and the details to
+        the trace. The block may add details to the dictionary it gets.
+        """
+        start = time.perf_counter()
+        try:
+            yield details
+        finally:
+            seconds = time.perf_counter() - start
+            self.observe(values, seconds)
+            trace = _trace.get()
+            if trace is not None:
+                trace.append((values, details, seconds))
+
+    def render(self):
+        "Return the list of lines in Prometheus text format."
+        result = ["# HELP %s %s" % (self.name, self.help),
+                  "# TYPE %s histogram" % self.name]
+        with self.lock:
+            entries = sorted([(k, list(v)) for k, v in self.entries.items()])
+        for values, entry in entries:
+            labels = ','.join(['%s="%s"' % (l, escape(v))
+                               for l, v in zip(self.labels, values)])
+            for bound, count in zip(BUCKETS, entry):
+                result.append('%s_bucket{%s,le="%s"} %i' %
+                              (self.name, labels, bound, count))
+            result.append('%s_bucket{%s,le="+Inf"} %i' %
+                          (self.name, labels, entry[-2]))
+            result.append("%s_count{%s} %i" % (self.name, labels, entry[-2]))
+            result.append("%s_sum{%s} %.6f" % (self.name, labels, entry[-1]))
+        return result
+
+
+requests = Histograms('beerclub_request_duration_seconds',
+                      'Time taken to handle a request.',
+                      ('route', 'method', 'status'))
+database = Histograms('beerclub_couchdb_duration_seconds',
+                      'Time taken by a CouchDB call.',
+                      ('operation', 'name'))
+
+
+def observe_request(handler):
+    "Record the time taken by the finished request."
+    status = "%ixx" % (handler.get_status() // 100)
+    requests.observe((get_route_name(handler), handler.request.method, status),
+                     handler.request.request_time())
+
+def get_route_name(handler):
+    """Return the name of the route of the request, as given in the URL
+    specifications of the application. A handler class may serve several
+    routes; if so, the one matching the request is chosen.
+    """
+    cls = type(handler)
+    try:
+        rules = _routes[cls]
+    except KeyError:
+        rules = handler.application.wildcard_router.named_rules.items()
+        rules = _routes[cls] = [(name, rule.matcher)
+                                for name, rule in rules
+                                if rule.target is cls]
+    if len(rules) == 1:
+        return rules[0][0]
+    for name, matcher in rules:
+        if matcher.match(handler.request) is not None:
+            return name
+    return cls.__name__
+
+def escape(value):
+    "Escape the label value."
+    return str(value).replace('\\', r'\\').replace('"', r'\"')\
+                     .replace('\n', r'\n')
+
+def render(values=()):
+    """Return the histograms, followed by the given untyped values, each
+    a tuple (name, value), in Prometheus text format. None is skipped.
+    """
+    result = requests.render() + database.render()
+    for name, value in values:
+        if value is None: continue
+        result.append("# TYPE %s untyped" % name)
+        result.append("%s %s" % (name, float(value)))
+    return '\n'.join(result) + '\n'
+
+def start_trace():
+    "Start tracing the CouchDB calls in the current context."
+    _trace.set([])
+
+def get_trace():
+    """Return the list of calls traced in the current context, each a
+    tuple (label values, details, seconds), or None if not tracing.
+    """
+    return _trace.get()
+
+def format_trace(trace, separator=', '):
+    """Return the traced calls as Server-Timing metrics, the slowest first,
+    preceded by the total for all calls. At most 'TRACE_MAX_ENTRIES'.
+    """
+    result = ['db;desc="%i calls";dur=%.1f' %
+              (len(trace), 1000.0 * sum([t[2] for t in trace]))]
+    for values, details, seconds in sorted(trace, key=lambda t: -t[2]):
+        if len(result) > TRACE_MAX_ENTRIES: break
+        desc = [' '.join(values[1:])]
+        for key, value in sorted(details.items()):
+            if value is None: continue
+            desc.append("%s=%s" % (key, json.dumps(value)))
+        result.append('%s;desc="%s";dur=%.1f' %
+                      (values[0], escape(' '.join(desc)), 1000.0 * seconds))
+    return separator.join(result)
@@ -0,0 +1,222 @@
+"""Queue of outbound emails, stored as message documents in the database.
+
+The request handlers only save the messages. A background worker sends
+them in batches over one connection to the email server, which is kept
+open between batches. A failed message is retried with an exponentially
+increasing delay, and is marked as failed after 'EMAIL_MAX_ATTEMPTS'.
+
+A message is claimed by a worker before being sent, by moving its next
+attempt time forward; a conflict means another process got it first.
+If the worker dies while sending, the message becomes due again later.
+"""
+
+import collections
+import concurrent.futures
+import datetime
+import logging
+import smtplib
+import time
+
+import tornado.ioloop
+import tornado.locks
+import tornado.util
+
+from beerclub import changes
+from beerclub import constants
+from beerclub import settings
+from beerclub import utils
+from beerclub.saver import Saver
+
+CLAIM_SECONDS = 600             # Time for a worker to send a claimed message.
+RECENT = 100                    # Number of recent sends for the averages.
+
+_executor = None
+_server = None                  # The connection to the email server.
+_server_used = None             # Monotonic time of its last use.
+_wakeup = tornado.locks.Event()
+_latencies = collections.deque(maxlen=RECENT)
+_send_times = collections.deque(maxlen=RECENT)
+
+# Number of queued messages at the last check, and counters of messages
+# sent, retried and failed, and of connections made to the email server.
+status = dict(depth=None, sent=0, retries=0, failed=0, connections=0)
+
+
+class MessageSaver(Saver):
+    doctype = constants.MESSAGE
+
+    def initialize(self):
+        self.doc['status'] = constants.QUEUED
+        self.doc['attempts'] = 0
+        self.doc['queued'] = utils.timestamp()
+        self.doc['next_attempt'] = self.doc['queued']
+
+
+async def enqueue(rqh, messages):
+    """Save the messages, each a tuple (recipient, subject, text),
+    and wake up the worker. Raise ValueError if any could not be saved.
+    """
+    async with MessageSaver.bulk(rqh=rqh) as bulk:
+        for recipient, subject, text in messages:
+            saver = bulk.new()
+            saver['recipient'] = recipient
+            saver['subject'] = subject
+            saver['text'] = text
+    if bulk.errors:
+        raise ValueError('could not queue the email')
+
+def wakeup(doc):
+    "Changes listener: wake up the worker if a message is due."
+    if doc.get(constants.DOCTYPE) != constants.MESSAGE: return
+    if doc.get('status') != constants.QUEUED: return
+    if doc['next_attempt'] <= utils.timestamp():
+        _wakeup.set()
+
+async def run(db):
+    """Send the queued messages, forever. The worker is woken up when
+    a message is queued, and otherwise checks at regular intervals.
+    The sending runs in an executor of its own, with a single thread,
+    so as not to occupy any of the threads for the database calls.
+    """
+    global _executor
+    if _executor is None:
+        _executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix='beerclub-email')
+    changes.add_listener(wakeup)
+    ioloop = tornado.ioloop.IOLoop.current()
+    timeout = datetime.timedelta(seconds=settings['EMAIL_QUEUE_POLL'])
+    while True:
+        _wakeup.clear()
+        try:
+            more = await send_batch(db)
+        except Exception as error:
+            logging.error("email queue: %s", error)
+            more = False
+        if more: continue
+        try:
+            await _wakeup.wait(timeout=timeout)
+        except tornado.util.TimeoutError:
+            await ioloop.run_in_executor(_executor, close_idle_server)
+
+async def send_batch(db):
+    """Send at most one batch of the messages that are due.
+    Return True if there may be more messages due.
+    The messages are saved by the async saver, so that the change
+    notifications are made in the IOLoop thread.
+    """
+    size = settings['EMAIL_BATCH_SIZE']
+    rows = await utils.run_async(get_due, db, size)
+    status['depth'] = await utils.run_async(get_depth, db)
+    if not rows: return False
+    # Claim the messages; the ones that fail are claimed by another worker.
+    async with MessageSaver.bulk(db=db) as claim:
+        for row in rows:
+            saver = claim.new(row.doc)
+            saver['next_attempt'] = utils.timestamp(CLAIM_SECONDS / 86400.0)
+    conflicts = set([docid for docid, error in claim.errors])
+    claimed = [s.doc for s in claim.savers if s.doc['_id'] not in conflicts]
+    ioloop = tornado.ioloop.IOLoop.current()
+    errors = await ioloop.run_in_executor(_executor, send_messages, claimed)
+    async with MessageSaver.bulk(db=db) as bulk:
+        for doc, error in zip(claimed, errors):
+            saver = bulk.new(doc)
+            saver['attempts'] = doc['attempts'] + 1
+            if error is None:
+                saver['status'] = constants.SENT
+                saver['sent'] = utils.timestamp()
+                del saver['error']
+                status['sent'] += 1
+                _latencies.append(get_seconds(doc['queued'], doc['sent']))
+            elif doc['attempts'] >= settings['EMAIL_MAX_ATTEMPTS']:
+                saver['status'] = constants.FAILED
+                saver['error'] = error
+                status['failed'] += 1
+                logging.error("email to %s failed: %s",
+                              doc['recipient'], error)
+            else:
+                delay = settings['EMAIL_RETRY_DELAY'] * \
+                        2 ** (doc['attempts'] - 1)
+                saver['next_attempt'] = utils.timestamp(delay / 86400.0)
+                saver['error'] = error
+                status['retries'] += 1
+                logging.warning("email to %s failed, retry in %s s: %s",
+                                doc['recipient'], delay, error)
+    status['depth'] = await utils.run_async(get_depth, db)
+    return len(rows) == size
+
+def get_due(db, size):
+    "Return the view rows of at most 'size' messages that are due."
+    return list(db.view('message/queue', endkey=utils.timestamp(),
+                        include_docs=True, reduce=False, limit=size))
+
+def send_messages(docs):
+    "Send the messages. Return the list of the results of 'send_message'."
+    return [send_message(doc) for doc in docs]
+
+def send_message(doc):
+    "Send the message. Return None if sent, else the error message."
+    start = time.perf_counter()
+    try:
+        get_server().send(doc['recipient'], doc['subject'], doc['text'])
+    except (smtplib.SMTPException, OSError, ValueError) as error:
+        # The connection may be in an unknown state; start afresh.
+        close_server()
+        return str(error) or type(error).__name__
+    _send_times.append(time.perf_counter() - start)
+    return None
+
+def get_server():
+    """Get the connection to the email server. A new connection is made
+    if there is none, or if it has been idle for too long.
+    """
+    global _server, _server_used
+    close_idle_server()
+    if _server is None:
+        _server = utils.EmailServer()
+        status['connections'] += 1
+    _server_used = time.monotonic()
+    return _server
+
+def close_idle_server():
+    "Close the connection if it has been idle longer than the keepalive."
+    if _server is None: return
+    if time.monotonic() - _server_used > settings['EMAIL_KEEPALIVE']:
+        close_server()
+
+def close_server():
+    "Close the connection to the email server, if any."
+    global _server
+    if _server is None: return
+    try:
+        _server.close()
+    except Exception:
+        pass
+    _server = None
+
+def get_depth(db):
+    "Return the number of queued messages, whether due or not."
+    result = list(db.view('message/queue', reduce=True))
+    if result:
+        return result[0].value
+    else:
+        return 0
+
+def get_seconds(start, end):
+    "Return the number of seconds between the two timestamps."
+    start = datetime.datetime.fromisoformat(start.rstrip('Z'))
+    end = datetime.datetime.fromisoformat(end.rstrip('Z'))
+    return (end - start).total_seconds()
+
+def get_metrics():
+    """Return the queue depth, the counters, and the average and maximum
+    latency (from queued to sent) and send time for the recent messages.
+    """
+    result = status.copy()
+    for name, values in [('latency', _latencies), ('send_time', _send_times)]:
+        if values:
+            result[name] = sum(values) / len(values)
+            result["max_%s" % name] = max(values)
+        else:
+            result[name] = None
+            result["max_%s" % name] = None
+    return result
@@ -1,34 +1,60 @@
 "RequestHandler subclass."
 
 import base64
+import csv
+import hashlib
 import json
 import logging
 import urllib
 from collections import OrderedDict as OD
+from io import StringIO
 
-import couchdb
+import tornado.escape
 import tornado.web
 
+from . import cache
+from . import changes
+from . import collation
 from . import constants
+from . import metrics
 from . import settings
 from . import utils
-from .saver import Saver
-
-
-class SnapshotSaver(Saver):
-    doctype = constants.SNAPSHOT
-
 
 class RequestHandler(tornado.web.RequestHandler):
     "Base request handler."
 
-    def prepare(self):
-        "Get the database connection."
-        try:
-            self.db = utils.get_dbserver()[settings['DATABASE_NAME']]
-        except couchdb.http.ResourceNotFound:
-            raise KeyError("CouchDB database '%s' does not exist." % 
-                           settings['DATABASE_NAME'])
+    async def prepare(self):
+        """Get the database connection, and the currently logged-in member.
+        The latter is done here since 'get_current_user' cannot be async.
+        """
+        if settings['TRACE_REQUESTS']:
+            metrics.start_trace()
+        self.db = self.application.settings['db']
+        self.current_user = await self.get_current_member()
+
+    def flush(self, include_footers=False):
+        """Output the database calls traced so far in the headers.
+        Only to admins, since the keys may contain personal data.
+        """
+        if not self._headers_written and self.is_admin():
+            trace = metrics.get_trace()
+            if trace is not None:
+                self.set_header('Server-Timing', metrics.format_trace(trace))
+        return super().flush(include_footers=include_footers)
+
+    def on_finish(self):
+        """Record the time taken to handle the request.
+        Log the traced database calls if the request was slow.
+        """
+        metrics.observe_request(self)
+        trace = metrics.get_trace()
+        if trace is not None and \
+           self.request.request_time() > settings['TRACE_SLOW_REQUEST']:
+            logging.warning("slow request %s %s %.0f ms: %s",
+                            self.request.method,
+                            self.request.uri,
+                            1000.0 * self.request.request_time(),
+                            metrics.format_trace(trace, separator='; '))
 
     def get_template_namespace(self):
         "Set the variables accessible within the template."
@@ -73,6 +99,20 @@ class RequestHandler(tornado.web.RequestHandler):
             url += '?' + urllib.parse.urlencode(query)
         return url
 
+    def get_from_to(self, days):
+        """Get the 'from' and 'to' date arguments. The default interval
+        is from the given number of days back until today.
+        """
+        try:
+            from_ = self.get_argument('from')
+        except tornado.web.MissingArgumentError:
+            from_ = utils.today(-days)
+        try:
+            to = self.get_argument('to')
+        except tornado.web.MissingArgumentError:
+            to = utils.today()
+        return from_, to
+
     def set_message_flash(self, message):
         "Set message flash cookie."
         self.set_flash('message', message)
@@ -87,110 +127,257 @@ class RequestHandler(tornado.web.RequestHandler):
         message = message.replace(',', '_')
         self.set_cookie(name, message)
 
-    def get_doc(self, key, viewname=None):
+    async def get_doc(self, key, viewname=None):
         """Get the document with the given id, or from the given view.
         Raise KeyError if not found.
         """
-        return utils.get_doc(self.db, key, viewname=viewname)
+        return await utils.get_doc_async(self.db, key, viewname=viewname)
 
-    def get_docs(self, viewname, key=None, last=None, **kwargs):
+    async def get_docs(self, viewname, key=None, last=None, **kwargs):
         """Get the list of documents using the named view
         and the given key or interval.
         """
-        return utils.get_docs(self.db, viewname, key=key, last=last, **kwargs)
+        return await utils.get_docs_async(self.db, viewname,
+                                          key=key, last=last, **kwargs)
 
-    def get_member(self, email, check=False):
+    async def get_rows(self, viewname, key=None, last=None, **kwargs):
+        """Get the list of rows from the named view
+        and the given key or interval.
+        """
+        return await utils.get_rows_async(self.db, viewname,
+                                          key=key, last=last, **kwargs)
+
+    async def get_docs_batches(self, viewname, key=None, last=None,
+                               **kwargs):
+        """Asynchronous generator of the documents using the named view
+        and the given key or interval, in lists of at most
+        'DATABASE_BATCH_SIZE' documents. Each batch is fetched by
+        a separate request, continuing from the key and document id
+        of the row following the previous batch.
+        """
+        kwargs['include_docs'] = True
+        kwargs['reduce'] = False
+        if key is not None:
+            kwargs['startkey'] = key
+            if last is None:
+                kwargs['endkey'] = key
+            else:
+                kwargs['endkey'] = last
+        batches = utils.get_rows_batches(self.db, viewname, **kwargs)
+        while True:
+            rows = await utils.run_async(next, batches, None)
+            if rows is None: break
+            yield [r.doc for r in rows]
+
+    async def get_docs_page(self, viewname, first, last):
+        """Get a page of the documents using the named view and the
+        interval given by the keys 'first' and 'last', newest first.
+        The page starts at the position given by the 'after' cursor
+        argument, or ends just before the 'before' cursor argument.
+        The page size is given by the 'size' argument, within limits.
+        Return the documents and the URLs of the next and previous pages;
+        each URL is None if there is no such page.
+        """
+        try:
+            size = int(self.get_argument('size'))
+        except (tornado.web.MissingArgumentError, ValueError):
+            size = settings['DISPLAY_PAGE_SIZE']
+        size = max(1, min(size, settings['DISPLAY_PAGE_MAX']))
+        kwargs = dict(include_docs=True, reduce=False, limit=size+1)
+        before = self.get_argument('before', None)
+        after = self.get_argument('after', None)
+        if before:
+            key, docid = self.decode_cursor(before, first, last)
+            # Read newer rows in ascending order, skipping the cursor row.
+            rows = await self.get_rows(viewname, startkey=key,
+                                       startkey_docid=docid, endkey=last,
+                                       skip=1, **kwargs)
+            previous_cursor = None
+            if len(rows) > size:
+                previous_cursor = self.encode_cursor(rows[size-1])
+            rows = list(reversed(rows[:size]))
+            next_cursor = before
+        else:
+            if after:
+                key, docid = self.decode_cursor(after, first, last)
+                kwargs['startkey'] = key
+                kwargs['startkey_docid'] = docid
+            else:
+                kwargs['startkey'] = last
+            rows = await self.get_rows(viewname, endkey=first,
+                                       descending=True, **kwargs)
+            next_cursor = None
+            if len(rows) > size:
+                next_cursor = self.encode_cursor(rows[size])
+            rows = rows[:size]
+            previous_cursor = None
+            if after and rows:
+                previous_cursor = self.encode_cursor(rows[0])
+        return ([r.doc for r in rows],
+                self.get_page_url(after=next_cursor),
+                self.get_page_url(before=previous_cursor))
+
+    def encode_cursor(self, row):
+        "Return the URL-safe cursor for the position of the view row."
+        data = json.dumps([row.key, row.id]).encode('utf-8')
+        return base64.urlsafe_b64encode(data).decode('ascii')
+
+    def decode_cursor(self, cursor, first, last):
+        """Return the key and document id encoded in the cursor.
+        Raise HTTP 400 if invalid, or if the key is outside the interval
+        given by the keys 'first' and 'last'; a forged cursor must not
+        give access to the rows of other keys in the view.
+        """
+        try:
+            key, docid = json.loads(base64.urlsafe_b64decode(cursor))
+            if not isinstance(docid, str): raise ValueError
+            if not (collation.collation_key(first) <=
+                    collation.collation_key(key) <=
+                    collation.collation_key(last)):
+                raise ValueError
+        except (TypeError, ValueError):
+            raise tornado.web.HTTPError(400, reason='Invalid page cursor')
+        return key, docid
+
+    def get_page_url(self, **cursor):
+        """Return the URL of the current page with the given cursor,
+        keeping the 'from', 'to' and 'size' arguments.
+        Return None if the cursor value is None.
+        """
+        name, value = cursor.popitem()
+        if value is None: return None
+        query = {}
+        for key in ('from', 'to', 'size'):
+            try:
+                query[key] = self.get_argument(key)
+            except tornado.web.MissingArgumentError:
+                pass
+        query[name] = value
+        return self.request.path + '?' + urllib.parse.urlencode(query)
+
+    async def delete_doc(self, doc):
+        "Delete the document."
+        await utils.run_async(self.db.delete, doc)
+        changes.notify_deleted(doc)
+
+    async def get_member(self, email, check=False):
         """Get the member identified by the email address.
         If Swish is enabled, then also check if 'email' is
         a Swish number, which must match exactly.
         Raise KeyError if no such member or if not allowed to view it.
+        The member cache is used, with fallback to the database.
         """
         try:
-            member = utils.get_member(self.db, email)
+            member = cache.members.get(email)
         except KeyError:
-            raise KeyError('No such member account.')
+            try:
+                member = await utils.get_member_async(self.db, email)
+            except KeyError:
+                raise KeyError('No such member account.')
+            cache.members.update(member)
         if check:
             if not (self.is_admin() or 
                     member['email'] == self.current_user['email']):
                 raise KeyError('You may not view the member account.')
         return member
 
-    def get_balance(self, member=None):
+    async def get_members(self, emails):
+        """Get the members identified by the email addresses or Swish
+        numbers. Return a dictionary with the given keys that were found.
+        The member cache is used, with fallback to the database.
+        """
+        result = {}
+        missing = []
+        for email in emails:
+            try:
+                result[email] = cache.members.get(email)
+            except KeyError:
+                missing.append(email)
+        if missing:
+            found = await utils.get_members_async(self.db, missing)
+            for member in found.values():
+                cache.members.update(member)
+            result.update(found)
+        return result
+
+    async def get_balance(self, member=None):
         "Get the current balance for the member, or the sum of all members."
-        if member is None:
-            result = list(self.db.view('event/credit', group=False))
-        else:
-            result = list(self.db.view('event/credit',
-                                       key=member['email'],
-                                       group_level=1))
-        if result:
-            return result[0].value
+        if cache.balances.loaded:
+            return cache.balances.get(member)
+        return await utils.get_balance_async(self.db, member=member)
+
+    async def get_balances(self, members):
+        "Get and set the balances for all input members."
+        if cache.balances.loaded:
+            for member in members:
+                member['balance'] = cache.balances.get(member)
         else:
-            return 0
+            await utils.get_balances_async(self.db, members)
 
-    def get_beerclub_balance(self):
+    async def get_beerclub_balance(self):
         "Get the current balance for the Beer Club account (i.e. payments)."
-        result = list(self.db.view('event/payment', group=False))
-        if result:
-            return result[0].value
-        else:
-            return 0
+        if cache.balances.loaded:
+            return cache.balances.beerclub_balance
+        return await utils.get_beerclub_balance_async(self.db)
 
-    def get_count(self, member, date=None):
+    async def get_count(self, member, date=None):
         "Get the number of beverages purchased on the given date."
-        if date is None:
-            date = utils.today()
-        result = list(self.db.view('event/beverage',
-                                   key=[member['email'], date],
-                                   group_level=2))
-        if result:
-            return result[0].value
-        else:
-            return 0
+        return await utils.get_count_async(self.db, member, date=date)
 
-    def get_current_user(self):
+    async def get_current_member(self):
         """Get the currently logged-in user member, or None.
-        This overrides a tornado function, otherwise it should have
-        been called 'get_current_member', since the term 'member'
-        is used in this code rather than 'user'."""
+        This replaces the tornado function 'get_current_user',
+        which cannot be a coroutine. It is called from 'prepare'.
+        """
         try:
-            user = self.get_current_user_session()
+            user = await self.get_current_user_session()
         except ValueError:
             try:
-                user = self.get_current_user_basic()
+                user = await self.get_current_user_basic()
             except ValueError:
                 try:
-                    user = self.get_current_user_api_key()
+                    user = await self.get_current_user_api_key()
                 except ValueError:
                     return None
-        self.create_snapshot(user)
         return user
 
-    def get_current_user_session(self):
+    async def get_current_user_session(self):
         """Get the current user from a secure login session cookie.
         Raise ValueError if no or erroneous authentication.
         """
+        value = self.get_cookie(constants.USER_COOKIE)
+        if not value: raise ValueError
+        # A recently verified session needs no decoding or member lookup.
+        try:
+            member = cache.sessions.get(value)
+        except KeyError:
+            pass
+        else:
+            logging.info("Session auth: %s", member['email'])
+            return member
         email = self.get_secure_cookie(
             constants.USER_COOKIE,
+            value=value,
             max_age_days=settings['LOGIN_SESSION_DAYS'])
         if not email: raise ValueError
         email = email.decode('utf-8')
         try:
-            member = self.get_member(email)
+            member = await self.get_member(email)
         except KeyError:
             raise ValueError
         # Disabled; must not be allowed to login.
-        if member.get('disabled'):
+        if member.get('status') == constants.DISABLED:
             logging.info("Session auth: DISABLED %s", member['email'])
             raise ValueError
         else:
             # Check if valid login session.
             if member.get('login') is None: raise ValueError
             # All fine.
+            cache.sessions.set(value, member)
             logging.info("Session auth: %s", member['email'])
             return member
 
-    def get_current_user_basic(self):
+    async def get_current_user_basic(self):
         """Get the current user by HTTP Basic authentication.
         This should be used only if the site is using TLS (SSL, https).
         Raise ValueError if no or erroneous authentication.
@@ -202,23 +389,32 @@ class RequestHandler(tornado.web.RequestHandler):
         try:
             auth = auth.split()
             if auth[0].lower() != 'basic': raise ValueError
-            auth = base64.b64decode(auth[1])
+            auth = base64.b64decode(auth[1]).decode('utf-8')
             email, password = auth.split(':', 1)
-            member = self.get_member(email)
-            print('given', utils.hashed_password(password))
-            print('stored', member.get('password'))
-            if utils.hashed_password(password) != member.get('password'):
+            member = await self.get_member(email)
+            if not await self.verify_password(member, password):
                 raise ValueError
-        except (IndexError, ValueError, TypeError):
+        except (IndexError, KeyError, ValueError, TypeError):
             raise ValueError
-        if member.get('disabled'):
+        if member.get('status') == constants.DISABLED:
             logging.info("Basic auth login: DISABLED %s", member['email'])
             raise ValueError
         else:
             logging.info("Basic auth login: %s", member['email'])
             return member
 
-    def get_current_user_api_key(self):
+    async def verify_password(self, member, password):
+        """Does the password match that of the member? The hashing runs in
+        an executor, and is skipped if the password was recently verified.
+        """
+        if cache.credentials.check(member, password): return True
+        if not await utils.verify_password_async(password,
+                                                 member.get('password')):
+            return False
+        cache.credentials.set(member, password)
+        return True
+
+    async def get_current_user_api_key(self):
         """Get the current user by API key authentication.
         Raise ValueError if no or erroneous authentication.
         """
@@ -228,9 +424,13 @@ class RequestHandler(tornado.web.RequestHandler):
             raise ValueError
         else:
             try:
-                member = self.get_doc(api_key, 'member/api_key')
+                member = cache.members.get_by_api_key(api_key)
             except KeyError:
-                raise ValueError
+                try:
+                    member = await self.get_doc(api_key, 'member/api_key')
+                except KeyError:
+                    raise ValueError
+                cache.members.update(member)
             if member.get('status') != constants.ENABLED:
                 logging.info("API key login: NOT ENABLED %s", member['email'])
                 raise ValueError
@@ -248,22 +448,94 @@ class RequestHandler(tornado.web.RequestHandler):
         if not self.is_admin():
             raise tornado.web.HTTPError(403, reason="Role 'admin' is required")
 
-    def create_snapshot(self, user):
-        "Create snapshot if not done today."
-        # The snapshot is of the state of things the day before.
-        date = utils.today(-1)
+
+class CachedPageMixin(object):
+    """Mixin for read-only pages and exports. Before any view is queried,
+    a conditional GET is answered by 304 Not Modified if the database has
+    not changed, or else the body rendered for the same request is reused
+    if available. Not done if there are flash messages to display.
+    """
+
+    page_key = None
+
+    async def prepare(self):
+        await super().prepare()
+        if not self.current_user: return
+        if self.get_cookie('error') or self.get_cookie('message'): return
+        # The XSRF token in the forms of the page depends on the cookie.
+        xsrf = self.get_cookie('_xsrf')
+        if not xsrf: return
+        version = changes.get_version()
+        if version is None: return
+        key = (self.request.uri,
+               self.current_user['email'],
+               self.current_user['role'],
+               xsrf)
+        # The default date interval depends on today's date.
+        data = repr((version, utils.today(), key)).encode('utf-8')
+        etag = '"%s"' % hashlib.sha1(data).hexdigest()
+        self.set_header('Etag', etag)
+        if self.check_etag_header():
+            cache.pages.counters['not_modified'] += 1
+            self.set_status(304)
+            self.finish()
+            return
         try:
-            self.get_doc(date, 'snapshot/date')
+            headers, body = cache.pages.get(key, etag)
         except KeyError:
-            # Explicit member is required to avoid infinite recursion.
-            with SnapshotSaver(rqh=self, member=user) as saver:
-                saver['date'] = date
-                saver['beerclub_balance'] = self.get_beerclub_balance()
-                saver['members_balance'] = self.get_balance()
-                counts = dict([(s, 0) for s in constants.STATUSES])
-                for row in self.db.view('member/status'):
-                    counts[row.key] += 1
-                saver['member_counts'] = counts
+            self.page_key = key
+            self.page_etag = etag
+            self.page_chunks = []
+            self.page_size = 0
+        else:
+            for name, value in headers:
+                self.set_header(name, value)
+            self.finish(body)
+
+    def write(self, chunk):
+        "Keep a copy of the output, unless it is too large."
+        super().write(chunk)
+        if self.page_key is None: return
+        # The same conversion to bytes as done by 'write' itself.
+        if isinstance(chunk, dict):
+            chunk = tornado.escape.json_encode(chunk)
+        chunk = tornado.escape.utf8(chunk)
+        self.page_chunks.append(chunk)
+        self.page_size += len(chunk)
+        if self.page_size > settings['PAGE_CACHE_MAX_BODY']:
+            self.page_key = None
+            self.page_chunks = None
+
+    def on_finish(self):
+        "Store the output, if complete and successful."
+        super().on_finish()
+        if self.page_key is None or self.get_status() != 200: return
+        headers = [(name, self._headers[name])
+                   for name in ('Content-Type', 'Content-Disposition')
+                   if name in self._headers]
+        cache.pages.set(self.page_key, self.page_etag, headers,
+                        b''.join(self.page_chunks))
+
+
+class CsvMixin(object):
+    "Mixin for CSV output, sent to the client in chunks."
+
+    def start_csv(self, filename, row):
+        """Set the headers for the CSV file, and write the header row.
+        If a filename is given, the file is sent as an attachment.
+        """
+        self.set_header('Content-Type', constants.CSV_MIME)
+        if filename:
+            self.set_header('Content-Disposition',
+                            'attachment; filename="%s"' % filename)
+        self.write_csv([row])
+
+    def write_csv(self, rows):
+        "Write the rows in CSV format to the output buffer."
+        csvbuffer = StringIO()
+        writer = csv.writer(csvbuffer)
+        writer.writerows(rows)
+        self.write(csvbuffer.getvalue())
 
 
 class ApiMixin(object):
@@ -5,7 +5,9 @@ import logging
 import couchdb
 import tornado.web
 
+from beerclub import changes
 from beerclub import constants
+from beerclub import metrics
 from beerclub import utils
 
 
@@ -42,9 +44,31 @@ class Saver(object):
     def __exit__(self, type, value, tb):
         if type is not None: return False # No exceptions handled here.
         self.finalize()
-        self.db.save(self.doc)
+        self.save()
+        changes.notify(self.doc)
         self.post_process()
 
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, type, value, tb):
+        "Coroutine version of '__exit__'; the save does not block the IOLoop."
+        if type is not None: return False # No exceptions handled here.
+        self.finalize()
+        await utils.run_async(self.save)
+        changes.notify(self.doc)
+        self.post_process()
+
+    @classmethod
+    def bulk(cls, rqh=None, db=None, member=None):
+        "Return a context manager saving several documents in one request."
+        return BulkSaver(cls, rqh=rqh, db=db, member=member)
+
+    def save(self):
+        "Save the document, recording the time taken."
+        with metrics.database.timer('save', self.doctype, id=self.doc['_id']):
+            self.db.save(self.doc)
+
     def __setitem__(self, key, value):
         "Update the key/value pair."
         try:
@@ -113,3 +137,70 @@ class Saver(object):
     def post_process(self):
         "Perform any actions after having saved the document."
         pass
+
+
+class BulkSaver(object):
+    """Context manager saving several documents in one bulk request.
+    Each document is set via a saver instance obtained from 'new'.
+    Nothing is saved if an exception is raised within the block.
+    The documents which could not be saved are listed in 'errors'.
+    """
+
+    def __init__(self, saver_class, rqh=None, db=None, member=None):
+        self.saver_class = saver_class
+        self.rqh = rqh
+        if rqh is not None:
+            self.db = rqh.db
+        elif db is not None:
+            self.db = db
+        else:
+            raise AttributeError('neither db nor rqh given')
+        self.member = member
+        self.savers = []
+        self.errors = []        # Tuples (document id, error).
+
+    def new(self, doc=None):
+        "Return a saver for a new or the given document."
+        saver = self.saver_class(doc=doc, rqh=self.rqh, db=self.db,
+                                 member=self.member)
+        self.savers.append(saver)
+        return saver
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, tb):
+        if type is not None: return False # No exceptions handled here.
+        self.process(self.update(self.finalize()))
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, type, value, tb):
+        "Coroutine version of '__exit__'; the save does not block the IOLoop."
+        if type is not None: return False # No exceptions handled here.
+        docs = self.finalize()
+        self.process(await utils.run_async(self.update, docs))
+
+    def finalize(self):
+        "Finalize all documents, and return them."
+        for saver in self.savers:
+            saver.finalize()
+        return [saver.doc for saver in self.savers]
+
+    def update(self, docs):
+        "Save the documents in one request; return the results."
+        if not docs: return []
+        with metrics.database.timer('bulk', self.saver_class.doctype,
+                                    docs=len(docs)):
+            return self.db.update(docs)
+
+    def process(self, results):
+        "Notify and post-process each saved document; record the failures."
+        for saver, (success, docid, rev) in zip(self.savers, results):
+            if success:
+                changes.notify(saver.doc)
+                saver.post_process()
+            else:
+                self.errors.append((docid, rev))
+                logging.error("bulk save %s: %s", docid, rev)
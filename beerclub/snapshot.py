@@ -0,0 +1,140 @@
+"""Create the daily snapshots of the balances and member counts.
+
+Run periodically by the web server, or as a separate worker from
+the command line (e.g. by cron). It is safe to run in several processes
+at the same time, since the snapshot document id is given by its date.
+Days that were missed are backfilled.
+"""
+
+import argparse
+import datetime
+import logging
+
+import couchdb
+
+from beerclub import constants
+from beerclub import settings
+from beerclub import utils
+from beerclub.saver import Saver
+
+
+class SnapshotSaver(Saver):
+    doctype = constants.SNAPSHOT
+
+
+def create_snapshots(db, until=None):
+    """Create the snapshots for the days since the latest snapshot, up to
+    and including the given date, by default yesterday.
+    Return the number of snapshots created.
+    """
+    count = 0
+    for date in get_dates(db, until=until):
+        if create_snapshot(db, date):
+            count += 1
+    return count
+
+def get_dates(db, until=None):
+    """Return the dates of the missing snapshots since the latest snapshot,
+    up to and including the given date, by default yesterday. If there is
+    no snapshot at all, then only the given date.
+    At most 'SNAPSHOT_BACKFILL_DAYS' days are backfilled.
+    """
+    if until is None:
+        until = utils.today(-1)
+    until = datetime.date.fromisoformat(until)
+    latest = list(db.view('snapshot/date', descending=True, limit=1))
+    if latest:
+        date = datetime.date.fromisoformat(latest[0].key)
+        date += datetime.timedelta(days=1)
+    else:
+        date = until
+    date = max(date,
+               until - datetime.timedelta(
+                   days=settings['SNAPSHOT_BACKFILL_DAYS'] - 1))
+    result = []
+    while date <= until:
+        result.append(date.isoformat())
+        date += datetime.timedelta(days=1)
+    return result
+
+def create_snapshot(db, date):
+    """Create the snapshot of the state at the end of the given date.
+    Return False if it already exists, e.g. created by another process.
+    """
+    values = get_values(db, date)
+    if values is None: return False
+    try:
+        with SnapshotSaver(doc=get_doc(date), db=db) as saver:
+            for key, value in values.items():
+                saver[key] = value
+    except couchdb.http.ResourceConflict:
+        return False
+    logging.info("created snapshot %s", date)
+    return True
+
+async def create_snapshot_async(db, date):
+    """Coroutine version of 'create_snapshot'; the change notification
+    is made in the IOLoop thread.
+    """
+    values = await utils.run_async(get_values, db, date)
+    if values is None: return False
+    try:
+        async with SnapshotSaver(doc=get_doc(date), db=db) as saver:
+            for key, value in values.items():
+                saver[key] = value
+    except couchdb.http.ResourceConflict:
+        return False
+    logging.info("created snapshot %s", date)
+    return True
+
+def get_doc(date):
+    "Return a new snapshot document for the date."
+    return {'_id': "snapshot_%s" % date,
+            constants.DOCTYPE: constants.SNAPSHOT}
+
+def get_values(db, date):
+    """Return the values for the snapshot of the state at the end of
+    the given date, or None if the snapshot already exists.
+    The member counts are those at the time of creation, since
+    the history of member status is not recorded.
+    """
+    if list(db.view('snapshot/date', key=date, limit=1)):
+        return None
+    last = date + constants.CEILING
+    counts = dict([(s, 0) for s in constants.STATUSES])
+    for row in db.view('member/status'):
+        counts[row.key] += 1
+    return dict(date=date,
+                beerclub_balance=get_sum(db, 'event/payment', last),
+                members_balance=get_sum(db, 'event/balance', last),
+                member_counts=counts)
+
+def get_sum(db, viewname, last):
+    "Get the sum of the values in the view up to and including the key."
+    result = list(db.view(viewname, endkey=last, group=False))
+    if result:
+        return result[0].value
+    else:
+        return 0
+
+async def run(db):
+    "Create any missing snapshots; for the periodic callback of the server."
+    try:
+        for date in await utils.run_async(get_dates, db):
+            await create_snapshot_async(db, date)
+    except Exception as error:
+        logging.error("snapshot creation: %s", error)
+
+
+if __name__ == '__main__':
+    utils.setup()
+    utils.initialize()
+    parser = argparse.ArgumentParser(
+        description='Create the missing daily snapshots.')
+    parser.add_argument('-u', '--until', metavar='DATE',
+                        action='store', dest='until',
+                        help='The last date to create a snapshot for;'
+                        ' default yesterday.')
+    args = parser.parse_args()
+    print('created', create_snapshots(utils.get_db(), until=args.until),
+          'snapshots')
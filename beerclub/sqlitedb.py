@@ -0,0 +1,558 @@
+"""SQLite storage backend, for small deployments and for fast tests.
+
+The storage backend interface is the subset of the 'couchdb.Database'
+interface used by BeerClub, as also implemented by the in-memory
+stand-in in the module 'standin':
+
+- 'db[docid]', 'db.get(docid)', 'docid in db', 'len(db)', 'db.info()'
+- 'db.save(doc)', 'db.update(docs)', 'db.delete(doc)', raising
+  'couchdb.http.ResourceConflict' for a stale revision, and
+  'couchdb.http.ResourceNotFound' for a missing document
+- 'db.put_attachment(...)', 'db.get_attachment(...)'
+- 'db.view(name, **options)' for the views in 'designs.DESIGNS' and
+  '_all_docs', with the CouchDB view options, including the reduce
+  functions '_sum', '_count' and '_stats'
+- 'db.changes(**options)', including the long poll feed
+
+Select this backend by setting 'DATABASE_BACKEND' to 'sqlite'.
+
+The view rows are stored in a table of their own, keyed by the view name,
+the encoded view key and the document id, so that a view query is a range
+scan of its primary key. This gives the indexes for member email, Swish
+number and API key, and for event member and timestamp, timestamp and
+date, since those are the keys of the views. The rows of all views are
+updated in the same transaction as the document; a view is rebuilt when
+its map function has changed.
+
+The map functions are translated into Python as for the stand-in, and
+the view keys are collated in the same way.
+"""
+
+import base64
+import copy
+import io
+import json
+import sqlite3
+import struct
+import threading
+import time
+import uuid
+
+import couchdb
+
+from beerclub import collation
+from beerclub import designs
+from beerclub import standin
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS docs (
+  id TEXT PRIMARY KEY,
+  rev TEXT NOT NULL,
+  doc TEXT NOT NULL) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS attachments (
+  docid TEXT NOT NULL,
+  filename TEXT NOT NULL,
+  data BLOB NOT NULL,
+  PRIMARY KEY (docid, filename)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS changes (
+  seq INTEGER PRIMARY KEY AUTOINCREMENT,
+  docid TEXT UNIQUE NOT NULL,
+  rev TEXT NOT NULL,
+  deleted INTEGER NOT NULL);
+CREATE TABLE IF NOT EXISTS views (
+  name TEXT PRIMARY KEY,
+  map TEXT NOT NULL) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS rows (
+  view TEXT NOT NULL,
+  key BLOB NOT NULL,
+  docid TEXT NOT NULL,
+  n INTEGER NOT NULL,
+  keyjson TEXT NOT NULL,
+  value TEXT NOT NULL,
+  number,
+  PRIMARY KEY (view, key, docid, n)) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS rows_docid ON rows (docid);
+"""
+
+BUSY_TIMEOUT = 30.0             # Seconds to wait for a lock on the file.
+POLL_INTERVAL = 1.0             # Seconds between checks in a long poll.
+
+
+def encode_key(value):
+    """Encode the view key as bytes, such that the byte order is
+    the collation order of the stand-in.
+    """
+    if value is None:
+        return b'a'
+    elif value is False:
+        return b'b'
+    elif value is True:
+        return b'c'
+    elif isinstance(value, (int, float)):
+        data = bytearray(struct.pack('>d', float(value) + 0.0))
+        if data[0] & 0x80:
+            data = bytearray([~b & 0xff for b in data])
+        else:
+            data[0] |= 0x80
+        return b'd' + bytes(data)
+    elif isinstance(value, str):
+        result = [b'e']
+        for c in value:
+            kind, lower, upper = collation.char_key(c)
+            result.append(b'%i%s%i' % (kind+1, lower.encode('utf-8'), upper))
+        result.append(b'\x00')
+        return b''.join(result)
+    elif isinstance(value, (list, tuple)):
+        return b'f' + b''.join([encode_key(v) for v in value]) + b'\x00'
+    elif isinstance(value, dict):
+        return b'g' + b''.join([encode_key(k) + encode_key(v)
+                                for k, v in value.items()]) + b'\x00'
+    raise TypeError("cannot collate %r" % value)
+
+def get_number(value):
+    "Return the value if it is a number, for the reduce functions."
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return value
+    return None
+
+
+class Database(object):
+    "SQLite database with the interface of 'couchdb.Database'."
+
+    def __init__(self, filepath, name='beerclub', designs=designs.DESIGNS):
+        self.filepath = filepath
+        self.name = name
+        self.local = threading.local()
+        self.condition = threading.Condition()
+        self.views = {}
+        self.sources = {}
+        for design, views in designs.items():
+            for view, definition in views.items():
+                viewname = "%s/%s" % (design, view)
+                self.views[viewname] = standin.View(
+                    standin.translate_map(definition['map']),
+                    definition.get('reduce'))
+                self.sources[viewname] = definition['map']
+        cnx = self.cnx
+        cnx.executescript(SCHEMA)
+        self.build_views()
+
+    @property
+    def cnx(self):
+        "The connection for the current thread."
+        try:
+            return self.local.cnx
+        except AttributeError:
+            cnx = sqlite3.connect(self.filepath,
+                                  timeout=BUSY_TIMEOUT,
+                                  isolation_level=None,
+                                  check_same_thread=False)
+            cnx.execute('PRAGMA journal_mode=WAL')
+            cnx.execute('PRAGMA synchronous=NORMAL')
+            self.local.cnx = cnx
+            return cnx
+
+    def build_views(self):
+        "Build the rows of the views that are new or have been changed."
+        cnx = self.cnx
+        cnx.execute('BEGIN IMMEDIATE')
+        try:
+            stored = dict(cnx.execute('SELECT name, map FROM views'))
+            changed = [name for name in self.views
+                       if stored.get(name) != self.sources[name]]
+            for name in set(stored).difference(self.views):
+                cnx.execute('DELETE FROM rows WHERE view=?', (name,))
+                cnx.execute('DELETE FROM views WHERE name=?', (name,))
+            for name in changed:
+                cnx.execute('DELETE FROM rows WHERE view=?', (name,))
+                for docid, data in cnx.execute('SELECT id, doc FROM docs')\
+                                      .fetchall():
+                    self.insert_rows(name, docid, json.loads(data))
+                cnx.execute('INSERT OR REPLACE INTO views (name, map)'
+                            ' VALUES (?, ?)', (name, self.sources[name]))
+        except:
+            cnx.execute('ROLLBACK')
+            raise
+        else:
+            cnx.execute('COMMIT')
+
+    def insert_rows(self, name, docid, doc):
+        "Insert the rows emitted by the document into the named view."
+        self.cnx.executemany(
+            'INSERT INTO rows (view, key, docid, n, keyjson, value, number)'
+            ' VALUES (?, ?, ?, ?, ?, ?, ?)',
+            [(name, encode_key(row[3]), docid, row[2],
+              json.dumps(row[3]), json.dumps(row[4]), get_number(row[4]))
+             for row in self.views[name].map(docid, doc)])
+
+    def __contains__(self, docid):
+        return self.cnx.execute('SELECT 1 FROM docs WHERE id=?',
+                                (docid,)).fetchone() is not None
+
+    def __iter__(self):
+        return iter([r[0] for r in
+                     self.cnx.execute('SELECT id FROM docs ORDER BY id')])
+
+    def __len__(self):
+        return self.cnx.execute('SELECT COUNT(*) FROM docs').fetchone()[0]
+
+    def __getitem__(self, docid):
+        doc = self.get_doc(docid, {})
+        if doc is None:
+            raise couchdb.http.ResourceNotFound(('not_found', 'missing'))
+        return couchdb.Document(doc)
+
+    def get(self, docid, default=None):
+        try:
+            return self[docid]
+        except couchdb.http.ResourceNotFound:
+            return default
+
+    def info(self):
+        return dict(db_name=self.name,
+                    doc_count=len(self),
+                    update_seq=self.get_update_seq())
+
+    def get_update_seq(self):
+        "Return the sequence number of the latest change."
+        return self.cnx.execute('SELECT COALESCE(MAX(seq), 0) FROM changes')\
+                       .fetchone()[0]
+
+    def store(self, doc):
+        """Store the document, and set its new revision.
+        Raise ResourceConflict if the revision is not the current one.
+        Must be called within a transaction.
+        """
+        cnx = self.cnx
+        docid = doc.get('_id') or uuid.uuid4().hex
+        row = cnx.execute('SELECT rev, doc FROM docs WHERE id=?',
+                          (docid,)).fetchone()
+        if row is not None:
+            if doc.get('_rev') != row[0]:
+                raise couchdb.http.ResourceConflict(
+                    ('conflict', 'Document update conflict.'))
+            generation = int(row[0].split('-')[0]) + 1
+        elif doc.get('_rev'):
+            raise couchdb.http.ResourceConflict(
+                ('conflict', 'Document update conflict.'))
+        else:
+            generation = 1
+        doc['_id'] = docid
+        doc['_rev'] = "%i-%s" % (generation, uuid.uuid4().hex)
+        cnx.execute('DELETE FROM rows WHERE docid=?', (docid,))
+        if doc.get('_deleted'):
+            cnx.execute('DELETE FROM docs WHERE id=?', (docid,))
+            cnx.execute('DELETE FROM attachments WHERE docid=?', (docid,))
+        else:
+            stored = copy.deepcopy(doc)
+            attachments = stored.get('_attachments')
+            if attachments is None:
+                if row is not None:
+                    current = json.loads(row[1]).get('_attachments')
+                    if current:
+                        stored['_attachments'] = current
+            else:
+                for filename, attachment in attachments.items():
+                    if 'data' not in attachment: continue
+                    data = base64.b64decode(attachment.pop('data'))
+                    cnx.execute('INSERT OR REPLACE INTO attachments'
+                                ' (docid, filename, data) VALUES (?, ?, ?)',
+                                (docid, filename, data))
+                    attachment['length'] = len(data)
+                    attachment['stub'] = True
+            cnx.execute('INSERT OR REPLACE INTO docs (id, rev, doc)'
+                        ' VALUES (?, ?, ?)',
+                        (docid, doc['_rev'], json.dumps(stored)))
+            for name in self.views:
+                self.insert_rows(name, docid, stored)
+        cnx.execute('DELETE FROM changes WHERE docid=?', (docid,))
+        cnx.execute('INSERT INTO changes (docid, rev, deleted)'
+                    ' VALUES (?, ?, ?)',
+                    (docid, doc['_rev'], int(bool(doc.get('_deleted')))))
+        return doc['_rev']
+
+    def transaction(self, function, *args):
+        "Call the function within a write transaction; notify of changes."
+        cnx = self.cnx
+        cnx.execute('BEGIN IMMEDIATE')
+        try:
+            result = function(*args)
+        except:
+            cnx.execute('ROLLBACK')
+            raise
+        cnx.execute('COMMIT')
+        with self.condition:
+            self.condition.notify_all()
+        return result
+
+    def save(self, doc, **options):
+        rev = self.transaction(self.store, doc)
+        return doc['_id'], rev
+
+    def update(self, documents, **options):
+        def store_all():
+            results = []
+            for doc in documents:
+                try:
+                    rev = self.store(doc)
+                except couchdb.http.ResourceConflict as error:
+                    results.append((False, doc.get('_id'), error))
+                else:
+                    results.append((True, doc['_id'], rev))
+            return results
+        return self.transaction(store_all)
+
+    def delete(self, doc):
+        if doc['_id'] not in self:
+            raise couchdb.http.ResourceNotFound(('not_found', 'missing'))
+        self.save(dict(_id=doc['_id'], _rev=doc['_rev'], _deleted=True))
+
+    def put_attachment(self, doc, content, filename=None, content_type=None):
+        if hasattr(content, 'read'):
+            content = content.read()
+        if isinstance(content, str):
+            content = content.encode('utf-8')
+        def store_attachment():
+            stored = self.get_doc(doc['_id'], {})
+            if stored is None:
+                raise couchdb.http.ResourceNotFound(('not_found', 'missing'))
+            stored['_rev'] = doc.get('_rev')
+            attachments = stored.setdefault('_attachments', {})
+            attachments[filename] = dict(
+                content_type=content_type,
+                data=base64.b64encode(content).decode('ascii'))
+            return self.store(stored)
+        doc['_rev'] = self.transaction(store_attachment)
+
+    def get_attachment(self, id_or_doc, filename, default=None):
+        if isinstance(id_or_doc, dict):
+            docid = id_or_doc['_id']
+        else:
+            docid = id_or_doc
+        row = self.cnx.execute('SELECT data FROM attachments'
+                               ' WHERE docid=? AND filename=?',
+                               (docid, filename)).fetchone()
+        if row is None:
+            return default
+        return io.BytesIO(row[0])
+
+    def get_doc(self, docid, options, data=None):
+        """Return the document, given its stored data if already fetched;
+        the attachments as stubs unless asked for.
+        """
+        if data is None:
+            row = self.cnx.execute('SELECT doc FROM docs WHERE id=?',
+                                   (docid,)).fetchone()
+            if row is None: return None
+            data = row[0]
+        doc = json.loads(data)
+        if options.get('attachments') in (True, 'true'):
+            for filename, attachment in doc.get('_attachments', {}).items():
+                content = self.cnx.execute(
+                    'SELECT data FROM attachments WHERE docid=? AND filename=?',
+                    (docid, filename)).fetchone()
+                if content is None: continue
+                attachment.pop('stub', None)
+                attachment['data'] = base64.b64encode(content[0])\
+                                           .decode('ascii')
+        return doc
+
+    def changes(self, **options):
+        since = int(options.get('since') or 0)
+        limit = options.get('limit')
+        sql = 'SELECT seq, docid, rev, deleted FROM changes WHERE seq>?' \
+              ' ORDER BY seq'
+        params = [since]
+        if limit:
+            sql += ' LIMIT ?'
+            params.append(int(limit))
+        rows = self.cnx.execute(sql, params).fetchall()
+        if not rows and options.get('feed') == 'longpoll':
+            # Also wait for changes made by other processes.
+            timeout = int(options.get('timeout', 60000)) / 1000.0
+            deadline = time.monotonic() + timeout
+            while not rows and time.monotonic() < deadline:
+                with self.condition:
+                    self.condition.wait(min(POLL_INTERVAL,
+                                            deadline - time.monotonic()))
+                rows = self.cnx.execute(sql, params).fetchall()
+        results = []
+        for seq, docid, rev, deleted in rows:
+            change = dict(seq=seq, id=docid, changes=[dict(rev=rev)])
+            if deleted:
+                change['deleted'] = True
+            if options.get('include_docs') in (True, 'true'):
+                if deleted:
+                    change['doc'] = dict(_id=docid, _rev=rev, _deleted=True)
+                else:
+                    change['doc'] = self.get_doc(docid, options)
+            results.append(change)
+        if results and limit:
+            last_seq = results[-1]['seq']
+        else:
+            last_seq = max(self.get_update_seq(), since)
+        return dict(results=results, last_seq=last_seq)
+
+    def view(self, name, wrapper=None, **options):
+        return standin.ViewResults(self, name, options)
+
+    def query(self, name, options):
+        "Return the rows of the named view or '_all_docs' for the options."
+        if name == '_all_docs':
+            return self.query_all_docs(options)
+        view = self.views[name]
+        reduce = view.reduce
+        if options.get('reduce') in (False, 'false'):
+            reduce = None
+        descending = options.get('descending', False)
+        if 'keys' in options:
+            selects = [(['key=?'], [encode_key(k)]) for k in options['keys']]
+        elif 'key' in options:
+            selects = [(['key=?'], [encode_key(options['key'])])]
+        else:
+            selects = [self.get_range(options, encode_key)]
+        grouped = options.get('group') in (True, 'true') or \
+                  'group_level' in options
+        if reduce and not grouped and 'keys' not in options:
+            return self.reduce(name, reduce, *selects[0])
+        if descending:
+            order = ' ORDER BY key DESC, docid DESC, n DESC'
+        else:
+            order = ' ORDER BY key, docid, n'
+        result = []
+        for where, params in selects:
+            sql = 'SELECT rows.docid, keyjson, value'
+            if options.get('include_docs'):
+                sql += ', docs.doc FROM rows LEFT JOIN docs' \
+                       ' ON docs.id=rows.docid'
+            else:
+                sql += ', NULL FROM rows'
+            sql += ' WHERE ' + ' AND '.join(['view=?'] + where) + order
+            params = [name] + params
+            if not reduce and len(selects) == 1:
+                sql += ' LIMIT ? OFFSET ?'
+                limit = options.get('limit')
+                params.extend([-1 if limit is None else limit,
+                               options.get('skip', 0)])
+            for docid, keyjson, value, data in self.cnx.execute(sql, params):
+                row = dict(id=docid,
+                           key=json.loads(keyjson),
+                           value=json.loads(value))
+                if options.get('include_docs'):
+                    if data is None:
+                        row['doc'] = None
+                    else:
+                        row['doc'] = self.get_doc(docid, options, data)
+                result.append(row)
+        if reduce:
+            return standin.reduce_rows([(r['key'], r['value']) for r in result],
+                                       reduce, options)
+        if len(selects) > 1:
+            skip = options.get('skip', 0)
+            limit = options.get('limit')
+            if limit is None:
+                result = result[skip:]
+            else:
+                result = result[skip:skip+limit]
+        return [couchdb.client.Row(row) for row in result]
+
+    def query_all_docs(self, options):
+        "Return the rows of '_all_docs' for the options."
+        if 'keys' in options:
+            result = []
+            for key in options['keys']:
+                row = self.cnx.execute('SELECT rev, doc FROM docs WHERE id=?',
+                                       (key,)).fetchone()
+                if row is None:
+                    result.append(couchdb.client.Row(dict(key=key,
+                                                          error='not_found')))
+                    continue
+                item = dict(id=key, key=key, value=dict(rev=row[0]))
+                if options.get('include_docs'):
+                    item['doc'] = self.get_doc(key, options, row[1])
+                result.append(couchdb.client.Row(item))
+            return result
+        if 'key' in options:
+            where, params = ['id=?'], [options['key']]
+        else:
+            where, params = self.get_range(options, str, column='id')
+        sql = 'SELECT id, rev, doc FROM docs'
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        if options.get('descending'):
+            sql += ' ORDER BY id DESC'
+        else:
+            sql += ' ORDER BY id'
+        sql += ' LIMIT ? OFFSET ?'
+        limit = options.get('limit')
+        params.extend([-1 if limit is None else limit, options.get('skip', 0)])
+        result = []
+        for docid, rev, data in self.cnx.execute(sql, params):
+            item = dict(id=docid, key=docid, value=dict(rev=rev))
+            if options.get('include_docs'):
+                item['doc'] = self.get_doc(docid, options, data)
+            result.append(couchdb.client.Row(item))
+        return result
+
+    def get_range(self, options, encode, column='key'):
+        """Return the SQL conditions and parameters for the range given
+        by the options. The same semantics as 'standin.select_range'.
+        """
+        descending = options.get('descending', False)
+        if 'startkey' in options:
+            start = (encode(options['startkey']),
+                     options.get('startkey_docid'))
+        else:
+            start = None
+        if 'endkey' in options:
+            end = (encode(options['endkey']), options.get('endkey_docid'))
+        else:
+            end = None
+        inclusive_end = options.get('inclusive_end', True)
+        if descending:
+            start, end = end, start
+        where = []
+        params = []
+        # A tie-breaking document id only applies to the views.
+        if start is None:
+            pass
+        elif start[1] is not None and column == 'key':
+            where.append('(key, docid) >= (?, ?)')
+            params.extend(start)
+        elif descending and not inclusive_end:
+            where.append("%s>?" % column)
+            params.append(start[0])
+        else:
+            where.append("%s>=?" % column)
+            params.append(start[0])
+        if end is None:
+            pass
+        elif end[1] is not None and column == 'key':
+            where.append('(key, docid) <= (?, ?)')
+            params.extend(end)
+        elif not descending and not inclusive_end:
+            where.append("%s<?" % column)
+            params.append(end[0])
+        else:
+            where.append("%s<=?" % column)
+            params.append(end[0])
+        return where, params
+
+    def reduce(self, name, reduce, where, params):
+        "Return the ungrouped reduce of the rows, computed by SQLite."
+        sql = 'SELECT COUNT(*), SUM(number), MIN(number), MAX(number),' \
+              ' SUM(number*number) FROM rows WHERE ' + \
+              ' AND '.join(['view=?'] + where)
+        count, total, low, high, sumsqr = self.cnx.execute(
+            sql, [name] + params).fetchone()
+        if not count: return []
+        if reduce == '_sum':
+            value = total
+        elif reduce == '_count':
+            value = count
+        elif reduce == '_stats':
+            value = dict(sum=total, count=count, min=low, max=high,
+                         sumsqr=sumsqr)
+        else:
+            raise ValueError("reduce function %s not supported" % reduce)
+        return [couchdb.client.Row(dict(key=None, value=value))]
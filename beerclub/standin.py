@@ -0,0 +1,490 @@
+"""In-memory stand-in for a CouchDB database, for benchmarks and tests.
+
+Implements the subset of the 'couchdb.Database' interface used by BeerClub.
+The views in 'designs.DESIGNS' are evaluated by translating their simple
+JavaScript map functions into Python; only the statements 'if (...) return;'
+and 'emit(...);' are allowed, and the functions 'Date.parse' and 'isNaN'.
+The reduce functions may be any of the built-ins '_sum', '_count' and '_stats'.
+
+A view index is built when first queried, and is then updated for each
+saved document. CouchDB collation is approximated, as in 'collation'.
+"""
+
+import base64
+import bisect
+import copy
+import datetime
+import io
+import re
+import threading
+import uuid
+
+import couchdb
+
+from beerclub import designs
+from beerclub.collation import collation_key
+
+# Larger than any document id; for the bounds of a range of rows.
+MAX_DOCID = '\uffff'
+
+
+class JsObject(dict):
+    "Dictionary with JavaScript-like attribute access; undefined is None."
+
+    def __getattr__(self, name):
+        return js_wrap(self.get(name))
+
+
+class Date(object):
+    "The part of the JavaScript 'Date' object used by the map functions."
+
+    @staticmethod
+    def parse(value):
+        """Return milliseconds since the epoch for an ISO format timestamp.
+        Return NaN if it cannot be parsed.
+        """
+        try:
+            instant = datetime.datetime.strptime(value[:19],
+                                                 '%Y-%m-%dT%H:%M:%S')
+            millis = int(round(float('0' + value[19:].rstrip('Z')) * 1000))
+        except (TypeError, ValueError):
+            return float('nan')
+        seconds = (instant - datetime.datetime(1970, 1, 1)).total_seconds()
+        return int(seconds) * 1000 + millis
+
+
+def isNaN(value):
+    "The JavaScript function; the argument is a number."
+    return value != value
+
+
+JS_TOKENS = [(re.compile(r'!=='), '!='),
+             (re.compile(r'==='), '=='),
+             (re.compile(r'&&'), ' and '),
+             (re.compile(r'\|\|'), ' or '),
+             (re.compile(r'!(?!=)'), ' not '),
+             (re.compile(r'\bnull\b'), 'None'),
+             (re.compile(r'\btrue\b'), 'True'),
+             (re.compile(r'\bfalse\b'), 'False')]
+JS_FUNCTION = re.compile(r'^function\s*\(doc\)\s*\{(.*)\}$', re.S)
+JS_IF_RETURN = re.compile(r'^if\s*\((.*)\)\s*return\s*;$')
+JS_EMIT = re.compile(r'^emit\((.*)\)\s*;$')
+
+
+def js_wrap(value):
+    "Wrap a dictionary for JavaScript-like attribute access."
+    if isinstance(value, dict) and not isinstance(value, JsObject):
+        return JsObject(value)
+    return value
+
+def js_expression(expr):
+    "Translate a simple JavaScript expression into Python."
+    for regexp, replacement in JS_TOKENS:
+        expr = regexp.sub(replacement, expr)
+    return expr.strip()
+
+def translate_map(source):
+    """Translate a JavaScript map function into a Python function.
+    Raise ValueError if it cannot be translated.
+    """
+    match = JS_FUNCTION.match(source.strip())
+    if not match:
+        raise ValueError("cannot translate map function: %s" % source)
+    # A statement may continue over several lines, until its ';'.
+    statements = []
+    pending = ''
+    for line in match.group(1).split('\n'):
+        pending = (pending + ' ' + line.strip()).strip()
+        if pending.endswith(';'):
+            statements.append(pending)
+            pending = ''
+    lines = ['def map_function(doc, emit):', '  doc = js_wrap(doc)']
+    for statement in statements:
+        match = JS_IF_RETURN.match(statement)
+        if match:
+            lines.append("  if %s: return" % js_expression(match.group(1)))
+            continue
+        match = JS_EMIT.match(statement)
+        if match:
+            lines.append("  emit(%s)" % js_expression(match.group(1)))
+            continue
+        raise ValueError("cannot translate statement: %s" % statement)
+    namespace = dict(js_wrap=js_wrap, Date=Date, isNaN=isNaN)
+    exec('\n'.join(lines), namespace)
+    return namespace['map_function']
+
+def docid_key(docid):
+    "The '_all_docs' index is ordered by the raw document id."
+    return docid
+
+def reduce_values(reduce, values):
+    "Apply the built-in reduce function to the values."
+    if reduce == '_sum':
+        return sum(values)
+    elif reduce == '_count':
+        return len(values)
+    elif reduce == '_stats':
+        return dict(sum=sum(values),
+                    count=len(values),
+                    min=min(values),
+                    max=max(values),
+                    sumsqr=sum([v*v for v in values]))
+    raise ValueError("reduce function %s not supported" % reduce)
+
+def reduce_rows(rows, reduce, options):
+    """Return the reduced rows, grouped as given by the options.
+    The rows are tuples (key, value), in order.
+    """
+    if options.get('group') in (True, 'true'):
+        group_level = None
+    elif 'group_level' in options:
+        group_level = int(options['group_level'])
+    else:
+        if not rows: return []
+        return [couchdb.client.Row(dict(
+            key=None,
+            value=reduce_values(reduce, [r[1] for r in rows])))]
+    groups = []
+    for key, value in rows:
+        if group_level is not None and isinstance(key, list):
+            key = key[:group_level]
+        if groups and groups[-1][0] == key:
+            groups[-1][1].append(value)
+        else:
+            groups.append((key, [value]))
+    return [couchdb.client.Row(dict(key=k, value=reduce_values(reduce, v)))
+            for k, v in groups]
+
+
+class ViewResults(object):
+    "Lazy view result, supporting the slice notation of couchdb-python."
+
+    def __init__(self, db, name, options):
+        self.db = db
+        self.name = name
+        self.options = options
+
+    def __getitem__(self, key):
+        options = self.options.copy()
+        if type(key) is slice:
+            if key.start is not None:
+                options['startkey'] = key.start
+            if key.stop is not None:
+                options['endkey'] = key.stop
+        else:
+            options['key'] = key
+        return ViewResults(self.db, self.name, options)
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def __len__(self):
+        return len(self.rows)
+
+    @property
+    def rows(self):
+        return self.db.query(self.name, dict(self.options))
+
+
+class View(object):
+    """Index of a view: the rows (collation key, document id, number,
+    key, value) in sorted order, and the rows emitted by each document.
+    The number distinguishes several rows emitted by the same document.
+    """
+
+    def __init__(self, map_function, reduce):
+        self.map_function = map_function
+        self.reduce = reduce
+        self.rows = None        # Not built until first queried.
+        self.emitted = {}
+
+    def build(self, docs):
+        self.rows = []
+        self.emitted = {}
+        for docid, doc in docs.items():
+            self.emitted[docid] = self.map(docid, doc)
+            self.rows.extend(self.emitted[docid])
+        self.rows.sort()
+
+    def map(self, docid, doc):
+        """Return the rows emitted by the document. As in CouchDB,
+        a document for which the map function fails emits no rows.
+        """
+        result = []
+        if docid.startswith('_design/'): return result
+        emit = lambda key, value=None: result.append(
+            (collation_key(key), docid, len(result), key, value))
+        try:
+            self.map_function(doc, emit)
+        except Exception:
+            return []
+        return result
+
+    def update(self, docid, doc):
+        "Update the rows for the document, if built; None if deleted."
+        if self.rows is None: return
+        for row in self.emitted.pop(docid, []):
+            pos = bisect.bisect_left(self.rows, row[:3])
+            del self.rows[pos]
+        if doc is None: return
+        self.emitted[docid] = self.map(docid, doc)
+        for row in self.emitted[docid]:
+            bisect.insort(self.rows, row)
+
+
+class Database(object):
+    "In-memory stand-in for 'couchdb.Database'."
+
+    def __init__(self, name='beerclub', designs=designs.DESIGNS):
+        self.name = name
+        self.lock = threading.RLock()
+        self.condition = threading.Condition(self.lock)
+        self.docs = {}
+        self.seq = 0
+        self.changes_log = []   # Tuples (seq, docid, rev, deleted).
+        self.views = {}
+        for design, views in designs.items():
+            for view, definition in views.items():
+                self.views["%s/%s" % (design, view)] = \
+                    View(translate_map(definition['map']),
+                         definition.get('reduce'))
+
+    def __contains__(self, docid):
+        return docid in self.docs
+
+    def __iter__(self):
+        return iter(sorted(self.docs))
+
+    def __len__(self):
+        return len(self.docs)
+
+    def __getitem__(self, docid):
+        with self.lock:
+            try:
+                return couchdb.Document(copy.deepcopy(self.docs[docid]))
+            except KeyError:
+                raise couchdb.http.ResourceNotFound(('not_found', 'missing'))
+
+    def get(self, docid, default=None):
+        try:
+            return self[docid]
+        except couchdb.http.ResourceNotFound:
+            return default
+
+    def info(self):
+        return dict(db_name=self.name,
+                    doc_count=len(self.docs),
+                    update_seq=self.seq)
+
+    def store(self, doc):
+        """Store the document, and set its new revision.
+        Raise ResourceConflict if the revision is not the current one.
+        The lock must be held.
+        """
+        docid = doc.get('_id') or uuid.uuid4().hex
+        current = self.docs.get(docid)
+        if current is not None:
+            if doc.get('_rev') != current['_rev']:
+                raise couchdb.http.ResourceConflict(
+                    ('conflict', 'Document update conflict.'))
+            generation = int(current['_rev'].split('-')[0]) + 1
+        elif doc.get('_rev'):
+            raise couchdb.http.ResourceConflict(
+                ('conflict', 'Document update conflict.'))
+        else:
+            generation = 1
+        doc['_id'] = docid
+        doc['_rev'] = "%i-%s" % (generation, uuid.uuid4().hex)
+        if doc.get('_deleted'):
+            self.docs.pop(docid, None)
+            stored = None
+        else:
+            stored = copy.deepcopy(doc)
+            if current and '_attachments' in current:
+                stored.setdefault('_attachments', current['_attachments'])
+            self.docs[docid] = stored
+        for view in self.views.values():
+            view.update(docid, stored)
+        self.seq += 1
+        self.changes_log.append((self.seq, docid, doc['_rev'],
+                                 bool(doc.get('_deleted'))))
+        self.condition.notify_all()
+        return doc['_rev']
+
+    def save(self, doc, **options):
+        with self.lock:
+            rev = self.store(doc)
+            return doc['_id'], rev
+
+    def update(self, documents, **options):
+        results = []
+        with self.lock:
+            for doc in documents:
+                try:
+                    rev = self.store(doc)
+                except couchdb.http.ResourceConflict as error:
+                    results.append((False, doc.get('_id'), error))
+                else:
+                    results.append((True, doc['_id'], rev))
+        return results
+
+    def delete(self, doc):
+        with self.lock:
+            if doc['_id'] not in self.docs:
+                raise couchdb.http.ResourceNotFound(('not_found', 'missing'))
+            self.store(dict(_id=doc['_id'], _rev=doc['_rev'], _deleted=True))
+
+    def put_attachment(self, doc, content, filename=None, content_type=None):
+        if hasattr(content, 'read'):
+            content = content.read()
+        if isinstance(content, str):
+            content = content.encode('utf-8')
+        with self.lock:
+            stored = copy.deepcopy(self.docs[doc['_id']])
+            stored['_rev'] = doc.get('_rev')
+            attachments = stored.setdefault('_attachments', {})
+            attachments[filename] = dict(
+                content_type=content_type,
+                length=len(content),
+                data=base64.b64encode(content).decode('ascii'))
+            doc['_rev'] = self.store(stored)
+
+    def get_attachment(self, id_or_doc, filename, default=None):
+        if isinstance(id_or_doc, dict):
+            docid = id_or_doc['_id']
+        else:
+            docid = id_or_doc
+        try:
+            attachment = self.docs[docid]['_attachments'][filename]
+        except KeyError:
+            return default
+        return io.BytesIO(base64.b64decode(attachment['data']))
+
+    def changes(self, **options):
+        since = int(options.get('since') or 0)
+        with self.lock:
+            if options.get('feed') == 'longpoll' and self.seq <= since:
+                self.condition.wait(int(options.get('timeout', 60000))/1000.0)
+            latest = {}
+            for seq, docid, rev, deleted in self.changes_log:
+                if seq <= since: continue
+                latest.pop(docid, None) # Keep the order of the latest change.
+                latest[docid] = (seq, rev, deleted)
+            limit = options.get('limit')
+            results = []
+            for docid, (seq, rev, deleted) in latest.items():
+                if limit and len(results) >= int(limit): break
+                change = dict(seq=seq, id=docid, changes=[dict(rev=rev)])
+                if deleted:
+                    change['deleted'] = True
+                if options.get('include_docs') in (True, 'true'):
+                    if deleted:
+                        change['doc'] = dict(_id=docid, _rev=rev,
+                                             _deleted=True)
+                    else:
+                        change['doc'] = self.get_doc(docid, options)
+                results.append(change)
+            if results and limit:
+                last_seq = results[-1]['seq']
+            else:
+                last_seq = max(self.seq, since)
+            return dict(results=results, last_seq=last_seq)
+
+    def view(self, name, wrapper=None, **options):
+        return ViewResults(self, name, options)
+
+    def query(self, name, options):
+        "Return the rows of the named view or '_all_docs' for the options."
+        with self.lock:
+            if name == '_all_docs':
+                rows = [(docid, docid, 0, docid, dict(rev=doc['_rev']))
+                        for docid, doc in sorted(self.docs.items())]
+                reduce = None
+                keyfunc = docid_key
+            else:
+                view = self.views[name]
+                if view.rows is None:
+                    view.build(self.docs)
+                rows = view.rows
+                reduce = view.reduce
+                keyfunc = collation_key
+            if options.get('reduce') in (False, 'false'):
+                reduce = None
+            if 'keys' in options:
+                selected = []
+                for key in options['keys']:
+                    selected.extend(self.select(rows, keyfunc(key)))
+            elif 'key' in options:
+                selected = self.select(rows, keyfunc(options['key']))
+            else:
+                selected = self.select_range(rows, options, keyfunc)
+            if reduce:
+                return reduce_rows([(r[3], r[4]) for r in selected],
+                                   reduce, options)
+            skip = options.get('skip', 0)
+            limit = options.get('limit')
+            if limit is None:
+                selected = selected[skip:]
+            else:
+                selected = selected[skip:skip+limit]
+            result = []
+            for row in selected:
+                item = dict(id=row[1], key=row[3], value=row[4])
+                if options.get('include_docs'):
+                    item['doc'] = self.get_doc(row[1], options)
+                result.append(couchdb.client.Row(item))
+            return result
+
+    def get_doc(self, docid, options):
+        "Return a copy of the document; attachments as stubs unless asked for."
+        doc = self.docs.get(docid)
+        if doc is None: return None
+        doc = copy.deepcopy(doc)
+        if options.get('attachments') not in (True, 'true'):
+            for attachment in doc.get('_attachments', {}).values():
+                attachment.pop('data', None)
+                attachment['stub'] = True
+        return doc
+
+    def select(self, rows, ck):
+        "Return the rows having the collation key."
+        low = bisect.bisect_left(rows, (ck, ))
+        high = bisect.bisect_right(rows, (ck, MAX_DOCID))
+        return rows[low:high]
+
+    def select_range(self, rows, options, keyfunc):
+        "Return the rows in the range given by the options, in order."
+        descending = options.get('descending', False)
+        if 'startkey' in options:
+            start = (keyfunc(options['startkey']),
+                     options.get('startkey_docid'))
+        else:
+            start = None
+        if 'endkey' in options:
+            end = (keyfunc(options['endkey']), options.get('endkey_docid'))
+        else:
+            end = None
+        inclusive_end = options.get('inclusive_end', True)
+        if descending:
+            start, end = end, start
+        # The bounds in ascending order.
+        if start is None:
+            low = 0
+        elif start[1] is not None:
+            low = bisect.bisect_left(rows, start)
+        elif descending and not inclusive_end:
+            low = bisect.bisect_right(rows, (start[0], MAX_DOCID))
+        else:
+            low = bisect.bisect_left(rows, (start[0], ))
+        if end is None:
+            high = len(rows)
+        elif end[1] is not None:
+            high = bisect.bisect_right(rows, (end[0], end[1], float('inf')))
+        elif not descending and not inclusive_end:
+            high = bisect.bisect_left(rows, (end[0], ))
+        else:
+            high = bisect.bisect_right(rows, (end[0], MAX_DOCID))
+        selected = rows[low:high]
+        if descending:
+            selected.reverse()
+        return selected
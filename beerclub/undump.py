@@ -4,56 +4,245 @@ The file to load must be given as a command line argument.
 
 NOTE: The dabase instance must exist, and should be empty. If it is not
 empty, this script may overwrite existing documents.
+
+The documents are saved in batches, and the attachments are uploaded
+by a number of threads in parallel. A checkpoint file records the number
+of items loaded so far, so that an interrupted load can be resumed.
+
+A full dump may be followed by a chain of delta dumps, each containing
+the changes since the previous one. They are loaded in the given order.
 """
 
 import argparse
+import concurrent.futures
 import json
 import os
+import sys
 import tarfile
 import time
 
+from beerclub import constants
+from beerclub import dump
+from beerclub import settings
 from beerclub import utils
 
 
-def undump(db, filepath):
+def undump_chain(db, filepaths, **kwargs):
+    """Load a full dump followed by any number of delta dumps.
+    Check first that each delta dump continues from the previous dump.
+    Raise ValueError if not.
+    """
+    previous = None
+    for filepath in filepaths:
+        try:
+            metadata = dump.get_metadata(filepath)
+        except KeyError:
+            # A dump made by an older version can only be loaded alone.
+            if len(filepaths) > 1: raise ValueError(
+                "no update sequence in dump file %s" % filepath)
+            metadata = dict(since=None)
+        if previous is None:
+            if metadata['since'] is not None:
+                raise ValueError("%s is not a full dump" % filepath)
+        elif metadata['since'] != previous['update_seq']:
+            raise ValueError("%s does not follow the previous dump" %
+                             filepath)
+        previous = metadata
+    for filepath in filepaths:
+        undump(db, filepath,
+               checkpoint=filepath + '.checkpoint',
+               **kwargs)
+
+def undump(db, filepath, batch_size=None, threads=None, checkpoint=None):
     """Reverse of dump; load all items from a tar file.
     NOTE: Items are just added to the database. Any existing data may
-    be overwritten. Should only be used with an empty database.
+    be overwritten. Should only be used with an empty database,
+    unless it is a delta dump, which updates or deletes the documents.
+    If a checkpoint file is given, then skip the items loaded according
+    to it, and update it after each batch. It is removed when done.
     """
+    if batch_size is None:
+        batch_size = settings['DATABASE_BATCH_SIZE']
+    if threads is None:
+        threads = settings['DATABASE_THREADS']
+    start = time.perf_counter()
+    skip = 0
+    if checkpoint and os.path.exists(checkpoint):
+        with open(checkpoint) as cpfile:
+            skip = json.load(cpfile)['items']
+        print('resuming after', skip, 'items')
+    loader = BatchLoader(db, threads)
     count_items = 0
-    count_files = 0
-    attachments = dict()
+    skipped = set()             # Names of attachments of skipped items.
+    batch = []
     infile = tarfile.open(filepath, mode='r')
-    for item in infile:
-        itemfile = infile.extractfile(item)
-        itemdata = itemfile.read()
-        itemfile.close()
-        if item.name in attachments:
-            # This relies on an attachment being after its item in the tarfile.
-            db.put_attachment(doc, itemdata, **attachments.pop(item.name))
-            count_files += 1
-        else:
-            doc = json.loads(itemdata)
-            atts = doc.pop('_attachments', dict())
-            db.save(doc)
+    try:
+        for item in infile:
+            itemfile = infile.extractfile(item)
+            itemdata = itemfile.read()
+            itemfile.close()
+            if item.name == constants.DUMP_METADATA:
+                metadata = json.loads(itemdata)
+                loader.delta = metadata.get('since') is not None
+                continue
+            if item.name in loader.attachments:
+                # This relies on an attachment being after its item in the tarfile.
+                loader.attachments[item.name]['data'] = itemdata
+                continue
+            if item.name in skipped: continue
             count_items += 1
-            for attname, attinfo in atts.items():
+            doc = json.loads(itemdata)
+            if count_items <= skip:
+                for attname in doc.get('_attachments', dict()):
+                    skipped.add("{0}_att/{1}".format(doc['_id'], attname))
+                continue
+            # Save the batch when full, and the attachments of its
+            # last item have been read.
+            if len(batch) >= batch_size:
+                loader.load(batch)
+                batch = []
+                write_checkpoint(checkpoint, count_items - 1)
+                print(count_items - 1, 'items loaded...')
+            for attname, attinfo in doc.pop('_attachments', dict()).items():
                 key = "{0}_att/{1}".format(doc['_id'], attname)
-                attachments[key] = dict(filename=attname,
-                                        content_type=attinfo['content_type'])
-        if count_items % 100 == 0:
-            print(count_items, 'items loaded...')
-    infile.close()
+                loader.attachments[key] = dict(
+                    doc=doc,
+                    filename=attname,
+                    content_type=attinfo['content_type'])
+            batch.append(doc)
+        loader.load(batch)
+    finally:
+        infile.close()
+        loader.close()
+    if checkpoint and os.path.exists(checkpoint):
+        os.remove(checkpoint)
+    elapsed = max(time.perf_counter() - start, 0.001)
     # This will be executed on the command line, so output to console, not log.
-    print('undumped', count_items, 'items and', 
-          count_files, 'files from', filepath)
+    print('undumped', loader.count_items, 'items and', 
+          loader.count_files, 'files from', filepath)
+    if loader.delta:
+        print('deleted', loader.count_deleted, 'items')
+    print("%.1f s, %.0f items/s" % (elapsed, loader.count_items / elapsed))
+    if skip:
+        print('skipped', min(skip, count_items), 'items already loaded')
+    if loader.errors:
+        print(len(loader.errors), 'errors:')
+        for key, error in loader.errors:
+            print(' ', key, error)
+
+def write_checkpoint(checkpoint, count_items):
+    "Record the number of items loaded, if a checkpoint file is given."
+    if not checkpoint: return
+    with open(checkpoint + '.tmp', 'w') as cpfile:
+        json.dump(dict(items=count_items), cpfile)
+    os.replace(checkpoint + '.tmp', checkpoint)
+
+
+class BatchLoader(object):
+    """Save batches of documents, and upload their attachments
+    using a pool of threads.
+    """
+
+    def __init__(self, db, threads):
+        self.db = db
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=threads)
+        self.attachments = dict()   # Pending attachments by tarfile name.
+        self.delta = False
+        self.count_items = 0
+        self.count_deleted = 0
+        self.count_files = 0
+        self.errors = []        # Tuples (document id or filename, error).
+
+    def load(self, docs):
+        """Save the documents in one request, then upload their attachments
+        in parallel; the attachments of each document in sequence.
+        Wait until all is done.
+        """
+        if self.delta:
+            docs = self.set_revisions(docs)
+        if not docs: return
+        saved = set()
+        deleted = set([doc['_id'] for doc in docs if doc.get('_deleted')])
+        for success, docid, rev in self.db.update(docs):
+            if not success:
+                self.errors.append((docid, rev))
+            elif docid in deleted:
+                self.count_deleted += 1
+            else:
+                saved.add(docid)
+                self.count_items += 1
+        # The attachments of the documents not saved are dropped.
+        by_doc = dict()
+        docids = set([doc['_id'] for doc in docs])
+        for key in list(self.attachments):
+            docid = self.attachments[key]['doc']['_id']
+            if docid in docids:
+                attachment = self.attachments.pop(key)
+                if docid in saved:
+                    by_doc.setdefault(docid, []).append((key, attachment))
+        futures = [self.executor.submit(self.put_attachments, atts)
+                   for atts in by_doc.values()]
+        for future in concurrent.futures.as_completed(futures):
+            self.count_files += future.result()
+
+    def set_revisions(self, docs):
+        """Set the current revision of the documents that exist.
+        Return the list of documents, excluding the deleted documents
+        that do not exist.
+        """
+        rows = self.db.view('_all_docs', keys=[doc['_id'] for doc in docs])
+        revs = dict([(row.key, row.value['rev']) for row in rows
+                     if row.value and not row.value.get('deleted')])
+        result = []
+        for doc in docs:
+            try:
+                doc['_rev'] = revs[doc['_id']]
+            except KeyError:
+                if doc.get('_deleted'): continue
+            result.append(doc)
+        return result
+
+    def put_attachments(self, attachments):
+        """Upload the attachments of a document, one after the other.
+        Return the number uploaded.
+        """
+        count = 0
+        for key, att in attachments:
+            try:
+                self.db.put_attachment(att['doc'], att.get('data', b''),
+                                       filename=att['filename'],
+                                       content_type=att['content_type'])
+            except Exception as error:
+                self.errors.append((key, error))
+            else:
+                count += 1
+        return count
+
+    def close(self):
+        self.executor.shutdown()
 
 
 if __name__ == '__main__':
     utils.setup()
     utils.initialize()
     parser = argparse.ArgumentParser(description='Load dump into database.')
-    parser.add_argument('dumpfile', metavar='FILE', type=str,
-                        help='Dump file to load into the database.')
+    parser.add_argument('dumpfiles', metavar='FILE', type=str, nargs='+',
+                        help='Dump file to load into the database,'
+                        ' optionally followed by delta dump files'
+                        ' in the order they were made.')
+    parser.add_argument('-b', '--batch', metavar='N', type=int,
+                        action='store', dest='batch_size',
+                        help='The number of documents to save per request;'
+                        ' default DATABASE_BATCH_SIZE.')
+    parser.add_argument('-t', '--threads', metavar='N', type=int,
+                        action='store', dest='threads',
+                        help='The number of threads uploading attachments;'
+                        ' default DATABASE_THREADS.')
     args =  parser.parse_args()
-    undump(utils.get_db(), args.dumpfile)
+    try:
+        undump_chain(utils.get_db(), args.dumpfiles,
+                     batch_size=args.batch_size,
+                     threads=args.threads)
+    except ValueError as error:
+        sys.exit(str(error))
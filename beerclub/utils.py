@@ -1,24 +1,44 @@
 "Various supporting functions."
 
+import concurrent.futures
+import contextvars
 import datetime
 import email.mime.text
+import functools
 import hashlib
+import hmac
 import json
 import logging
 import os
+import re
 import smtplib
 import string
 import sys
+import threading
 import time
 import urllib                   # formerly: urlparse
 import uuid
 
 import couchdb
+import tornado.ioloop
 
 import beerclub
 from beerclub import constants
 from beerclub import designs
+from beerclub import metrics
 from beerclub import settings
+from beerclub import sqlitedb
+
+PASSWORD_ALGORITHM = 'pbkdf2_sha256'
+
+_executor = None
+_password_executor = None
+_in_flight = 0
+_executor_waits = 0     # Calls made while all database threads were busy.
+_pool = None
+_dbserver = None
+_db = None
+_swish_prefixes = None
 
 
 def setup():
@@ -70,31 +90,171 @@ def setup():
     settings['POLICY_STATEMENT'] = settings['POLICY_STATEMENT'].format(**settings)
     settings['PRIVACY_STATEMENT'] = settings['PRIVACY_STATEMENT'].format(**settings)
 
+def get_executor():
+    "Get the thread pool executor in which the blocking database calls run."
+    global _executor
+    if _executor is None:
+        _executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=settings['DATABASE_THREADS'],
+            thread_name_prefix='beerclub-db')
+    return _executor
+
+async def run_async(func, *args, **kwargs):
+    """Run the blocking function in the database executor,
+    so that the IOLoop is not stalled. Return its result.
+    """
+    global _in_flight, _executor_waits
+    if _in_flight >= settings['DATABASE_THREADS']:
+        _executor_waits += 1
+    if metrics.get_trace() is not None:
+        # Make the trace available in the executor thread.
+        func = functools.partial(contextvars.copy_context().run, func)
+    _in_flight += 1
+    try:
+        return await tornado.ioloop.IOLoop.current().run_in_executor(
+            get_executor(), functools.partial(func, *args, **kwargs))
+    finally:
+        _in_flight -= 1
+
+
+class ConnectionPool(couchdb.http.ConnectionPool):
+    """HTTP connection pool shared by all database calls in the process.
+    Keeps at most 'size' idle connections per host, and discards
+    connections that have been idle for more than 'keepalive' seconds.
+    The number of concurrent connections is bounded by the executor.
+    """
+
+    def __init__(self, timeout, size, keepalive):
+        super().__init__(timeout)
+        self.size = size
+        self.keepalive = keepalive
+        self.counters = dict(hits=0, new=0, discarded=0)
+
+    def get(self, url):
+        scheme, host = couchdb.util.urlsplit(url, 'http', False)[:2]
+        now = time.monotonic()
+        with self.lock:
+            conns = self.conns.setdefault((scheme, host), [])
+            while conns:
+                conn, released = conns.pop()
+                if now - released <= self.keepalive:
+                    self.counters['hits'] += 1
+                    return conn
+                conn.close()
+                self.counters['discarded'] += 1
+            self.counters['new'] += 1
+        if scheme == 'http':
+            conn = couchdb.http.HTTPConnection(host, timeout=self.timeout)
+        elif scheme == 'https':
+            conn = couchdb.http.HTTPSConnection(host, timeout=self.timeout)
+        else:
+            raise ValueError('%s is not a supported scheme' % scheme)
+        conn.connect()
+        return conn
+
+    def release(self, url, conn):
+        scheme, host = couchdb.util.urlsplit(url, 'http', False)[:2]
+        with self.lock:
+            conns = self.conns.setdefault((scheme, host), [])
+            if len(conns) < self.size:
+                conns.append((conn, time.monotonic()))
+                return
+            self.counters['discarded'] += 1
+        conn.close()
+
+    def __del__(self):
+        for conns in self.conns.values():
+            for conn, released in conns:
+                conn.close()
+
+
+class Cache(couchdb.http.Cache):
+    "Thread-safe version of the content cache of the HTTP session."
+
+    def __init__(self):
+        super().__init__()
+        self.lock = threading.Lock()
+
+    def put(self, url, response):
+        with self.lock:
+            super().put(url, response)
+
+    def remove(self, url):
+        with self.lock:
+            super().remove(url)
+
+
+def get_connection_pool():
+    "Get the HTTP connection pool shared by the process."
+    global _pool
+    if _pool is None:
+        _pool = ConnectionPool(settings['DATABASE_TIMEOUT'],
+                               settings['DATABASE_POOL_SIZE'],
+                               settings['DATABASE_KEEPALIVE'])
+    return _pool
+
+def log_pool_counters():
+    """Log the usage counters of the HTTP connection pool, and the number
+    of calls that had to wait for a thread of the database executor.
+    """
+    counters = ', '.join(["%s %s" % i for i in
+                          get_connection_pool().counters.items()])
+    logging.info("database pool: %s; executor waits %s",
+                 counters, _executor_waits)
+
 def get_dbserver():
-    "Get the server connection, with credentials if any."
-    server = couchdb.Server(settings['DATABASE_SERVER'])
-    if settings.get('DATABASE_ACCOUNT') and settings.get('DATABASE_PASSWORD'):
-        server.resource.credentials = (settings.get('DATABASE_ACCOUNT'),
-                                       settings.get('DATABASE_PASSWORD'))
-    return server
+    """Get the server connection, with credentials if any.
+    It is shared by the process, and uses the shared connection pool.
+    """
+    global _dbserver
+    if _dbserver is None:
+        session = couchdb.http.Session(timeout=settings['DATABASE_TIMEOUT'])
+        session.connection_pool = get_connection_pool()
+        session.cache = Cache()
+        server = couchdb.Server(settings['DATABASE_SERVER'], session=session)
+        if settings.get('DATABASE_ACCOUNT') and \
+           settings.get('DATABASE_PASSWORD'):
+            server.resource.credentials = (settings.get('DATABASE_ACCOUNT'),
+                                           settings.get('DATABASE_PASSWORD'))
+        _dbserver = server
+    return _dbserver
 
 def get_db():
-    "Return the handle for the CouchDB database."
+    """Return the handle for the database. Shared by the process.
+    Depending on 'DATABASE_BACKEND', it is either a CouchDB database,
+    or an SQLite database with the same interface.
+    """
+    global _db
+    if _db is not None:
+        return _db
+    if settings['DATABASE_BACKEND'] == 'sqlite':
+        filepath = settings['DATABASE_FILEPATH'] or \
+                   os.path.join(settings['ROOT_DIR'],
+                                settings['DATABASE_NAME'] + '.sqlite')
+        _db = sqlitedb.Database(filepath, name=settings['DATABASE_NAME'])
+        return _db
+    elif settings['DATABASE_BACKEND'] != 'couchdb':
+        raise ValueError("no such database backend '%s'" %
+                         settings['DATABASE_BACKEND'])
     server = get_dbserver()
     try:
-        return server[settings['DATABASE_NAME']]
+        _db = server[settings['DATABASE_NAME']]
     except couchdb.http.ResourceNotFound:
         raise couchdb.http.ResourceNotFound("CouchDB database '%s' does not exist." %
                        settings.get('DATABASE_NAME'))
     except couchdb.http.Unauthorized:
         raise couchdb.http.Unauthorized("CouchDB account '%s' is not authorized to access database '%s'." %
                        (settings.get('DATABASE_ACCOUNT'), settings.get('DATABASE_NAME')))
+    return _db
 
-def initialize(db=None):
-    "Load the design documents, or update."
+def initialize(db=None, warm=True):
+    """Load the design documents, or update. If 'warm' is False, then
+    the indexes of updated views must be regenerated by calling
+    'designs.warm_views'.
+    """
     if db is None:
         db = get_db()
-    designs.load_design_documents(db)
+    designs.load_design_documents(db, warm=warm)
 
 def get_doc(db, key, viewname=None):
     """Get the document with the given id, or from the given view.
@@ -102,28 +262,74 @@ def get_doc(db, key, viewname=None):
     """
     if viewname is None:
         try:
-            return db[key]
+            with metrics.database.timer('get', 'doc', id=key):
+                return db[key]
         except couchdb.http.ResourceNotFound:
             raise KeyError
     else:
         view = db.view(viewname, include_docs=True, reduce=False)
-        result = list(view[str(key)])
+        with metrics.database.timer('view', viewname, key=key) as details:
+            result = list(view[str(key)])
+            details['rows'] = len(result)
         if len(result) != 1:
             raise KeyError("%i items found", len(result))
         return result[0].doc
 
+async def get_doc_async(db, key, viewname=None):
+    "Coroutine version of 'get_doc'."
+    return await run_async(get_doc, db, key, viewname=viewname)
+
 def get_docs(db, viewname, key=None, last=None, **kwargs):
     """Get the list of documents using the named view and
     the given key or interval.
     """
-    view = db.view(viewname, include_docs=True, reduce=False, **kwargs)
+    return [r.doc for r in get_rows(db, viewname, key=key, last=last,
+                                    include_docs=True, reduce=False,
+                                    **kwargs)]
+
+async def get_docs_async(db, viewname, key=None, last=None, **kwargs):
+    "Coroutine version of 'get_docs'."
+    return await run_async(get_docs, db, viewname, key=key, last=last,**kwargs)
+
+def get_rows(db, viewname, key=None, last=None, **kwargs):
+    """Get the list of rows from the named view and
+    the given key or interval.
+    """
+    view = db.view(viewname, **kwargs)
     if key is None:
         iterator = view
     elif last is None:
         iterator = view[key]
     else:
         iterator = view[key:last]
-    return [i.doc for i in iterator]
+    with metrics.database.timer('view', viewname,
+                                key=key, last=last) as details:
+        result = list(iterator)
+        details['rows'] = len(result)
+    return result
+
+async def get_rows_async(db, viewname, key=None, last=None, **kwargs):
+    "Coroutine version of 'get_rows'."
+    return await run_async(get_rows, db, viewname, key=key, last=last,**kwargs)
+
+def get_rows_batches(db, viewname, size=None, **kwargs):
+    """Generator of the rows from the named view and the given
+    view options, in lists of at most 'size' rows, by default
+    'DATABASE_BATCH_SIZE'. Each batch is fetched by a separate request,
+    continuing from the key and document id of the row following
+    the previous batch.
+    """
+    if size is None:
+        size = settings['DATABASE_BATCH_SIZE']
+    while True:
+        with metrics.database.timer('view', viewname,
+                                    startkey=kwargs.get('startkey')) as details:
+            rows = list(db.view(viewname, limit=size+1, **kwargs))
+            details['rows'] = len(rows)
+        yield rows[:size]
+        if len(rows) <= size: break
+        kwargs['startkey'] = rows[size].key
+        kwargs['startkey_docid'] = rows[size].id
 
 def get_member(db, email):
     """Get the member identified by the email address.
@@ -142,6 +348,107 @@ def get_member(db, email):
                 pass
         raise KeyError("no such member %s" % email)
 
+async def get_member_async(db, email):
+    "Coroutine version of 'get_member'."
+    return await run_async(get_member, db, email)
+
+def get_members(db, emails):
+    """Get the members identified by the email addresses, or by
+    Swish numbers if Swish is enabled, using one multi-key lookup
+    per view. Return a dictionary with the given keys that were found.
+    """
+    result = {}
+    keys = dict([(e.strip().lower(), e) for e in emails])
+    viewnames = ['member/email']
+    if settings['MEMBER_SWISH']:
+        viewnames.append('member/swish')
+    for viewname in viewnames:
+        if not keys: break
+        with metrics.database.timer('view', viewname,
+                                    keys=len(keys)) as details:
+            rows = list(db.view(viewname, keys=list(keys), include_docs=True))
+            details['rows'] = len(rows)
+        for row in rows:
+            try:
+                result[keys.pop(row.key)] = row.doc
+            except KeyError:    # Duplicate entry in the view.
+                pass
+    return result
+
+async def get_members_async(db, emails):
+    "Coroutine version of 'get_members'."
+    return await run_async(get_members, db, emails)
+
+def normalized_swish(number):
+    """Return the Swish number with any international prefix replaced
+    according to the setting 'SWISH_NUMBER_PREFIXES'. The first prefix
+    in the setting that matches is used.
+    """
+    global _swish_prefixes
+    prefixes = settings['SWISH_NUMBER_PREFIXES']
+    if not prefixes: return number
+    if _swish_prefixes is None or _swish_prefixes[0] is not prefixes:
+        regexp = re.compile("|".join([re.escape(p) for p in prefixes]))
+        _swish_prefixes = (prefixes, regexp)
+    match = _swish_prefixes[1].match(number)
+    if match:
+        return prefixes[match.group()] + number[match.end():]
+    return number
+
+def get_balance(db, member=None):
+    "Get the current balance for the member, or the sum of all members."
+    if member is None:
+        with metrics.database.timer('view', 'event/credit') as details:
+            result = list(db.view('event/credit', group=False))
+            details['rows'] = len(result)
+    else:
+        with metrics.database.timer('view', 'event/credit',
+                                    key=member['email']) as details:
+            result = list(db.view('event/credit',
+                                  key=member['email'],
+                                  group_level=1))
+            details['rows'] = len(result)
+    if result:
+        return result[0].value
+    else:
+        return 0
+
+async def get_balance_async(db, member=None):
+    "Coroutine version of 'get_balance'."
+    return await run_async(get_balance, db, member=member)
+
+def get_beerclub_balance(db):
+    "Get the current balance for the Beer Club account (i.e. payments)."
+    with metrics.database.timer('view', 'event/payment') as details:
+        result = list(db.view('event/payment', group=False))
+        details['rows'] = len(result)
+    if result:
+        return result[0].value
+    else:
+        return 0
+
+async def get_beerclub_balance_async(db):
+    "Coroutine version of 'get_beerclub_balance'."
+    return await run_async(get_beerclub_balance, db)
+
+def get_count(db, member, date=None):
+    "Get the number of beverages purchased on the given date."
+    if date is None:
+        date = today()
+    key = [member['email'], date]
+    with metrics.database.timer('view', 'event/beverage',
+                                key=key) as details:
+        result = list(db.view('event/beverage', key=key, group_level=2))
+        details['rows'] = len(result)
+    if result:
+        return result[0].value
+    else:
+        return 0
+
+async def get_count_async(db, member, date=None):
+    "Coroutine version of 'get_count'."
+    return await run_async(get_count, db, member, date=date)
+
 def get_balances(db, members):
     "Get and set the balances for all input members."
     # Prepare lookup of all input members.
@@ -151,36 +458,131 @@ def get_balances(db, members):
         # Default balance is zero
         member['balance'] = 0.0
     # Simple but effective: get all balances in one go.
-    view = db.view('event/credit', group_level=1, reduce=True)
-    for row in view:
+    with metrics.database.timer('view', 'event/credit') as details:
+        rows = list(db.view('event/credit', group_level=1, reduce=True))
+        details['rows'] = len(rows)
+    for row in rows:
         try:
             lookup[row.key]['balance'] = row.value
         except KeyError:
             pass
 
+async def get_balances_async(db, members):
+    "Coroutine version of 'get_balances'."
+    await run_async(get_balances, db, members)
+
 def get_latest_events(db, members):
-    "Get and set the latest event for all input members."
+    """Get and set the latest event for all input members.
+    The 'event/latest' view gives the timestamp of the latest event
+    for each member, which is then used to fetch all those events
+    in one multi-key query. Only if that does not find the event
+    (e.g. timestamp in an unexpected format), query for each member.
+    """
+    lookup = {}
     for member in members:
-        events = get_docs(db, 'event/member',            
+        lookup[member['email']] = member
+        member['latest_event'] = None
+    if not lookup: return
+    with metrics.database.timer('view', 'event/latest',
+                                keys=len(lookup)) as details:
+        rows = list(db.view('event/latest', keys=list(lookup), group=True))
+        details['rows'] = len(rows)
+    keys = [[row.key, millis_timestamp(row.value['max'])] for row in rows]
+    if not keys: return
+    with metrics.database.timer('view', 'event/member',
+                                keys=len(keys)) as details:
+        rows = list(db.view('event/member', keys=keys, include_docs=True))
+        details['rows'] = len(rows)
+    # Rows for the same key are in docid order; the last is the latest.
+    for row in rows:
+        lookup[row.key[0]]['latest_event'] = row.doc
+    for key in keys:
+        member = lookup[key[0]]
+        if member['latest_event'] is not None: continue
+        events = get_docs(db, 'event/member',
                           key=[member['email'], constants.CEILING],
                           last=[member['email'], ''],
                           descending=True,
                           limit=1)
         if events:
             member['latest_event'] = events[0]
-        else:
-            member['latest_event'] = None
+
+async def get_latest_events_async(db, members):
+    "Coroutine version of 'get_latest_events'."
+    await run_async(get_latest_events, db, members)
 
 def get_iuid():
     "Return a unique instance identifier."
     return uuid.uuid4().hex
 
-def hashed_password(password):
-    "Return the password in hashed form."
+def hashed_password(password, salt=None, iterations=None):
+    """Return the password in hashed form 'algorithm$iterations$salt$hash',
+    using PBKDF2-SHA256 with a random salt, and with 'PASSWORD_SALT'
+    prepended to the password. This takes a while, by design; a request
+    handler should use 'hashed_password_async'.
+    """
+    if salt is None:
+        salt = get_iuid()
+    if iterations is None:
+        iterations = settings['PASSWORD_ITERATIONS']
+    password = settings['PASSWORD_SALT'] + password
+    key = hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'),
+                              salt.encode('utf-8'), iterations)
+    return "%s$%i$%s$%s" % (PASSWORD_ALGORITHM, iterations, salt, key.hex())
+
+def legacy_hashed_password(password):
+    "Return the password in the legacy hashed form; a single salted SHA-256."
     sha256 = hashlib.sha256(settings['PASSWORD_SALT'].encode('utf-8'))
     sha256.update(password.encode('utf-8'))
     return sha256.hexdigest()
 
+def verify_password(password, stored):
+    """Does the password match the stored hashed form, either the current
+    or the legacy one? This takes a while, by design; a request handler
+    should use 'verify_password_async'.
+    """
+    if not stored: return False
+    try:
+        algorithm, iterations, salt, key = stored.split('$')
+        if algorithm != PASSWORD_ALGORITHM: return False
+        hashed = hashed_password(password, salt=salt,
+                                 iterations=int(iterations))
+    except ValueError:
+        hashed = legacy_hashed_password(password)
+    return hmac.compare_digest(hashed, stored)
+
+def needs_rehash(stored):
+    """Is the stored hashed form of the password the legacy one, or made
+    with other than the current number of iterations?
+    """
+    try:
+        algorithm, iterations, salt, key = stored.split('$')
+        return algorithm != PASSWORD_ALGORITHM or \
+               int(iterations) != settings['PASSWORD_ITERATIONS']
+    except (AttributeError, ValueError):
+        return True
+
+def get_password_executor():
+    """Get the thread pool executor in which the password hashing runs,
+    so as not to occupy any of the threads for the database calls.
+    """
+    global _password_executor
+    if _password_executor is None:
+        _password_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=settings['PASSWORD_THREADS'],
+            thread_name_prefix='beerclub-password')
+    return _password_executor
+
+async def hashed_password_async(password):
+    "Coroutine version of 'hashed_password'; runs in the password executor."
+    return await tornado.ioloop.IOLoop.current().run_in_executor(
+        get_password_executor(), hashed_password, password)
+
+async def verify_password_async(password, stored):
+    "Coroutine version of 'verify_password'; runs in the password executor."
+    return await tornado.ioloop.IOLoop.current().run_in_executor(
+        get_password_executor(), verify_password, password, stored)
+
 def check_password(password):
     """Check that the password is long and complex enough.
     Raise ValueError otherwise."""
@@ -198,6 +600,15 @@ def timestamp(days=None):
     instant = instant.isoformat()
     return instant[:17] + "%06.3f" % float(instant[17:]) + "Z"
 
+def millis_timestamp(millis):
+    """Convert milliseconds since the epoch (as from JavaScript 'Date.parse')
+    to a timestamp in the same format as produced by 'timestamp'.
+    """
+    seconds, millis = divmod(int(millis), 1000)
+    instant = datetime.datetime(1970, 1, 1) + \
+              datetime.timedelta(seconds=seconds)
+    return instant.strftime('%Y-%m-%dT%H:%M:%S') + ".%03iZ" % millis
+
 def today(days=None):
     """Current date (UTC) in ISO format.
     Add the specified offset in number of days, if given.
@@ -213,7 +624,7 @@ def normalize_swish(value):
     return ''.join([c for c in value if c in string.digits])
 
 def timeit(label):
-    logging.debug("%f %f %s", time.clock(), time.time(), label)
+    logging.debug("%f %f %s", time.perf_counter(), time.time(), label)
 
 
 class EmailServer(object):
@@ -245,10 +656,14 @@ class EmailServer(object):
     def __del__(self):
         "Close the connection to the email server."
         try:
-            self.server.quit()
-        except AttributeError:
+            self.close()
+        except (AttributeError, smtplib.SMTPException, OSError):
             pass
 
+    def close(self):
+        "Close the connection to the email server."
+        self.server.quit()
+
     def send(self, recipient, subject, text):
         "Send an email."
         mail = email.mime.text.MIMEText(text, 'plain', 'utf-8')
@@ -0,0 +1,143 @@
+"""Common setup for the tests: the web application using an in-memory
+stand-in for the CouchDB database, or the SQLite backend on a temporary
+file, with fresh caches for each test.
+"""
+
+import os
+import tempfile
+import unittest
+import urllib.parse
+
+import tornado.httpclient
+import tornado.httpserver
+import tornado.ioloop
+import tornado.testing
+import tornado.web
+
+from beerclub import settings
+
+settings.update(COOKIE_SECRET='test-cookie-secret',
+                PASSWORD_SALT='test-password-salt',
+                PASSWORD_ITERATIONS=1000)
+
+from beerclub import app_beerclub
+from beerclub import cache
+from beerclub import changes
+from beerclub import constants
+from beerclub import sqlitedb
+from beerclub import standin
+from beerclub import utils
+
+# A fixed XSRF token, for both the form field and the cookie.
+XSRF_TOKEN = "2|00000000|%s|1" % ('0' * 32)
+
+
+def new_database(backend, dirpath):
+    """Return a new empty database of the backend, 'standin' or 'sqlite';
+    the latter in a file in the given directory.
+    """
+    if backend == 'sqlite':
+        return sqlitedb.Database(
+            os.path.join(dirpath, "%s.sqlite" % utils.get_iuid()))
+    elif backend == 'standin':
+        return standin.Database()
+    raise ValueError("no such backend %s" % backend)
+
+
+class BeerClubTestCase(unittest.TestCase):
+    """The web application on an empty database of the given backend,
+    served by an HTTP server on an IOLoop of its own.
+    """
+
+    backend = 'standin'
+
+    def setUp(self):
+        self.io_loop = tornado.ioloop.IOLoop()
+        self.io_loop.make_current()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.db = new_database(self.backend, self.tmpdir.name)
+        del changes._listeners[:]
+        cache.members = cache.MemberCache()
+        cache.balances = cache.BalanceCache()
+        cache.pages = cache.PageCache()
+        cache.sessions = cache.SessionCache()
+        cache.credentials = cache.CredentialCache()
+        sock, self.port = tornado.testing.bind_unused_port()
+        self.http_server = tornado.httpserver.HTTPServer(
+            app_beerclub.get_application(self.db))
+        self.http_server.add_sockets([sock])
+        self.http_client = tornado.httpclient.AsyncHTTPClient()
+
+    def tearDown(self):
+        self.http_server.stop()
+        self.http_client.close()
+        self.io_loop.clear_current()
+        self.io_loop.close(all_fds=True)
+        self.tmpdir.cleanup()
+
+    def run_sync(self, func, *args, **kwargs):
+        "Run the coroutine function on the IOLoop; return its result."
+        return self.io_loop.run_sync(lambda: func(*args, **kwargs),
+                                     timeout=10)
+
+    def fetch(self, path, **kwargs):
+        "Fetch the path from the server; HTTP errors are not raised."
+        kwargs.setdefault('raise_error', False)
+        kwargs.setdefault('follow_redirects', False)
+        return self.run_sync(self.http_client.fetch,
+                             "http://127.0.0.1:%s%s" % (self.port, path),
+                             **kwargs)
+
+    def add_member(self, email, password=None, role=constants.MEMBER,
+                   login=True):
+        "Save a member document directly in the database; return it."
+        doc = {'_id': utils.get_iuid(),
+               constants.DOCTYPE: constants.MEMBER,
+               'email': email,
+               'first_name': 'First',
+               'last_name': email.split('@')[0],
+               'role': role,
+               'status': constants.ENABLED,
+               'password': password,
+               'swish': None,
+               'address': None,
+               'login': utils.timestamp() if login else None}
+        self.db.save(doc)
+        return doc
+
+    def add_event(self, email, credit=-20.0, days=0):
+        "Save a purchase event for the member directly in the database."
+        doc = {'_id': utils.get_iuid(),
+               constants.DOCTYPE: constants.EVENT,
+               'action': constants.PURCHASE,
+               'member': email,
+               'beverage': 'beer',
+               'credit': credit,
+               'date': utils.today(days),
+               'description': 'test',
+               'log': dict(timestamp=utils.timestamp(days),
+                           date=utils.today(days))}
+        self.db.save(doc)
+        return doc
+
+    def get_session_cookie(self, email):
+        "Return the Cookie header value of a login session for the member."
+        value = tornado.web.create_signed_value(
+            settings['COOKIE_SECRET'], constants.USER_COOKIE, email)
+        return "%s=%s" % (constants.USER_COOKIE, value.decode('ascii'))
+
+    def fetch_as(self, email, path, **kwargs):
+        "Fetch the path within a login session for the member."
+        headers = kwargs.setdefault('headers', {})
+        headers['Cookie'] = self.get_session_cookie(email)
+        return self.fetch(path, **kwargs)
+
+    def post_form(self, path, data, email=None):
+        "Post the form data with the XSRF token, optionally as the member."
+        data = dict(data, _xsrf=XSRF_TOKEN)
+        cookies = ["_xsrf=%s" % XSRF_TOKEN]
+        if email:
+            cookies.append(self.get_session_cookie(email))
+        return self.fetch(path, method='POST',
+                          body=urllib.parse.urlencode(data),
+                          headers={'Cookie': '; '.join(cookies)})
@@ -0,0 +1,127 @@
+"Coherence of the in-process caches with the database."
+
+from base import BeerClubTestCase
+
+from beerclub import cache
+from beerclub import changes
+from beerclub import constants
+
+
+class SessionCacheTestCase(BeerClubTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.member = self.add_member('alice@example.org')
+
+    def fetch_account(self):
+        return self.fetch_as('alice@example.org', '/account/alice@example.org')
+
+    def test_not_used_until_initialized(self):
+        self.assertEqual(self.fetch_account().code, 200)
+        self.assertEqual(self.fetch_account().code, 200)
+        self.assertEqual(cache.sessions.get_metrics()['size'], 0)
+        self.assertEqual(cache.sessions.counters['hits'], 0)
+
+    def test_invalidated_by_member_change(self):
+        cache.initialize(self.db)
+        self.assertEqual(self.fetch_account().code, 200)
+        self.assertEqual(self.fetch_account().code, 200)
+        self.assertEqual(cache.sessions.counters['hits'], 1)
+        # Disabled by another process; the change arrives via the feed.
+        doc = self.db[self.member['_id']]
+        doc['status'] = constants.DISABLED
+        self.db.save(doc)
+        changes.notify(doc)
+        self.assertEqual(cache.sessions.get_metrics()['size'], 0)
+        self.assertEqual(self.fetch_account().code, 302)
+
+
+class PageCacheTestCase(BeerClubTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.add_member('admin@example.org', role=constants.ADMIN)
+        self.add_event('admin@example.org')
+        # As if the changes feed had been started.
+        self.status = changes.status.copy()
+        changes.status.update(seq='1', synced=0.0)
+
+    def tearDown(self):
+        changes.status.update(self.status)
+        super().tearDown()
+
+    def fetch_page(self, path, headers={}):
+        "Fetch the page as admin; the XSRF cookie is needed for caching."
+        headers = dict(headers)
+        headers['Cookie'] = "%s; _xsrf=2|00000000|%s|1" % \
+            (self.get_session_cookie('admin@example.org'), '0' * 32)
+        return self.fetch(path, headers=headers)
+
+    def test_body_reused(self):
+        for path in ['/ledger', '/ledger.csv', '/dashboard.json']:
+            first = self.fetch_page(path)
+            self.assertEqual(first.code, 200)
+            second = self.fetch_page(path)
+            self.assertEqual(second.code, 200)
+            self.assertEqual(second.body, first.body)
+            self.assertEqual(second.headers['Content-Type'],
+                             first.headers['Content-Type'])
+        self.assertEqual(cache.pages.counters['hits'], 3)
+
+    def test_not_modified(self):
+        first = self.fetch_page('/ledger')
+        response = self.fetch_page(
+            '/ledger', headers={'If-None-Match': first.headers['Etag']})
+        self.assertEqual(response.code, 304)
+
+
+class MemberBalanceCacheTestCase(BeerClubTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.member = self.add_member('alice@example.org')
+        self.add_event('alice@example.org', credit=-20.0)
+        cache.initialize(self.db)
+
+    def test_member_change(self):
+        self.assertEqual(cache.members.get('alice@example.org')['status'],
+                         constants.ENABLED)
+        self.assertEqual(self.fetch_as('alice@example.org',
+                                       '/account/alice@example.org').code,
+                         200)
+        # Disabled by another process; the change arrives via the feed.
+        doc = self.db[self.member['_id']]
+        doc['status'] = constants.DISABLED
+        self.db.save(doc)
+        changes.notify(doc)
+        self.assertEqual(cache.members.get('alice@example.org')['status'],
+                         constants.DISABLED)
+        self.assertEqual(self.fetch_as('alice@example.org',
+                                       '/account/alice@example.org').code,
+                         302)
+
+    def test_balance_change(self):
+        self.assertEqual(cache.balances.get(self.member), -20.0)
+        doc = self.add_event('alice@example.org', credit=-15.0)
+        changes.notify(doc)
+        self.assertEqual(cache.balances.get(self.member), -35.0)
+        self.assertEqual(cache.balances.get(), -35.0)
+        # Deleted by another process; the feed gives only a stub.
+        self.db.delete(doc)
+        generation = changes.revision_generation(doc)
+        changes.notify({'_id': doc['_id'],
+                        '_rev': "%i-0" % (generation + 1),
+                        '_deleted': True})
+        self.assertEqual(cache.balances.get(self.member), -20.0)
+
+
+class SqliteSessionCacheTestCase(SessionCacheTestCase):
+    backend = 'sqlite'
+
+
+class SqlitePageCacheTestCase(PageCacheTestCase):
+    backend = 'sqlite'
+
+
+class SqliteMemberBalanceCacheTestCase(MemberBalanceCacheTestCase):
+    backend = 'sqlite'
@@ -0,0 +1,110 @@
+"Dumping the database, and loading the dumps into an empty database."
+
+import os
+import tempfile
+import unittest
+
+from base import new_database
+
+from beerclub import constants
+from beerclub import dump
+from beerclub import undump
+from beerclub import utils
+
+
+def get_contents(db):
+    "Return the documents without revisions, and the attachment contents."
+    docs = {}
+    attachments = {}
+    for docid in db:
+        if docid.startswith('_design/'): continue
+        doc = dict(db[docid])
+        doc.pop('_rev')
+        for filename in doc.pop('_attachments', {}):
+            attachments[(docid, filename)] = \
+                db.get_attachment(docid, filename).read()
+        docs[docid] = doc
+    return docs, attachments
+
+
+class DumpTestCase(unittest.TestCase):
+
+    backend = 'standin'
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.db = self.new_database()
+        self.member = self.save({constants.DOCTYPE: constants.MEMBER,
+                                 'email': 'alice@example.org',
+                                 'status': constants.ENABLED})
+        self.db.put_attachment(self.member, b'some binary \x00 content',
+                               filename='photo.png',
+                               content_type='image/png')
+        self.events = [self.save({constants.DOCTYPE: constants.EVENT,
+                                  'member': 'alice@example.org',
+                                  'credit': -20.0 * i})
+                       for i in range(5)]
+        # Not belonging to the application; not dumped.
+        self.save({'name': 'foreign'})
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def new_database(self):
+        return new_database(self.backend, self.tmpdir.name)
+
+    def save(self, doc):
+        doc['_id'] = utils.get_iuid()
+        self.db.save(doc)
+        return doc
+
+    def get_filepath(self, name):
+        return os.path.join(self.tmpdir.name, name)
+
+    def test_full_and_delta(self):
+        full = self.get_filepath('full.tar.gz')
+        dump.dump(self.db, full)
+        # Change, delete and add documents after the full dump.
+        member = self.db[self.member['_id']]
+        member['status'] = constants.DISABLED
+        self.db.save(member)
+        self.db.delete(self.db[self.events[0]['_id']])
+        self.save({constants.DOCTYPE: constants.EVENT,
+                   'member': 'alice@example.org',
+                   'credit': 100.0})
+        delta = self.get_filepath('delta.tar.gz')
+        dump.dump(self.db, delta,
+                  since=dump.get_metadata(full)['update_seq'])
+        self.assertEqual(dump.get_metadata(delta)['since'],
+                         dump.get_metadata(full)['update_seq'])
+
+        copy = self.new_database()
+        undump.undump_chain(copy, [full, delta], batch_size=2, threads=2)
+        docs, attachments = get_contents(self.db)
+        docs = dict([(docid, doc) for docid, doc in docs.items()
+                     if doc.get(constants.DOCTYPE)])
+        self.assertEqual(get_contents(copy), (docs, attachments))
+        self.assertNotIn(self.events[0]['_id'], copy)
+        self.assertEqual(copy[self.member['_id']]['status'],
+                         constants.DISABLED)
+        self.assertFalse(os.path.exists(full + '.checkpoint'))
+
+    def test_chain_order(self):
+        full = self.get_filepath('full.tar')
+        dump.dump(self.db, full)
+        self.save({constants.DOCTYPE: constants.EVENT, 'credit': 1.0})
+        first = self.get_filepath('first.tar')
+        dump.dump(self.db, first,
+                  since=dump.get_metadata(full)['update_seq'])
+        self.save({constants.DOCTYPE: constants.EVENT, 'credit': 2.0})
+        second = self.get_filepath('second.tar')
+        dump.dump(self.db, second,
+                  since=dump.get_metadata(first)['update_seq'])
+        with self.assertRaises(ValueError):
+            undump.undump_chain(self.new_database(), [first])
+        with self.assertRaises(ValueError):
+            undump.undump_chain(self.new_database(), [full, second])
+
+
+class SqliteDumpTestCase(DumpTestCase):
+    backend = 'sqlite'
@@ -0,0 +1,27 @@
+"The synthetic dataset generator."
+
+import unittest
+
+import base                     # The settings for the tests.
+
+from beerclub import constants
+from beerclub import generate
+from beerclub import utils
+
+
+def get_docs(**kwargs):
+    return list(generate.Generator(members=20, days=20, randomseed=3,
+                                   until='2024-01-31', **kwargs))
+
+
+class GenerateTestCase(unittest.TestCase):
+
+    def test_deterministic(self):
+        "The output is the same for the same seed, including the password."
+        docs = get_docs(admin_password='secret123')
+        self.assertEqual(docs, get_docs(admin_password='secret123'))
+        admins = [d for d in docs if d.get('role') == constants.ADMIN]
+        self.assertTrue(admins)
+        for admin in admins:
+            self.assertTrue(utils.verify_password('secret123',
+                                                  admin['password']))
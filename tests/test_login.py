@@ -0,0 +1,66 @@
+"Login by password, and replacing outdated hashed forms of the password."
+
+from base import BeerClubTestCase
+
+from beerclub import constants
+from beerclub import settings
+from beerclub import utils
+
+PASSWORD = 'correct horse battery'
+
+
+class LoginTestCase(BeerClubTestCase):
+
+    def login(self, password):
+        return self.post_form('/login', dict(email='alice@example.org',
+                                             password=password))
+
+    def get_stored(self):
+        return self.db[self.member['_id']]['password']
+
+    def get_user_cookies(self, response):
+        return [c for c in response.headers.get_list('Set-Cookie')
+                if c.startswith(constants.USER_COOKIE + '=')]
+
+    def assertLoggedIn(self, response):
+        self.assertEqual(response.code, 303)
+        self.assertEqual(len(self.get_user_cookies(response)), 1)
+        self.assertIsNotNone(self.db[self.member['_id']]['login'])
+
+    def test_legacy_rehashed(self):
+        self.member = self.add_member(
+            'alice@example.org',
+            password=utils.legacy_hashed_password(PASSWORD),
+            login=False)
+        self.assertLoggedIn(self.login(PASSWORD))
+        stored = self.get_stored()
+        self.assertTrue(stored.startswith("%s$%i$" %
+                                          (utils.PASSWORD_ALGORITHM,
+                                           settings['PASSWORD_ITERATIONS'])))
+        self.assertFalse(utils.needs_rehash(stored))
+        self.assertTrue(utils.verify_password(PASSWORD, stored))
+        # The new hashed form works for the next login.
+        self.assertLoggedIn(self.login(PASSWORD))
+        self.assertEqual(self.get_stored(), stored)
+
+    def test_outdated_iterations_rehashed(self):
+        outdated = utils.hashed_password(PASSWORD, iterations=500)
+        self.member = self.add_member('alice@example.org',
+                                      password=outdated, login=False)
+        self.assertLoggedIn(self.login(PASSWORD))
+        self.assertNotEqual(self.get_stored(), outdated)
+        self.assertFalse(utils.needs_rehash(self.get_stored()))
+
+    def test_wrong_password_not_rehashed(self):
+        legacy = utils.legacy_hashed_password(PASSWORD)
+        self.member = self.add_member('alice@example.org',
+                                      password=legacy, login=False)
+        response = self.login('wrong password')
+        self.assertEqual(response.code, 303)
+        self.assertEqual(self.get_user_cookies(response), [])
+        self.assertEqual(self.get_stored(), legacy)
+        self.assertIsNone(self.db[self.member['_id']]['login'])
+
+
+class SqliteLoginTestCase(LoginTestCase):
+    backend = 'sqlite'
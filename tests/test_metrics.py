@@ -0,0 +1,43 @@
+"Tracing the database calls of a request."
+
+import re
+
+from base import BeerClubTestCase
+
+from beerclub import constants
+from beerclub import settings
+
+
+class TraceTestCase(BeerClubTestCase):
+
+    def setUp(self):
+        super().setUp()
+        settings['TRACE_REQUESTS'] = True
+        self.add_member('admin@example.org', role=constants.ADMIN)
+        self.add_member('alice@example.org')
+        self.add_event('alice@example.org')
+
+    def tearDown(self):
+        settings['TRACE_REQUESTS'] = False
+        super().tearDown()
+
+    def get_traced_views(self, path):
+        "Return the names of the views given in the Server-Timing header."
+        response = self.fetch_as('admin@example.org', path)
+        self.assertEqual(response.code, 200)
+        return re.findall(r'view;desc="([^ "]+)',
+                          response.headers['Server-Timing'])
+
+    def test_members(self):
+        views = self.get_traced_views('/members')
+        for viewname in ['member/email', 'event/credit',
+                         'event/latest', 'event/member']:
+            self.assertIn(viewname, views)
+
+    def test_home_and_ledger(self):
+        self.assertIn('event/beverage', self.get_traced_views('/'))
+        self.assertIn('event/payment', self.get_traced_views('/ledger'))
+
+
+class SqliteTraceTestCase(TraceTestCase):
+    backend = 'sqlite'
@@ -0,0 +1,60 @@
+"Paging through the events with cursors."
+
+import base64
+import json
+import re
+
+from base import BeerClubTestCase
+
+
+def make_cursor(key, docid):
+    data = json.dumps([key, docid]).encode('utf-8')
+    return base64.urlsafe_b64encode(data).decode('ascii')
+
+
+class AccountPagingTestCase(BeerClubTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.add_member('alice@example.org')
+        self.add_member('bob@example.org')
+        self.add_member('carol@example.org')
+        for days in range(5):
+            self.add_event('alice@example.org', days=-days/10.0)
+            self.add_event('carol@example.org', days=-days/10.0)
+
+    def test_cursor_pages(self):
+        response = self.fetch_as('bob@example.org',
+                                 '/account/bob@example.org')
+        self.assertEqual(response.code, 200)
+        response = self.fetch_as('alice@example.org',
+                                 '/account/alice@example.org?size=2')
+        self.assertEqual(response.code, 200)
+        match = re.search(r'after=([A-Za-z0-9_=-]+)',
+                          response.body.decode('utf-8'))
+        self.assertIsNotNone(match)
+        response = self.fetch_as('alice@example.org',
+                                 '/account/alice@example.org?size=2&after=%s'
+                                 % match.group(1))
+        self.assertEqual(response.code, 200)
+
+    def test_forged_cursor_rejected(self):
+        "A cursor outside the member's keys must not show others' events."
+        for argument, key in [('after', ['carol@example.org', '9999']),
+                              ('before', ['alice@example.org', '']),
+                              ('after', 'carol@example.org')]:
+            cursor = make_cursor(key, 'f' * 32)
+            response = self.fetch_as('bob@example.org',
+                                     '/account/bob@example.org?%s=%s'
+                                     % (argument, cursor))
+            self.assertEqual(response.code, 400)
+            self.assertNotIn(b'carol@example.org', response.body)
+
+    def test_invalid_cursor_rejected(self):
+        response = self.fetch_as('bob@example.org',
+                                 '/account/bob@example.org?after=garbage')
+        self.assertEqual(response.code, 400)
+
+
+class SqliteAccountPagingTestCase(AccountPagingTestCase):
+    backend = 'sqlite'
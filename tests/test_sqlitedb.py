@@ -0,0 +1,143 @@
+"The SQLite backend must give the same results as the stand-in."
+
+import tempfile
+import unittest
+
+import couchdb
+
+from base import new_database
+
+from beerclub import constants
+
+MEMBERS = ['alice@example.org', 'Bob@example.org', 'carol@example.org']
+
+
+def get_rows(db, viewname, **options):
+    """Return the view rows as dictionaries, without document revisions.
+    The numbers in the reduced values are compared as floats, as in
+    JavaScript, to a precision independent of the order of summation.
+    """
+    result = []
+    for row in db.view(viewname, **options):
+        row = dict(row)
+        if viewname == '_all_docs':
+            row.pop('value')
+        elif isinstance(row['value'], dict):
+            row['value'] = dict([(k, float("%.12g" % v))
+                                 for k, v in row['value'].items()])
+        if row.get('doc'):
+            row['doc'] = dict(row['doc'])
+            row['doc'].pop('_rev')
+        result.append(row)
+    return result
+
+
+class ParityTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.dbs = [new_database('standin', self.tmpdir.name),
+                    new_database('sqlite', self.tmpdir.name)]
+        for db in self.dbs:
+            for pos, email in enumerate(MEMBERS):
+                db.save({'_id': "member%02i" % pos,
+                         constants.DOCTYPE: constants.MEMBER,
+                         'email': email,
+                         'status': constants.ENABLED})
+            for pos in range(30):
+                # Several events having the same timestamp.
+                timestamp = "2020-01-%02iT12:00:00.000Z" % (1 + pos // 3)
+                db.save({'_id': "event%02i" % pos,
+                         constants.DOCTYPE: constants.EVENT,
+                         'action': constants.PURCHASE,
+                         'member': MEMBERS[pos % 3],
+                         'credit': -10.0 * (pos % 4) - 0.5,
+                         'date': timestamp[:10],
+                         'log': dict(timestamp=timestamp)})
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def assertSameRows(self, viewname, **options):
+        results = [get_rows(db, viewname, **options) for db in self.dbs]
+        self.assertEqual(results[0], results[1])
+        return results[0]
+
+    def test_ranges(self):
+        rows = self.assertSameRows('event/ledger', reduce=False)
+        self.assertEqual(len(rows), 30)
+        start = rows[16]
+        for descending in [False, True]:
+            for skip in [0, 1]:
+                rows = self.assertSameRows('event/ledger',
+                                           startkey=start['key'],
+                                           startkey_docid=start['id'],
+                                           descending=descending,
+                                           skip=skip, limit=7,
+                                           include_docs=True,
+                                           reduce=False)
+                self.assertEqual(len(rows), 7)
+        rows = self.assertSameRows('event/member',
+                                   startkey=[MEMBERS[1], 'ZZZZZZZZ'],
+                                   endkey=[MEMBERS[1], ''],
+                                   descending=True)
+        self.assertEqual(len(rows), 10)
+        self.assertSameRows('_all_docs', startkey='event10',
+                            endkey='event20', inclusive_end=False)
+
+    def test_keys_group(self):
+        keys = [MEMBERS[2], 'nobody@example.org', MEMBERS[0]]
+        rows = self.assertSameRows('event/credit', keys=keys, group=True)
+        self.assertEqual([r['key'] for r in rows], [MEMBERS[2], MEMBERS[0]])
+        self.assertSameRows('member/email', keys=keys, include_docs=True)
+        self.assertSameRows('event/credit', group_level=1)
+
+    def test_stats(self):
+        rows = self.assertSameRows('event/latest', group=False)
+        self.assertEqual(rows[0]['value']['count'], 30)
+        self.assertSameRows('event/latest', group=True)
+        self.assertSameRows('event/latest', key=MEMBERS[1], group=True)
+
+    def test_changes(self):
+        for db in self.dbs:
+            doc = db['event05']
+            doc['credit'] = 0.0
+            db.save(doc)
+            db.delete(db['event06'])
+        results = []
+        for db in self.dbs:
+            result = []
+            since = db.changes(limit=10)['last_seq']
+            while True:
+                changes = db.changes(since=since, limit=10)
+                result.extend([(c['id'], c.get('deleted', False))
+                               for c in changes['results']])
+                if len(changes['results']) < 10: break
+                since = changes['last_seq']
+            results.append(result)
+        self.assertEqual(results[0], results[1])
+        self.assertEqual(len(results[0]), 33 - 10)
+        self.assertEqual(results[0][-2:], [('event05', False),
+                                           ('event06', True)])
+
+    def test_update_conflicts(self):
+        results = []
+        for db in self.dbs:
+            stale = db['event01']
+            current = db['event01']
+            current['credit'] = 1.0
+            db.save(current)
+            stale['credit'] = 2.0
+            result = db.update([stale,
+                                {'_id': 'event02', 'credit': 3.0},
+                                dict(db['event03'], credit=4.0),
+                                {'_id': 'new'}])
+            results.append([(success, docid, type(error).__name__)
+                            for success, docid, error in result
+                            if not success])
+            self.assertEqual([success for success, docid, rev in result],
+                             [False, False, True, True])
+            self.assertEqual(db['event01']['credit'], 1.0)
+            self.assertEqual(db['event03']['credit'], 4.0)
+        self.assertEqual(results[0], results[1])
+        self.assertEqual(results[0][0][1], 'event01')
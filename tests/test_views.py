@@ -0,0 +1,40 @@
+"The view map functions, as translated for the stand-in and SQLite backends."
+
+import tempfile
+import unittest
+
+from base import new_database
+
+from beerclub import constants
+from beerclub import utils
+
+
+class LatestEventTestCase(unittest.TestCase):
+
+    backend = 'standin'
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_invalid_timestamp_ignored(self):
+        "An event lacking a valid timestamp must not break the reduce."
+        db = new_database(self.backend, self.tmpdir.name)
+        for log in [dict(timestamp=utils.timestamp()),
+                    dict(timestamp='not a timestamp'),
+                    dict(timestamp=None),
+                    None]:
+            db.save({'_id': utils.get_iuid(),
+                     constants.DOCTYPE: constants.EVENT,
+                     'member': 'alice@example.org',
+                     'log': log})
+        rows = list(db.view('event/latest', group=True))
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0].value['count'], 1)
+        self.assertEqual(rows[0].value['max'], rows[0].value['min'])
+
+
+class SqliteLatestEventTestCase(LatestEventTestCase):
+    backend = 'sqlite'